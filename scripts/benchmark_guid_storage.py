@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+import argparse
+import os
+import tempfile
+import time
+
+# Assumes you've installed pandelephant package with setup.py
+import pandelephant
+from pandelephant import _db_models
+
+"""
+USAGE: benchmark_guid_storage.py [-syscalls N]
+
+Compares the default 32 character hex uuid keys with compact_guids (16 byte binary)
+on SQLite: file size, bulk insert throughput and full table read throughput.
+"""
+
+def populate(ds, num_syscalls):
+    execution = ds.new_execution('benchmark')
+    [process] = ds.new_processes(execution, [(0, 1, 0)])
+    threads = ds.new_threads([(process, i, i, ['thread{}'.format(i)]) for i in range(16)])
+    args = [{'type': 'unsigned64', 'value': 1}, {'type': 'pointer', 'value': 'deadbeef'}, {'type': 'string', 'value': '/etc/passwd'}]
+    ds.new_syscall_collection((threads[i % len(threads)], 'sys_read', 0, args, i, 0x1000 + i) for i in range(num_syscalls))
+
+def read_all(ds):
+    # Core reads so the GUID conversion dominates instead of ORM object construction
+    rows = 0
+    with ds.engine.connect() as conn:
+        for table in (_db_models.Syscall.__table__, _db_models.SyscallArgument.__table__):
+            for _ in conn.execute(table.select()):
+                rows += 1
+    return rows
+
+def benchmark(path, num_syscalls, compact_guids):
+    ds = pandelephant.PandaDatastore('sqlite:///' + path, compact_guids=compact_guids)
+    t1 = time.time()
+    populate(ds, num_syscalls)
+    t2 = time.time()
+    rows = read_all(ds)
+    t3 = time.time()
+    ds.engine.dispose()
+    return {
+        'size': os.path.getsize(path),
+        'insert_rate': num_syscalls / (t2 - t1),
+        'read_rate': rows / (t3 - t2),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark hex vs binary uuid storage on sqlite")
+    parser.add_argument("-syscalls", help="number of syscalls to insert", type=int, default=100000)
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, compact_guids in (('hex CHAR(32)', False), ('BINARY(16)', True)):
+            results[name] = benchmark(os.path.join(tmp, name.split()[0] + '.db'), args.syscalls, compact_guids)
+
+    print('{:<14} {:>12} {:>18} {:>16}'.format('storage', 'db bytes', 'syscalls/s insert', 'rows/s read'))
+    for name, r in results.items():
+        print('{:<14} {:>12} {:>18.0f} {:>16.0f}'.format(name, r['size'], r['insert_rate'], r['read_rate']))
+    base, compact = results['hex CHAR(32)'], results['BINARY(16)']
+    print('size {:.2f}x, insert {:.2f}x, read {:.2f}x'.format(base['size'] / compact['size'], compact['insert_rate'] / base['insert_rate'], compact['read_rate'] / base['read_rate']))
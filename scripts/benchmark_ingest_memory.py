@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+import argparse
+import random
+import tracemalloc
+
+# Needs LEET_PANDA_SCRIPTS_DIR set, same as plog_to_pandelephant.py
+import plog_to_pandelephant as ingest
+
+"""
+USAGE: benchmark_ingest_memory.py [-flows N]
+
+Measures how many bytes each taint flow costs in the ingest's intermediate representation:
+the namedtuple list and set the ingest used to keep (buffered flows, and resolved flows
+with their code points) against the RecordColumns it keeps now.
+"""
+
+def synthetic_flows(num_flows, num_threads=16):
+    rng = random.Random(0)
+    threads = [ingest.CollectedThread(ProcessId=1000 + t // 4, ParentProcessId=1, ThreadId=2000 + t, CreateTime=rng.getrandbits(40)) for t in range(num_threads)]
+    instr = 0
+    for _ in range(num_flows):
+        instr += rng.randint(1, 1000)
+        yield ingest.PendingTaintFlow(
+            IsStore=rng.random() < 0.5,
+            SourceThread=rng.choice(threads), SourcePc=0x400000 + rng.getrandbits(20), SourceInstructionCount=instr,
+            SinkThread=rng.choice(threads), SinkPc=0x400000 + rng.getrandbits(20), SinkInstructionCount=instr + rng.randint(1, 100))
+
+def measure(build, num_flows):
+    # Allocations that survive building the structure, per flow
+    tracemalloc.start()
+    tracemalloc.clear_traces()
+    before, _ = tracemalloc.get_traced_memory()
+    structure = build(synthetic_flows(num_flows))
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del structure
+    return (after - before) / num_flows
+
+def namedtuple_list(flows):
+    return list(flows)
+
+def resolved_set(flows):
+    mapping = ingest.BetterCollectedMapping(AddressSpaceId=0, Process=None, Name='prog', File='/bin/prog', BaseAddress=0x400000, Size=0x100000)
+    return set(ingest.CollectedTaintFlow(
+        IsStore=f.IsStore,
+        SourceCodePoint=ingest.CollectedCodePoint(Mapping=mapping, Offset=f.SourcePc - mapping.BaseAddress), SourceThread=f.SourceThread, SourceInstructionCount=f.SourceInstructionCount,
+        SinkCodePoint=ingest.CollectedCodePoint(Mapping=mapping, Offset=f.SinkPc - mapping.BaseAddress), SinkThread=f.SinkThread, SinkInstructionCount=f.SinkInstructionCount)
+        for f in flows)
+
+def columns(flows):
+    c = ingest.PendingTaintFlowColumns({ 'threads': ingest.Interner() })
+    for f in flows:
+        c.add(f)
+    return c
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark memory per taint flow of the ingest's intermediate representation")
+    parser.add_argument("-flows", help="number of taint flows", type=int, default=200000)
+    args = parser.parse_args()
+
+    results = [
+        ('buffered flows, list of PendingTaintFlow', measure(namedtuple_list, args.flows)),
+        ('resolved flows, set of CollectedTaintFlow', measure(resolved_set, args.flows)),
+        ('buffered flows, PendingTaintFlowColumns', measure(columns, args.flows)),
+    ]
+    for name, per_flow in results:
+        print('{:<44} {:>8.1f} bytes/flow'.format(name, per_flow))
+    before = results[0][1] + results[1][1]
+    print('before (both held at once) {:.1f} bytes/flow, after {:.1f} bytes/flow, {:.1f}x smaller'.format(before, results[2][1], before / results[2][1]))
@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+
+from sqlalchemy import create_engine
+
+# Needs LEET_PANDA_SCRIPTS_DIR set, same as plog_to_pandelephant.py
+import plog_to_pandelephant as ingest
+
+"""
+USAGE: check_ingest_modes.py -pandalog PLOG
+
+Ingests PLOG once per mode of plog_to_pandelephant.py, each into a new SQLite file, and checks
+that every mode writes the same database contents as the plain batch ingest. Rows are compared
+by what they hold, not their ids. --follow resolves taint flows against the mappings known when
+their chunk arrives, so its taint flows aren't compared.
+Exits non-zero if any mode differs.
+"""
+
+# name -> query of the rows it compares
+CONTENTS = [
+    ('processes', "select pid, ppid, create_time from processes"),
+    ('threads', "select p.pid, t.tid, t.create_time, n.name from threads t join processes p using(process_id) join thread_names n using(thread_id)"),
+    ('mappings', "select p.pid, m.name, m.path, v.asid, v.address, m.size, m.first_seen_execution_offset, m.last_seen_execution_offset "
+                 "from mappings m join processes p using(process_id) join virtual_addresses v on v.address_id = m.base_id"),
+    ('thread slices', "select t.tid, s.start_execution_offset, s.end_execution_offset from threadslice s join threads t using(thread_id)"),
+    ('syscalls', "select t.tid, s.name, s.execution_offset, s.pc, a.position, a.argument_type, a.value, a.int_value, a.bytes_value "
+                 "from syscalls s join threads t using(thread_id) left join syscall_arguments a using(syscall_id)"),
+    ('taint flows', "select f.source_is_store, st.tid, f.source_execution_offset, sc.offset, kt.tid, f.sink_execution_offset, kc.offset from taint_flows f "
+                    "join threads st on st.thread_id = f.source_thread_id join threads kt on kt.thread_id = f.sink_thread_id "
+                    "join code_points sc on sc.code_point_id = f.source_id join code_points kc on kc.code_point_id = f.sink_id"),
+]
+
+# name -> plog_to_pe keyword arguments, the contents it isn't expected to match
+MODES = [
+    ('jobs', {'jobs': 2}, ()),
+    ('writers', {'writers': 2}, ()),
+    ('memory budget', {'memory_budget': 8192}, ()),
+    ('memory budget, jobs', {'memory_budget': 8192, 'jobs': 2}, ()),
+    ('memory budget, writers', {'memory_budget': 8192, 'writers': 2}, ()),
+    ('checkpoint chunks', {'checkpoint_chunks': 2}, ()),
+    ('follow', {'follow': True, 'poll_interval': 0.01}, ('taint flows',)),
+]
+
+def contents(db_file):
+    engine = create_engine('sqlite:///' + db_file)
+    try:
+        # by repr, a left join can put None among the values of a column
+        return {name: sorted((tuple(row) for row in engine.execute(query)), key=repr) for (name, query) in CONTENTS}
+    finally:
+        engine.dispose()
+
+def ingest_into(directory, name, pandalog, kwargs):
+    db_file = os.path.join(directory, name.replace(', ', '_').replace(' ', '_') + '.db')
+    with contextlib.redirect_stdout(io.StringIO()):
+        ingest.plog_to_pe(pandalog, 'sqlite:///' + db_file, 'check', **kwargs)
+    return contents(db_file)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="check every ingest mode writes the same database contents")
+    parser.add_argument("-pandalog", help="pandalog", action="store", required=True)
+    args = parser.parse_args()
+
+    failures = 0
+    with tempfile.TemporaryDirectory(prefix='check_ingest_modes') as directory:
+        expected = ingest_into(directory, 'batch', args.pandalog, {})
+        for (mode, kwargs, skipped) in MODES:
+            got = ingest_into(directory, mode, args.pandalog, kwargs)
+            for (name, _) in CONTENTS:
+                if name in skipped:
+                    continue
+                ok = got[name] == expected[name]
+                failures += 0 if ok else 1
+                print('{:<40} {}'.format(mode + ' ' + name, 'ok' if ok else 'FAILED ({} rows, {} expected)'.format(len(got[name]), len(expected[name]))))
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+import argparse
+import os
+import sys
+import tempfile
+import threading
+
+# Assumes you've installed pandelephant package with setup.py
+import pandelephant
+
+"""
+USAGE: check_session_scope.py [-db_url URL]
+
+Checks that what is written inside a PandaDatastore.session_scope can be read back by the
+calls made in the same scope, including the ones that read through Core statements instead
+of ORM queries, and that the in memory indexes built from an execution's mappings are rebuilt
+once a scope that wrote mappings commits. Exits non-zero if any check fails.
+"""
+
+def check_reads_in_scope(ds):
+    args = [{'name': 'fd', 'type': 'unsigned64', 'value': 1}]
+    with ds.session_scope():
+        execution = ds.new_execution('reads_in_scope')
+        process = ds.new_process(execution, 0, 1, 0)
+        thread = ds.new_thread(process, 0, 1, ['t'])
+        ds.new_syscall(thread, 'sys_read', 0, args, 10, 0)
+        ds.new_threadslice(thread, 0, 20)
+        ds.new_mapping(process, 'lib', '/lib', 0, 0x1000, 0, 0x100, 0, 100)
+        return [
+            ('iter_syscalls', len(list(ds.iter_syscalls(execution))) == 1),
+            ('iter_syscall_batches', sum(len(b.syscalls) for b in ds.iter_syscall_batches(execution)) == 1),
+            ('iter_threadslices', len(list(ds.iter_threadslices(execution))) == 1),
+            ('resolve_address', ds.resolve_address(execution, 0, 0x1010, 50) is not None),
+            ('snapshot_at', len(ds.snapshot_at(execution, 50).mappings) == 1),
+            ('get_execution_stats', ds.get_execution_stats(execution).syscalls.count == 1),
+        ]
+
+def check_address_index_after_commit(ds):
+    execution = ds.new_execution('address_index_after_commit')
+    process = ds.new_process(execution, 0, 1, 0)
+    # cached before the scope, while the scope is open (from another thread) and from inside it
+    before = ds.resolve_address(execution, 0, 0x1010, 50)
+    with ds.session_scope():
+        ds.new_mapping(process, 'lib', '/lib', 0, 0x1000, 0, 0x100, 0, 100)
+        other = threading.Thread(target=lambda: ds.resolve_address(execution, 0, 0x1010, 50))
+        other.start()
+        other.join()
+        inside = ds.resolve_address(execution, 0, 0x1010, 50)
+    return [
+        ('resolve_address before', before is None),
+        ('resolve_address inside', inside is not None),
+        ('resolve_address after', ds.resolve_address(execution, 0, 0x1010, 50) is not None),
+        ('resolve_addresses after', ds.resolve_addresses(execution, [0], [0x1010], [50])[0] is not None),
+    ]
+
+def check_seen_ranges_after_commit(ds):
+    execution = ds.new_execution('seen_ranges_after_commit')
+    process = ds.new_process(execution, 0, 1, 0)
+    thread = ds.new_thread(process, 0, 1, ['t'])
+    ds.new_threadslice(thread, 0, 100)
+    before = ds.snapshot_at(execution, 50)
+    with ds.session_scope():
+        ds.new_mapping(process, 'lib', '/lib', 0, 0x1000, 0, 0x100, 0, 100)
+        other = threading.Thread(target=lambda: ds.snapshot_at(execution, 50))
+        other.start()
+        other.join()
+        inside = ds.snapshot_at(execution, 50)
+    after = ds.snapshot_at(execution, 50)
+    try:
+        with ds.session_scope():
+            ds.new_mapping(process, 'rolled back', '/lib', 0, 0x2000, 0, 0x100, 0, 100)
+            ds.snapshot_at(execution, 50)
+            raise RuntimeError('roll back')
+    except RuntimeError:
+        pass
+    return [
+        ('snapshot_at before', len(before.mappings) == 0),
+        ('snapshot_at inside', len(inside.mappings) == 1),
+        ('snapshot_at after', len(after.mappings) == 1),
+        ('snapshot_at after rollback', len(ds.snapshot_at(execution, 50).mappings) == 1),
+    ]
+
+CHECKS = [check_reads_in_scope, check_address_index_after_commit, check_seen_ranges_after_commit]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="check reads made inside a session_scope")
+    # not sqlite://, each thread would get its own in memory database
+    parser.add_argument("-db_url", help="db url (should be an empty database, default a new SQLite file)", action="store", default=None)
+    args = parser.parse_args()
+
+    ds = pandelephant.PandaDatastore(args.db_url or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'check_session_scope.db'))
+    failures = 0
+    for check in CHECKS:
+        for name, ok in check(ds):
+            failures += 0 if ok else 1
+            print('{:<40} {}'.format(check.__name__ + ' ' + name, 'ok' if ok else 'FAILED'))
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+import argparse
+import io
+import sys
+import tempfile
+import uuid
+
+# Assumes you've installed pandelephant package with setup.py
+import pandelephant
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+"""
+USAGE: check_statement_counts.py [-db_url URL] [-v]
+
+Runs each PandaDatastore API call against a populated database and checks the number
+of SQL statements it emits against a fixed budget, so N+1 query patterns (a statement
+per row instead of per call) are caught. Exits non-zero if any call is over budget.
+"""
+
+NUM_EXECUTIONS = 5
+NUM_PROCESSES = 20
+# writes also look up, update and insert the execution_stats rows they change
+STATS = 3
+
+def populate(ds):
+    executions = []
+    for i in range(NUM_EXECUTIONS):
+        execution = ds.new_execution('execution{}'.format(i))
+        processes = ds.new_processes(execution, [(p, p, 1) for p in range(NUM_PROCESSES)])
+        threads = ds.new_threads([(p, 0, p.pid(), ['a', 'b']) for p in processes])
+        mappings = ds.new_mappings([(p, 'lib', '/lib', 0, 0x1000, 0, 0x100, 0, 100) for p in processes])
+        executions.append((execution, processes, threads, mappings))
+    ds.new_recording('recording', 'prefix', 100, b'log', b'snapshot')
+    return executions
+
+def checks(ds, executions):
+    (execution, processes, threads, mappings) = executions[0]
+    args = [{'name': 'fd', 'type': 'unsigned64', 'value': 1}, {'name': 'buf', 'type': 'pointer', 'value': 'beef'}]
+    flows = [(True, threads[i], mappings[i], i, i, threads[0], mappings[0], i, i + 1) for i in range(len(threads))]
+    # (description, call, statement budget)
+    checks = [
+        ('get_executions', lambda: ds.get_executions(), 2),
+        ('get_execution_by_uuid', lambda: ds.get_execution_by_uuid(execution.uuid()), 2),
+        ('get_execution_by_name', lambda: ds.get_execution_by_name(execution.name()), 2),
+        ('get_recordings', lambda: ds.get_recordings(), 2),
+        ('new_execution', lambda: ds.new_execution('another'), 1),
+        ('new_process', lambda: ds.new_process(execution, 0, 1, 1), 1 + STATS),
+        ('new_thread', lambda: ds.new_thread(processes[0], 0, 1, ['x']), 2 + STATS),
+        ('new_mapping', lambda: ds.new_mapping(processes[0], 'lib', '/lib', 0, 0, 0, 1, 0, 1), 2 + STATS),
+        ('new_taintflow', lambda: ds.new_taintflow(True, threads[0], mappings[0], 1, 1, threads[0], mappings[0], 2, 2), 5 + STATS),
+        ('new_threadslice', lambda: ds.new_threadslice(threads[0], 0, 1), 1 + STATS),
+        ('new_syscall', lambda: ds.new_syscall(threads[0], 'sys_read', 0, args, 0, 0), 1 + len(args) + STATS),
+        ('new_processes', lambda: ds.new_processes(execution, [(0, p, 1) for p in range(100)]), 1 + STATS),
+        ('new_threads', lambda: ds.new_threads([(processes[0], 0, t, ['x']) for t in range(100)]), 2 + STATS),
+        ('set_process_create_time', lambda: ds.set_process_create_time(processes[0], 0), 1),
+        ('add_thread_names', lambda: ds.add_thread_names(threads[0], ['c', 'd']), 2),
+        ('extend_mappings', lambda: ds.extend_mappings([(m, 0, 200) for m in mappings]), 1 + STATS),
+        ('new_mappings', lambda: ds.new_mappings([(processes[0], 'lib', '/lib', 0, 0, 0, 1, 0, 1)] * 100), 2 + STATS),
+        ('new_threadslices', lambda: ds.new_threadslices([(threads[0], i, i) for i in range(100)]), 1 + STATS),
+        ('new_syscall_collection', lambda: ds.new_syscall_collection([(threads[0], 'sys_read', 0, args, i, 0) for i in range(100)]), 2 + STATS),
+        # one lookup per distinct mapping, then the code point and flow inserts
+        ('new_taintflow_collection', lambda: ds.new_taintflow_collection(flows), len(mappings) + 2 + STATS),
+        ('get_execution_stats', lambda: ds.get_execution_stats(execution), 1),
+        # delete, one group by per kind and the inserts
+        ('rebuild_execution_stats', lambda: ds.rebuild_execution_stats(execution), 10),
+        # process and thread ranges, mappings and thread names
+        ('snapshot_at', lambda: ds.snapshot_at(execution, 50), 3),
+        # the address index of the execution is loaded once (mappings were just written) and cached after that
+        ('resolve_address', lambda: ds.resolve_address(execution, 0, 0x10, 50), 1),
+        ('resolve_addresses', lambda: ds.resolve_addresses(execution, [0] * 100, list(range(0, 0x1000, 0x10))[:100], [50] * 100), 0),
+        ('load_taint_graph', lambda: ds.load_taint_graph(execution), 1),
+        # one recursive query however far the taint spreads
+        ('taint_downstream', lambda: ds.taint_downstream(uuid.uuid4(), 0), 1),
+        ('taint_upstream', lambda: ds.taint_upstream(uuid.uuid4(), 100), 1),
+        ('new_code_points', lambda: ds.new_code_points([(mappings[0], i) for i in range(100)]), 2),
+        # one page each: the page query (plus one for the syscall arguments)
+        ('iter_syscalls', lambda: list(ds.iter_syscalls(execution, page_size=1000)), 2),
+        ('iter_syscalls argument range', lambda: list(ds.iter_syscalls(execution, argument=(None, 0, (0, 10)), page_size=1000)), 2),
+        ('iter_taintflows', lambda: list(ds.iter_taintflows(execution, page_size=1000)), 1),
+        ('iter_threadslices', lambda: list(ds.iter_threadslices(execution, page_size=1000)), 1),
+        # the widest syscall, then one streaming query each however many batches
+        ('iter_syscall_batches', lambda: list(ds.iter_syscall_batches(execution, batch_size=10)), 2),
+        ('iter_taintflow_batches', lambda: list(ds.iter_taintflow_batches(execution, batch_size=10)), 1),
+        ('iter_threadslice_batches', lambda: list(ds.iter_threadslice_batches(execution, batch_size=10)), 1),
+        # processes, threads and their names, mappings, code points, then the thread slice, syscall and taint flow batches
+        ('write_execution_dump', lambda: ds.write_execution_dump(execution, io.BytesIO(), batch_size=10), 9),
+        # nothing to move in a database created with the typed columns, just the lookup
+        ('migrate_syscall_arguments', lambda: ds.migrate_syscall_arguments(), 1),
+        ('save_ingest_checkpoint', lambda: ds.save_ingest_checkpoint(execution, 'plog', pandelephant.IngestCheckpoint('decode', 1, 2, 3, b'state')), 2),
+        ('get_ingest_checkpoint', lambda: ds.get_ingest_checkpoint(execution, 'plog'), 1),
+        ('add_ingest_checkpoint_data', lambda: ds.add_ingest_checkpoint_data(execution, 'plog', b'data'), 1),
+        ('iter_ingest_checkpoint_data', lambda: list(ds.iter_ingest_checkpoint_data(execution, 'plog')), 1),
+        ('delete_ingest_checkpoint_data', lambda: ds.delete_ingest_checkpoint_data(execution, 'plog'), 1),
+    ]
+    if pyarrow is not None:
+        export_dir = tempfile.mkdtemp()
+        checks += [
+            # processes, threads and their names, mappings, thread slices, the widest syscall, syscalls and taint flows
+            ('export_execution', lambda: ds.export_execution(execution, export_dir), 8),
+            # the inserts of each table and a stats update per batch write, then new_taintflow_collection's code point lookups
+            ('import_execution', lambda: ds.import_execution(export_dir, name='imported'), 11 + 6 * STATS + len(mappings)),
+        ]
+    return checks
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="check the number of SQL statements emitted per API call")
+    parser.add_argument("-db_url", help="db url (should be an empty database)", action="store", default="sqlite://")
+    parser.add_argument("-v", help="print the statements of calls over budget", action="store_true")
+    args = parser.parse_args()
+
+    ds = pandelephant.PandaDatastore(args.db_url)
+    executions = populate(ds)
+
+    failures = 0
+    for name, call, budget in checks(ds, executions):
+        with ds.count_statements() as counter:
+            call()
+        ok = counter.count <= budget
+        failures += 0 if ok else 1
+        print('{:<30} {:>4} statements (budget {:>3}) {}'.format(name, counter.count, budget, 'ok' if ok else 'OVER BUDGET'))
+        if not ok and args.v:
+            for statement in counter.statements:
+                print('\t' + statement.replace('\n', ' '))
+    sys.exit(1 if failures else 0)
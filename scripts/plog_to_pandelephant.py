@@ -1,14 +1,30 @@
 #!/usr/bin/python3
 from datetime import datetime, timedelta
 import argparse
+import array
 import sys
 import time
 import os
 import collections
+import concurrent.futures
+import contextlib
+import heapq
+import itertools
+import pickle
+import queue
+import struct
+import tempfile
+import threading
+import zlib
 
 # Assumes you've installed pandelephant package with setup.py
 import pandelephant
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # PLogReader from pandare package is easiest to import,
 # but if it's unavailable, fallback to searching PYTHONPATH
 # which users should add panda/panda/scripts to
@@ -43,84 +59,508 @@ CollectedMappingSlice = collections.namedtuple('CollectedMappingSlice', ['Instru
 CollectedMapping = collections.namedtuple('CollectedMapping', ['Name', 'File', 'BaseAddress', 'Size'])
 BetterCollectedMapping = collections.namedtuple('BetterCollectedMapping', ['AddressSpaceId', 'Process', 'Name', 'File', 'BaseAddress', 'Size'])
 CollectedCodePoint = collections.namedtuple('CollectedCodePoint', ['Mapping', 'Offset'])
-CollectedSyscall = collections.namedtuple('CollectedSyscall', ['Name', 'Thread', 'InstructionCount', 'Arguments'])
+CollectedSyscall = collections.namedtuple('CollectedSyscall', ['Name', 'Thread', 'InstructionCount', 'Pc', 'Arguments'])
 CollectedSyscallArgument = collections.namedtuple('CollectedSyscallArgument', ['Type', 'Value'])
 CollectedTaintFlow = collections.namedtuple('CollectedTaintFlow', ['IsStore', 'SourceCodePoint', 'SourceThread', 'SourceInstructionCount', 'SinkCodePoint', 'SinkThread', 'SinkInstructionCount'])
 
-def CollectThreadsAndProcesses(pandalog):
-    # Why don't we just gather these on the fly? 
-    # Because there are multiple sources for this information
-    # and they have to be reconciled. 
-    # It's oddly tricky to get a consistent view out of a replay
-    # of the set of threads and processes and their names.
-    # One could check at every basic block (by invoking Osi) 
-    # but that would be very slow.  So we check at a few std
-    # temporal points (syscall, every 100 bb, asid_info logging points)
-    # and reconcile.
-    # Better would be if we had callback on after-scheduler-changes-proc
-    #  s.t. we could obtain proc/thread. 
-
-    # thread is (pid, ppid, tid, create_time)
-    # process is (pid, ppid)
-    processes = set()
-    threads = set()
-    thread_slices = set()
-    thread_names = {}
-    def CollectFrom_asid_libraries(msg):
+PendingTaintFlow = collections.namedtuple('PendingTaintFlow', ['IsStore', 'SourceThread', 'SourcePc', 'SourceInstructionCount', 'SinkThread', 'SinkPc', 'SinkInstructionCount'])
+
+# SyscallArg oneof field -> (argument type, struct the value is spilled with or None for strings).
+# Numeric values stay ints all the way to the datastore instead of being formatted as text here.
+SyscallFieldInfo = {
+    'str': ('string',     None),
+    'ptr': ('pointer',    struct.Struct('>Q')),
+    'u64': ('unsigned64', struct.Struct('>Q')),
+    'u32': ('unsigned32', struct.Struct('>Q')),
+    'u16': ('unsigned16', struct.Struct('>Q')),
+    'i64': ('signed64',   struct.Struct('>q')),
+    'i32': ('signed32',   struct.Struct('>q')),
+    'i16': ('signed16',   struct.Struct('>q')),
+}
+SyscallArgumentTypes = {fld: typ for fld, (typ, _) in SyscallFieldInfo.items()}
+
+def syscall_arg_values(args):
+    # CollectedSyscallArguments for all the arguments of a syscall, one WhichOneof lookup each
+    # instead of trying every field with HasField
+    if not args:
+        return ()
+    oneof = args[0].DESCRIPTOR.oneofs[0].name
+    values = []
+    for arg in args:
+        fld = arg.WhichOneof(oneof)
+        if fld is None:
+            raise Exception("Syscall argument with no value set")
+        values.append(CollectedSyscallArgument(SyscallArgumentTypes[fld], getattr(arg, fld)))
+    return tuple(values)
+
+# Records are packed big endian so they sort by thread and then instruction count
+PendingTaintFlowStruct = struct.Struct('>?QQQQQQQQQQQQ')
+SyscallHeaderStruct = struct.Struct('>QQQQQQHH') # thread, instruction count, pc, name length, argument count
+SyscallArgumentTypeStruct = struct.Struct('>B') # index into SyscallArgumentPacking
+SyscallStringLengthStruct = struct.Struct('>I')
+SyscallArgumentPacking = [(typ, value_struct) for (typ, value_struct) in SyscallFieldInfo.values()]
+SyscallArgumentPackingIndex = {typ: i for i, (typ, _) in enumerate(SyscallArgumentPacking)}
+
+def PackPendingTaintFlow(pending):
+    return PendingTaintFlowStruct.pack(pending.IsStore,
+        *pending.SourceThread, pending.SourcePc, pending.SourceInstructionCount,
+        *pending.SinkThread, pending.SinkPc, pending.SinkInstructionCount)
+
+def UnpackPendingTaintFlow(data):
+    f = PendingTaintFlowStruct.unpack(data)
+    return PendingTaintFlow(IsStore=f[0],
+        SourceThread=CollectedThread(*f[1:5]), SourcePc=f[5], SourceInstructionCount=f[6],
+        SinkThread=CollectedThread(*f[7:11]), SinkPc=f[11], SinkInstructionCount=f[12])
+
+def PackSyscall(syscall):
+    name = syscall.Name.encode()
+    parts = [SyscallHeaderStruct.pack(*syscall.Thread, syscall.InstructionCount, syscall.Pc, len(name), len(syscall.Arguments)), name]
+    for arg in syscall.Arguments:
+        index = SyscallArgumentPackingIndex[arg.Type]
+        parts.append(SyscallArgumentTypeStruct.pack(index))
+        value_struct = SyscallArgumentPacking[index][1]
+        if value_struct is None:
+            value = arg.Value.encode()
+            parts.append(SyscallStringLengthStruct.pack(len(value)))
+            parts.append(value)
+        else:
+            parts.append(value_struct.pack(arg.Value))
+    return b''.join(parts)
+
+def UnpackSyscall(data):
+    f = SyscallHeaderStruct.unpack_from(data)
+    i = SyscallHeaderStruct.size
+    name = data[i:i + f[6]].decode()
+    i += f[6]
+    args = []
+    for _ in range(f[7]):
+        typ, value_struct = SyscallArgumentPacking[data[i]]
+        i += SyscallArgumentTypeStruct.size
+        if value_struct is None:
+            (size,) = SyscallStringLengthStruct.unpack_from(data, i)
+            i += SyscallStringLengthStruct.size
+            value = data[i:i + size].decode()
+            i += size
+        else:
+            (value,) = value_struct.unpack_from(data, i)
+            i += value_struct.size
+        args.append(CollectedSyscallArgument(Type=typ, Value=value))
+    return CollectedSyscall(Name=name, Thread=CollectedThread(*f[0:4]), InstructionCount=f[4], Pc=f[5], Arguments=tuple(args))
+
+class SpillSet:
+    '''
+    Set of records that keeps memory use bounded by spilling to disk.
+
+    Records are packed into bytes and held in memory until they take up more than budget
+    bytes, then they are sorted and written to a temporary file in directory as a sorted
+    run. Iterating merges the runs (an external sort) and yields each distinct record once,
+    in the order of their packed bytes. len is the number of records added, duplicates
+    included.
+
+    Runs are plain files, so a SpillSet filled in a worker process can be pickled back
+    and merged as long as both sides use the same directory.
+    '''
+    # merge at most this many runs at once, to keep the number of open files down
+    MaxMergeRuns = 64
+    RecordSizeStruct = struct.Struct('>I')
+
+    def __init__(self, directory, budget, pack, unpack):
+        self.directory = directory
+        self.budget = budget
+        self.pack = pack
+        self.unpack = unpack
+        self.buffer = set()
+        self.buffered_bytes = 0
+        self.runs = []
+        self.count = 0
+
+    def add(self, record):
+        self.add_packed(self.pack(record))
+
+    def add_packed(self, data):
+        self.count += 1
+        if data not in self.buffer:
+            self.buffer.add(data)
+            # the bytes object plus roughly a set slot
+            self.buffered_bytes += sys.getsizeof(data) + 16
+            if self.buffered_bytes > self.budget:
+                self.spill()
+
+    def update(self, records):
+        if isinstance(records, SpillSet):
+            self.runs.extend(records.runs)
+            for data in records.buffer:
+                self.add_packed(data)
+            self.count += records.count - len(records.buffer)
+        else:
+            for record in records:
+                self.add(record)
+
+    # so a SpillSet can stand in for a list too
+    append = add
+    extend = update
+
+    def __len__(self):
+        return self.count
+
+    def write_run(self, records):
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix='.run')
+        with os.fdopen(fd, 'wb', buffering=1 << 20) as f:
+            for data in records:
+                f.write(self.RecordSizeStruct.pack(len(data)))
+                f.write(data)
+        self.runs.append(path)
+
+    def spill(self):
+        self.write_run(sorted(self.buffer))
+        self.buffer = set()
+        self.buffered_bytes = 0
+
+    def read_run(self, path):
+        with open(path, 'rb', buffering=1 << 20) as f:
+            while True:
+                header = f.read(self.RecordSizeStruct.size)
+                if not header:
+                    return
+                yield f.read(self.RecordSizeStruct.unpack(header)[0])
+
+    def merge_runs(self, runs):
+        previous = None
+        for data in heapq.merge(*runs):
+            if data != previous:
+                yield data
+                previous = data
+
+    def __iter__(self):
+        # Fold runs together until one merge pass over them (and the buffer) is cheap enough
+        while len(self.runs) > self.MaxMergeRuns:
+            merging, self.runs = self.runs[:self.MaxMergeRuns], self.runs[self.MaxMergeRuns:]
+            self.write_run(self.merge_runs([self.read_run(path) for path in merging]))
+            for path in merging:
+                os.remove(path)
+        for data in self.merge_runs([self.read_run(path) for path in self.runs] + [iter(sorted(self.buffer))]):
+            yield self.unpack(data)
+
+class Interner:
+    # Hands out a small integer id per distinct value, so columns can store ints instead of tuples
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def __call__(self, value):
+        i = self.ids.get(value)
+        if i is None:
+            i = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return i
+
+    def __getitem__(self, i):
+        return self.values[i]
+
+def SortUnique(columns):
+    # Sort the rows formed by equal length array.arrays (first column first) and drop
+    # duplicate rows, returns the new columns
+    if len(columns[0]) == 0:
+        return columns
+    if np is not None:
+        arrays = [np.frombuffer(column, dtype=column.typecode) for column in columns]
+        order = np.lexsort(arrays[::-1])
+        arrays = [a[order] for a in arrays]
+        keep = np.zeros(len(order), dtype=bool)
+        keep[0] = True
+        for a in arrays:
+            keep[1:] |= a[1:] != a[:-1]
+        unique = []
+        for column, a in zip(columns, arrays):
+            u = array.array(column.typecode)
+            u.frombytes(a[keep].tobytes())
+            unique.append(u)
+        return unique
+    unique = [array.array(column.typecode) for column in columns]
+    previous = None
+    for row in sorted(zip(*columns)):
+        if row != previous:
+            for u, v in zip(unique, row):
+                u.append(v)
+            previous = row
+    return unique
+
+class RecordColumns:
+    '''
+    Column-wise storage for one kind of collected record, a few bytes per record instead of
+    a namedtuple and its int objects.
+
+    Every field is an array.array. Fields holding threads, names and other values that
+    repeat a lot are stored as ids from a shared Interner. Iterating sorts the rows and drops
+    duplicates (without hashing the records), then yields each distinct record once.
+    len is the number of records added, duplicates included.
+    '''
+    # (field, array typecode, name of the Interner the ids come from or a function to decode the stored value)
+    Fields = ()
+    Record = None
+
+    def __init__(self, interners):
+        self.interners = interners
+        self.columns = [array.array(typecode) for (_, typecode, _) in self.Fields]
+        self.count = 0
+        self.unique_rows = 0
+
+    def add(self, record):
+        for column, (field, _, decode) in zip(self.columns, self.Fields):
+            value = getattr(record, field)
+            column.append(self.interners[decode](value) if isinstance(decode, str) else value)
+        self.count += 1
+
+    def update(self, other):
+        remaps = { name: [self.interners[name](value) for value in interner.values] for name, interner in other.interners.items() }
+        for column, other_column, (_, typecode, decode) in zip(self.columns, other.columns, self.Fields):
+            if isinstance(decode, str):
+                remap = remaps[decode]
+                column.extend(array.array(typecode, (remap[i] for i in other_column)))
+            else:
+                column.extend(other_column)
+        self.count += other.count
+
+    # so RecordColumns can stand in for a set or a list
+    append = add
+    extend = update
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        if self.unique_rows != len(self.columns[0]):
+            self.columns = SortUnique(self.columns)
+            self.unique_rows = len(self.columns[0])
+        decoders = [self.interners[decode].__getitem__ if isinstance(decode, str) else decode for (_, _, decode) in self.Fields]
+        fields = [field for (field, _, _) in self.Fields]
+        for row in zip(*self.columns):
+            yield self.Record(**{ field: decode(value) for field, decode, value in zip(fields, decoders, row) })
+
+class PendingTaintFlowColumns(RecordColumns):
+    Fields = (
+        ('SourceThread', 'I', 'threads'),
+        ('SourceInstructionCount', 'Q', int),
+        ('SourcePc', 'Q', int),
+        ('SinkThread', 'I', 'threads'),
+        ('SinkInstructionCount', 'Q', int),
+        ('SinkPc', 'Q', int),
+        ('IsStore', 'B', bool),
+    )
+    Record = PendingTaintFlow
+
+class SyscallColumns(RecordColumns):
+    Fields = (
+        ('Thread', 'I', 'threads'),
+        ('InstructionCount', 'Q', int),
+        ('Pc', 'Q', int),
+        ('Name', 'I', 'names'),
+        ('Arguments', 'I', 'arguments'),
+    )
+    Record = CollectedSyscall
+
+class PlogCollector:
+    '''
+    Gathers everything the ingest needs from a single pass over a pandalog.
+
+    Why don't we just gather processes and threads on the fly?
+    Because there are multiple sources for this information
+    and they have to be reconciled.
+    It's oddly tricky to get a consistent view out of a replay
+    of the set of threads and processes and their names.
+    One could check at every basic block (by invoking Osi)
+    but that would be very slow.  So we check at a few std
+    temporal points (syscall, every 100 bb, asid_info logging points)
+    and reconcile.
+    Better would be if we had callback on after-scheduler-changes-proc
+     s.t. we could obtain proc/thread.
+
+    Syscalls only need thread identity, which is known from the message itself,
+    so they are collected directly (or handed to syscall_sink as they are read,
+    if one is set, each once like CollectedSyscalls keeps them).
+
+    Syscalls and buffered flows are by far the most numerous records, they are kept
+    in RecordColumns (or SpillSets) rather than sets and lists of namedtuples. A taint flow needs the mapping covering its
+    source and sink pc, and a mapping's instruction range isn't final until
+    the whole plog has been read, so flows are buffered as PendingTaintFlows
+    and resolved by IterResolvedTaintFlows once the pass is over.
+    '''
+    # handled by the CollectFrom_<type> method of the same name
+    MessageTypes = ('asid_libraries', 'asid_info', 'taint_flow', 'syscall')
+
+    def __init__(self, spill=None):
+        # With spill, a (directory, budget) pair, the syscalls and buffered taint flows are
+        # SpillSets each holding at most half the budget in memory.
+        # thread is (pid, ppid, tid, create_time)
+        # process is (pid, ppid)
+        self.processes = set()
+        self.threads = set()
+        self.thread_names = {}
+        self.thread_slices = set()
+        self.CollectedBetterMappingRanges = {}
+        if spill is not None:
+            directory, budget = spill
+            self.CollectedSyscalls = SpillSet(directory, budget // 2, PackSyscall, UnpackSyscall)
+            self.PendingTaintFlows = SpillSet(directory, budget // 2, PackPendingTaintFlow, UnpackPendingTaintFlow)
+        else:
+            threads = Interner()
+            self.CollectedSyscalls = SyscallColumns({ 'threads': threads, 'names': Interner(), 'arguments': Interner() })
+            self.PendingTaintFlows = PendingTaintFlowColumns({ 'threads': threads })
+        self.syscall_sink = None
+        # the syscalls handed to syscall_sink at the last instruction count read
+        self.SinkInstr = None
+        self.SinkSyscalls = set()
+        # when set, the processes whose mappings were added to or changed are added to it
+        self.ChangedProcesses = None
+        self.num_no_mappings = 0
+        self.message_count = 0
+        self.byte_count = 0
+        self.AttemptCounts = { k: 0 for k in self.MessageTypes }
+        self.FailCounts = { k: 0 for k in self.MessageTypes }
+
+    def add_process(self, process):
+        self.processes.add(process)
+        if process not in self.CollectedBetterMappingRanges:
+            self.CollectedBetterMappingRanges[process] = {}
+            if self.ChangedProcesses is not None:
+                self.ChangedProcesses.add(process)
+        return process
+
+    def add_thread(self, thread):
+        self.threads.add(thread)
+        return self.add_process(CollectedProcess(ProcessId=thread.ProcessId, ParentProcessId=thread.ParentProcessId))
+
+    def CollectFrom_asid_libraries(self, entry, msg):
         thread = CollectedThread(ProcessId=msg.pid, ParentProcessId=msg.ppid, ThreadId=msg.tid, CreateTime=msg.create_time)
         # there might be several names for a tid
-        if thread in thread_names.keys():
-            thread_names[thread].add(msg.proc_name)
+        if thread in self.thread_names.keys():
+            self.thread_names[thread].add(msg.proc_name)
         else:
-            thread_names[thread] = set([msg.proc_name])
-        threads.add(thread)
-        processes.add(CollectedProcess(ProcessId=msg.pid, ParentProcessId=msg.ppid))
-    def CollectFrom_asid_info(msg):
+            self.thread_names[thread] = set([msg.proc_name])
+        process = self.add_thread(thread)
+
+        if (msg.pid == 0) or (msg.ppid == 0) or (msg.tid == 0):
+            self.num_no_mappings += 1
+            return
+        # mappings in this plog entry
+        ranges = self.CollectedBetterMappingRanges[process]
+        if self.ChangedProcesses is not None and msg.modules:
+            self.ChangedProcesses.add(process)
+        for mapping in msg.modules:
+            better_mapping = BetterCollectedMapping(AddressSpaceId=entry.asid, Name=mapping.name, File=mapping.file, BaseAddress=mapping.base_addr, Size=mapping.size, Process=process)
+            if better_mapping in ranges.keys():
+                FirstInstructionCount, LastInstructionCount = ranges[better_mapping]
+                if entry.instr < FirstInstructionCount:
+                    ranges[better_mapping] = (entry.instr, LastInstructionCount)
+                elif entry.instr > LastInstructionCount:
+                    ranges[better_mapping] = (FirstInstructionCount, entry.instr)
+            else:
+                ranges[better_mapping] = (entry.instr, entry.instr)
+
+    def CollectFrom_asid_info(self, entry, msg):
         for tid in msg.tids:
             thread = CollectedThread(ProcessId=msg.pid, ParentProcessId=msg.ppid, ThreadId=tid, CreateTime=msg.create_time)
-            if thread in thread_names.keys():
+            if thread in self.thread_names.keys():
                 for name in msg.names:
-                    thread_names[thread].add(name)
+                    self.thread_names[thread].add(name)
             else:
-                thread_names[thread] = set(msg.names)
-            threads.add(thread)
-            thread_slices.add(CollectedThreadSlice(FirstInstructionCount=msg.start_instr, LastInstructionCount=msg.end_instr, Thread=thread))
-        processes.add(CollectedProcess(ProcessId=msg.pid, ParentProcessId=msg.ppid))
-    def CollectFrom_taint_flow(msg):
+                self.thread_names[thread] = set(msg.names)
+            self.add_thread(thread)
+            self.thread_slices.add(CollectedThreadSlice(FirstInstructionCount=msg.start_instr, LastInstructionCount=msg.end_instr, Thread=thread))
+        self.add_process(CollectedProcess(ProcessId=msg.pid, ParentProcessId=msg.ppid))
+
+    def CollectFrom_taint_flow(self, entry, msg):
         source_thread = msg.source.cp.thread
-        threads.add(CollectedThread(ProcessId=source_thread.pid, ParentProcessId=source_thread.ppid, ThreadId=source_thread.tid, CreateTime=source_thread.create_time))
-        processes.add(CollectedProcess(ProcessId=source_thread.pid, ParentProcessId=source_thread.ppid))
+        source_thread = CollectedThread(ProcessId=source_thread.pid, ParentProcessId=source_thread.ppid, ThreadId=source_thread.tid, CreateTime=source_thread.create_time)
+        self.add_thread(source_thread)
         sink_thread = msg.sink.cp.thread
-        threads.add(CollectedThread(ProcessId=sink_thread.pid, ParentProcessId=sink_thread.ppid, ThreadId=sink_thread.tid, CreateTime=sink_thread.create_time))
-        processes.add(CollectedProcess(ProcessId=sink_thread.pid, ParentProcessId=sink_thread.ppid))
-    def CollectFrom_syscall(msg):
-        threads.add(CollectedThread(ProcessId=msg.pid, ParentProcessId=msg.ppid, ThreadId=msg.tid, CreateTime=msg.create_time))
-        processes.add(CollectedProcess(ProcessId=msg.pid, ParentProcessId=msg.ppid))
-
-    CollectFrom = {
-        'asid_libraries': CollectFrom_asid_libraries,
-        'asid_info': CollectFrom_asid_info,
-        'taint_flow': CollectFrom_taint_flow,
-        'syscall': CollectFrom_syscall,
-    }
+        sink_thread = CollectedThread(ProcessId=sink_thread.pid, ParentProcessId=sink_thread.ppid, ThreadId=sink_thread.tid, CreateTime=sink_thread.create_time)
+        self.add_thread(sink_thread)
+        self.PendingTaintFlows.append(PendingTaintFlow(
+            IsStore=msg.source.is_store,
+            SourceThread=source_thread, SourcePc=msg.source.cp.pc, SourceInstructionCount=msg.source.instr,
+            SinkThread=sink_thread, SinkPc=msg.sink.cp.pc, SinkInstructionCount=msg.sink.instr
+        ))
 
-    AttemptCounts = { k: 0 for k in CollectFrom.keys() }
-    FailCounts = { k: 0 for k in CollectFrom.keys() }
+    def CollectFrom_syscall(self, entry, msg):
+        thread = CollectedThread(ProcessId=msg.pid, ParentProcessId=msg.ppid, ThreadId=msg.tid, CreateTime=msg.create_time)
+        self.add_thread(thread)
+        syscall = CollectedSyscall(
+            Name=msg.call_name,
+            Thread=thread,
+            InstructionCount=entry.instr,
+            Pc=entry.pc,
+            Arguments=syscall_arg_values(msg.args)
+        )
+        if self.syscall_sink is not None:
+            # Identical syscalls have the same instruction count and the log is in instruction
+            # count order, so only the ones at the current instruction count can repeat
+            if entry.instr != self.SinkInstr:
+                self.SinkInstr = entry.instr
+                self.SinkSyscalls = set()
+            if syscall in self.SinkSyscalls:
+                return
+            self.SinkSyscalls.add(syscall)
+            self.syscall_sink(syscall)
+        else:
+            self.CollectedSyscalls.add(syscall)
+
+    def collect(self, msg):
+        self.message_count += 1
+        for k in self.MessageTypes:
+            if hasfield(msg, k):
+                self.AttemptCounts[k] += 1
+                try:
+                    getattr(self, 'CollectFrom_' + k)(msg, getattr(msg, k))
+                except:
+                    self.FailCounts[k] += 1
+                break
+
+    def merge(self, other, records=True):
+        # Fold in a collector that read a later part of the plog. Merging in plog
+        # order gives the same result as one collector reading the whole plog.
+        # Without records the other collector's syscalls and buffered flows are left out.
+        self.processes |= other.processes
+        self.threads |= other.threads
+        for thread, names in other.thread_names.items():
+            self.thread_names.setdefault(thread, set()).update(names)
+        self.thread_slices |= other.thread_slices
+        for process, ranges in other.CollectedBetterMappingRanges.items():
+            merged = self.CollectedBetterMappingRanges.setdefault(process, {})
+            for mapping, (FirstInstructionCount, LastInstructionCount) in ranges.items():
+                if mapping in merged:
+                    MergedFirst, MergedLast = merged[mapping]
+                    merged[mapping] = (min(MergedFirst, FirstInstructionCount), max(MergedLast, LastInstructionCount))
+                else:
+                    merged[mapping] = (FirstInstructionCount, LastInstructionCount)
+        if records:
+            self.CollectedSyscalls.update(other.CollectedSyscalls)
+            self.PendingTaintFlows.extend(other.PendingTaintFlows)
+        self.num_no_mappings += other.num_no_mappings
+        self.message_count += other.message_count
+        for k in self.MessageTypes:
+            self.AttemptCounts[k] += other.AttemptCounts[k]
+            self.FailCounts[k] += other.FailCounts[k]
+
+    def report(self):
+        print('Read {} messages ({} bytes)'.format(self.message_count, self.byte_count))
+        print('Gathered {} Processes and {} Threads ({} asid_libraries without mapping)'.format(len(self.processes), len(self.threads), self.num_no_mappings))
+        for k in self.MessageTypes:
+            print('\t{} Attempts: {}, Failures: {}'.format(k, self.AttemptCounts[k], self.FailCounts[k]))
+        print('CollectedBetterMappingRanges Len {}'.format(sum(len(procmaps.keys()) for procmaps in self.CollectedBetterMappingRanges.values())))
+        print('Buffered {} Taint Flows for mapping resolution'.format(len(self.PendingTaintFlows)))
+
+def CollectPlog(pandalog, collector=None):
+    # Single pass over the plog. Everything that can't be resolved until
+    # the pass is over is buffered in the collector.
+    if collector is None:
+        collector = PlogCollector()
     with PLogReader(pandalog) as plr:
         for msg in plr:
-            for k in CollectFrom.keys():
-                if hasfield(msg, k):
-                    AttemptCounts[k] += 1
-                    try:
-                        CollectFrom[k](getattr(msg, k))
-                    except:
-                        FailCounts[k] += 1
-                        pass
-                    break
-    print('Gathered {} Processes and {} Threads'.format(len(processes), len(threads)))
-    for k in CollectFrom.keys():
-        print('\t{} Attempts: {}, Failures: {}'.format(k, AttemptCounts[k], FailCounts[k]))
-    return processes, threads, thread_names, thread_slices
+            collector.collect(msg)
+    collector.byte_count = os.path.getsize(pandalog)
+    collector.report()
+    return collector
 
 def AssociateThreadsAndProcesses(processes, threads, thread_names):
     # associate threads and procs
@@ -140,282 +580,707 @@ def AssociateThreadsAndProcesses(processes, threads, thread_names):
 
     return proc2threads, thread2proc
 
-def CollectProcessMemoryMappings(pandalog, processes):
-    # 2nd pass over plog 
-    # 
-    # This time to get mappings for processes 
+PlogChunk = collections.namedtuple('PlogChunk', ['Position', 'End'])
 
-    CollectedBetterMappings = set()
-    CollectedBetterMappingRanges = { proc: { } for proc in processes }
+def ReadPlogChunkDirectory(pandalog):
+    # A pandalog is a header (uint32 version, uint64 dir_pos, uint32 chunk_size, with padding)
+    # followed by zlib compressed chunks. The directory at dir_pos is a uint32 chunk count and
+    # then (uint64 instr, uint64 pos, uint64 num_entries) per chunk. A chunk ends where the
+    # next one (or the directory) starts.
+    with open(pandalog, 'rb') as f:
+        _, _, dir_pos, _, _ = struct.unpack('<IIQII', f.read(24))
+        f.seek(dir_pos)
+        nchunks, = struct.unpack('<I', f.read(4))
+        positions = [struct.unpack('<QQQ', f.read(24))[1] for _ in range(nchunks)]
+    return [PlogChunk(Position=pos, End=end) for pos, end in zip(positions, positions[1:] + [dir_pos])]
 
-    num_no_mappings = 0
-    def CollectFrom_asid_libraries(entry, msg):
-        nonlocal num_no_mappings
-        if (msg.pid == 0) or (msg.ppid == 0) or (msg.tid == 0):
-            num_no_mappings += 1
-            return
-        thread = CollectedThread(ProcessId=msg.pid, ParentProcessId=msg.ppid, ThreadId=msg.tid, CreateTime=msg.create_time)
-        process = CollectedProcess(ProcessId=msg.pid, ParentProcessId=msg.ppid)
-        # mappings in this plog entry
-        for mapping in msg.modules:
-            better_mapping = BetterCollectedMapping(AddressSpaceId=entry.asid, Name=mapping.name, File=mapping.file, BaseAddress=mapping.base_addr, Size=mapping.size, Process=process)
-            CollectedBetterMappings.add(better_mapping)
-            if better_mapping in CollectedBetterMappingRanges[process].keys():
-                FirstInstructionCount, LastInstructionCount = CollectedBetterMappingRanges[process][better_mapping]
-                if entry.instr < FirstInstructionCount:
-                    CollectedBetterMappingRanges[process][better_mapping] = (entry.instr, LastInstructionCount)
-                elif entry.instr > LastInstructionCount:
-                    CollectedBetterMappingRanges[process][better_mapping] = (FirstInstructionCount, entry.instr)
-            else:
-                CollectedBetterMappingRanges[process][better_mapping] = (entry.instr, entry.instr)
+def DecodePlogChunkData(data):
+    # Inside a decompressed chunk every LogEntry is prefixed with its uint32 size
+    import plog_pb2
+    i = 0
+    while i < len(data):
+        entry_size, = struct.unpack_from('<I', data, i)
+        i += 4
+        msg = plog_pb2.LogEntry()
+        msg.ParseFromString(data[i:i + entry_size])
+        i += entry_size
+        yield msg
 
-    CollectFrom = {
-        'asid_libraries': CollectFrom_asid_libraries,
-    }
-    AttemptCounts = { k: 0 for k in CollectFrom.keys() }
-    FailCounts = { k: 0 for k in CollectFrom.keys() }
-    with PLogReader(pandalog) as plr:
-        for msg in plr:
-            for k in CollectFrom.keys():
-                if hasfield(msg, k):
-                    AttemptCounts[k] += 1
-                    try:
-                        CollectFrom[k](msg, getattr(msg, k))
-                    except:
-                        FailCounts[k] += 1
-                        pass
-                    break
-    print('Processed {} messages ({} without mapping)'.format(sum(AttemptCounts[k] for k in AttemptCounts.keys()), num_no_mappings))
-    for k in CollectFrom.keys():
-        print('\t{} Attempts: {}, Failures: {}'.format(k, AttemptCounts[k], FailCounts[k]))
-    print('CollectedBetterMappingRanges Len {}'.format(sum(len(procmaps.keys()) for procmaps in CollectedBetterMappingRanges.values())))
-    return CollectedBetterMappingRanges
-
-def ConvertTaintFlowsAndSyscallsToDatabase(datastore, CollectedSyscalls, CollectedTaintFlows, CollectedCodePoints, processes, CollectedThreadToDatabaseThread, CollectedMappingToDatabaseMapping):
-    CollectedCodePointToDatabaseCodePoint = {}
-    CollectedSyscallToDatabaseSyscall = {}
-    for s in CollectedSyscalls:
-        args = []
-        for a in s.Arguments:
-            args.append({'type': a.Type, 'value': a.Value})
-        CollectedSyscallToDatabaseSyscall[s] = datastore.add(CollectedThreadToDatabaseThread[s.Thread], s.Name, args, s.InstructionCount)
-
-
-    for tf in CollectedTaintFlows:
-        src_thread = CollectedThreadToDatabaseThread[tf.SourceThread]
-        src_mapping = CollectedMappingToDatabaseMapping[tf.SourceCodePoint.Mapping]
-
-        sink_thread = CollectedThreadToDatabaseThread[tf.SinkThread]
-        sink_mapping = CollectedMappingToDatabaseMapping[tf.SinkCodePoint.Mapping]
-
-        CollectedCodePointToDatabaseCodePoint[tf] = datastore.new_taintflow(tf.IsStore, src_thread, src_mapping, tf.SourceCodePoint.Offset, tf.SourceInstructionCount, sink_thread, sink_mapping, tf.SinkCodePoint.Offset, tf.SinkInstructionCount)
-
-
-def CollectTaintFlowsAndSyscalls(pandalog, CollectedBetterMappingRanges):
-    CollectedCodePoints = set()
-    CollectedSyscalls = set()
-    CollectedTaintFlows = set()
-    # DuplicateTaintFlows = {}
-    NoMappingCount = {
-        'Source': 0,
-        'Sink': 0,
-    }
-    def CollectFrom_syscall(entry, msg):
-        args = []
-        SyscallFieldInfo = {
-            'str': ('string',      '{:s}'),
-            'ptr': ('pointer',     '{:x}'),
-            'u64': ('unsigned64', '{:d}'),
-            'u32': ('unsigned32', '{:d}'),
-            'u16': ('unsigned16', '{:d}'),
-            'i64': ('signed64',   '{:d}'),
-            'i32': ('signed32',   '{:d}'),
-            'i16': ('signed16',   '{:d}'),
-        }
-        def syscall_arg_value(arg):
-            for fld, (typ, fmt) in SyscallFieldInfo.items():
-                if arg.HasField(fld):
-                    return typ, fmt.format(getattr(arg, fld))
-            assert(False)
-        thread = CollectedThread(ProcessId=msg.pid, ParentProcessId=msg.ppid, ThreadId=msg.tid, CreateTime=msg.create_time)
-        CollectedSyscalls.add(CollectedSyscall(
-            Name=msg.call_name,
-            Thread=thread,
-            InstructionCount=entry.instr,
-            Arguments=[
-                CollectedSyscallArgument(*syscall_arg_value(arg))
-                for arg in msg.args
-            ]
-        ))
-        return
-    def CollectFrom_taint_flow(entry, msg):
-        source_thread = msg.source.cp.thread
-        source_process = CollectedProcess(ProcessId=source_thread.pid, ParentProcessId=source_thread.ppid)
-        source_thread = CollectedThread(ProcessId=source_thread.pid, ParentProcessId=source_thread.ppid, ThreadId=source_thread.tid, CreateTime=source_thread.create_time)
-        sink_thread = msg.sink.cp.thread
-        sink_process = CollectedProcess(ProcessId=sink_thread.pid, ParentProcessId=sink_thread.ppid)
-        sink_thread = CollectedThread(ProcessId=sink_thread.pid, ParentProcessId=sink_thread.ppid, ThreadId=sink_thread.tid, CreateTime=sink_thread.create_time)
+def DecodePlogChunks(pandalog, chunks):
+    with open(pandalog, 'rb') as f:
+        for chunk in chunks:
+            f.seek(chunk.Position)
+            yield from DecodePlogChunkData(zlib.decompress(f.read(chunk.End - chunk.Position)))
 
-        # REQUIRES: CollectedBetterMappingRanges[{source,sink}_process].items() is sorted by ascending FirstInstructionCount
-        sink_mapping_slice, sink_mapping, sink_offset = None, None, None
-        for mapping, (FirstInstructionCount, LastInstructionCount) in CollectedBetterMappingRanges[sink_process].items():
-            if (FirstInstructionCount <= msg.sink.instr) and (LastInstructionCount >= msg.sink.instr):
-                if (msg.sink.cp.pc >= mapping.BaseAddress) and (msg.sink.cp.pc <= (mapping.BaseAddress + mapping.Size - 1)):
-                    sink_mapping_slice = (FirstInstructionCount, LastInstructionCount)
-                    sink_mapping = mapping
-                    sink_offset = msg.sink.cp.pc - mapping.BaseAddress
-            else:
-                if not (sink_mapping is None):
-                    break
-
-        source_mapping_slice, source_mapping, source_offset = None, None, None
-        for mapping, (FirstInstructionCount, LastInstructionCount) in CollectedBetterMappingRanges[source_process].items():
-            if (FirstInstructionCount <= msg.source.instr) and (LastInstructionCount >= msg.source.instr):
-                if (msg.source.cp.pc >= mapping.BaseAddress) and (msg.source.cp.pc <= (mapping.BaseAddress + mapping.Size - 1)):
-                    source_mapping_slice = (FirstInstructionCount, LastInstructionCount)
-                    source_mapping = mapping
-                    source_offset = msg.source.cp.pc - mapping.BaseAddress
+PlogHeaderSize = 24
+
+def FollowPlogChunks(pandalog, poll_interval=1.0, read_size=1 << 20):
+    # Yields the decompressed data of each chunk of a plog that is still being written,
+    # as soon as the whole chunk is there. The chunk directory is only written when
+    # the log is closed, so chunks are found by decompressing from the end of the
+    # previous one: each is a complete zlib stream. Returns once the directory shows
+    # up right after the last chunk.
+    position = PlogHeaderSize
+    with open(pandalog, 'rb') as f:
+        while True:
+            f.seek(0)
+            _, _, dir_pos, _, _ = struct.unpack('<IIQII', f.read(PlogHeaderSize))
+            if dir_pos != 0 and position >= dir_pos:
+                return
+
+            f.seek(position)
+            decompressor = zlib.decompressobj()
+            parts = []
+            consumed = 0
+            try:
+                while not decompressor.eof:
+                    data = f.read(read_size)
+                    if not data:
+                        break
+                    parts.append(decompressor.decompress(data))
+                    consumed += len(data)
+            except zlib.error:
+                # the directory, written before the header points at it
+                pass
+            if decompressor.eof:
+                position += consumed - len(decompressor.unused_data)
+                yield b''.join(parts)
             else:
-                if not (source_mapping is None):
-                    break
-        if sink_mapping is None:
-            NoMappingCount['Sink'] += 1
-        if source_mapping is None:
-            NoMappingCount['Source'] += 1
-        if (sink_mapping is None) or (source_mapping is None):
-            return
+                time.sleep(poll_interval)
 
-        SourceCodePoint = CollectedCodePoint(Mapping=source_mapping, Offset=source_offset)
-        SinkCodePoint = CollectedCodePoint(Mapping=sink_mapping, Offset=sink_offset)
-        CollectedCodePoints.add(SourceCodePoint)
-        CollectedCodePoints.add(SinkCodePoint)
-        flow = CollectedTaintFlow(
-            IsStore=msg.source.is_store,
-            SourceCodePoint=SourceCodePoint, SourceThread=source_thread, SourceInstructionCount=msg.source.instr,
-            SinkCodePoint=SinkCodePoint, SinkThread=sink_thread, SinkInstructionCount=msg.sink.instr
+def CollectPlogChunks(pandalog, chunks, spill=None):
+    # Worker side of CollectPlogParallel
+    collector = PlogCollector(spill)
+    for msg in DecodePlogChunks(pandalog, chunks):
+        collector.collect(msg)
+    return collector
+
+def CollectPlogParallel(pandalog, jobs, spill=None):
+    # Decode contiguous runs of chunks in worker processes and merge the
+    # collectors back in plog order, so the result doesn't depend on which
+    # worker finishes first. A few runs per worker keeps them all busy.
+    chunks = ReadPlogChunkDirectory(pandalog)
+    runs = max(1, min(len(chunks), jobs * 4))
+    bounds = [len(chunks) * i // runs for i in range(runs + 1)]
+    collector = PlogCollector(spill)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        for partial in executor.map(CollectPlogChunks, itertools.repeat(pandalog), [chunks[bounds[i]:bounds[i + 1]] for i in range(runs)], itertools.repeat(spill)):
+            collector.merge(partial)
+    collector.byte_count = os.path.getsize(pandalog)
+    collector.report()
+    return collector
+
+def SyscallRow(s, CollectedThreadToDatabaseThread):
+    # Arguments to datastore.new_syscall for a CollectedSyscall
+    return (CollectedThreadToDatabaseThread[s.Thread], s.Name, None, [{'type': a.Type, 'value': a.Value} for a in s.Arguments], s.InstructionCount, s.Pc)
+
+def TaintFlowRow(tf, CollectedThreadToDatabaseThread, CollectedMappingToDatabaseMapping):
+    # Arguments to datastore.new_taintflow for a CollectedTaintFlow
+    return (tf.IsStore,
+        CollectedThreadToDatabaseThread[tf.SourceThread], CollectedMappingToDatabaseMapping[tf.SourceCodePoint.Mapping], tf.SourceCodePoint.Offset, tf.SourceInstructionCount,
+        CollectedThreadToDatabaseThread[tf.SinkThread], CollectedMappingToDatabaseMapping[tf.SinkCodePoint.Mapping], tf.SinkCodePoint.Offset, tf.SinkInstructionCount)
+
+def ConvertTaintFlowsAndSyscallsToDatabase(datastore, CollectedSyscalls, CollectedTaintFlows, processes, CollectedThreadToDatabaseThread, CollectedMappingToDatabaseMapping):
+    datastore.new_syscall_collection(SyscallRow(s, CollectedThreadToDatabaseThread) for s in CollectedSyscalls)
+
+    datastore.new_taintflow_collection(
+        TaintFlowRow(tf, CollectedThreadToDatabaseThread, CollectedMappingToDatabaseMapping)
+        for tf in CollectedTaintFlows
+    )
+
+def BuildMappingIndexes(CollectedBetterMappingRanges):
+    # One interval index per process, keyed on address range and instruction count range
+    return {
+        process: pandelephant.MappingIndex(
+            (mapping, mapping.BaseAddress, mapping.Size, FirstInstructionCount, LastInstructionCount)
+            for mapping, (FirstInstructionCount, LastInstructionCount) in ranges.items()
         )
-        # if flow in CollectedTaintFlows:
-        #     if flow in DuplicateTaintFlows.keys():
-        #         DuplicateTaintFlows[flow] += 1
-        #     else:
-        #         DuplicateTaintFlows[flow] = 2
-        CollectedTaintFlows.add(flow)
-        return
-    CollectFrom = {
-        'syscall': CollectFrom_syscall,
-        'taint_flow': CollectFrom_taint_flow,
+        for process, ranges in CollectedBetterMappingRanges.items()
     }
-    AttemptCounts = { k: 0 for k in CollectFrom.keys() }
-    FailCounts = { k: 0 for k in CollectFrom.keys() }
-    with PLogReader(pandalog) as plr:
-        for msg in plr:
-            for k in CollectFrom.keys():
-                if hasfield(msg, k):
-                    AttemptCounts[k] += 1
-                    try:
-                        CollectFrom[k](msg, getattr(msg, k))
-                    except Exception as e:
-                        FailCounts[k] += 1
-                    break
-    for k in CollectFrom.keys():
-        print('\t{} Attempts: {}, Failures: {}'.format(k, AttemptCounts[k], FailCounts[k]))
-    print('\tNoMappingCount = {}'.format(NoMappingCount))
-    # print('\tDuplicate Flows {}'.format(len(DuplicateTaintFlows.keys())))
-    # for flow, count in DuplicateTaintFlows.items():
-    #     print('\t\tFlow Duplicated {} times: {}'.format(count, flow))
-    #     if (flow.SourceCodePoint.Mapping.Name == 'toy_debug') and (flow.SinkCodePoint.Mapping.Name == 'toy_debug'):
-    #         print('\t\t\tGhidra Flow Info: {:08x} -> {:08x}'.format(0x00100000 + flow.SourceCodePoint.Offset, 0x00100000 + flow.SinkCodePoint.Offset))
-    return CollectedTaintFlows, CollectedSyscalls, CollectedCodePoints
-
-def ConvertProcessThreadsMappingsToDatabase(datastore, execution, processes, threads, CollectedBetterMappingRanges, thread_names, proc2threads, thread_slices):
+
+def ResolveCodePoints(MappingIndexes, processes, pcs, instrs):
+    # Resolve a chunk of (process, pc, instr) to (mapping, offset) with one batch lookup per process
+    by_process = {}
+    for i, process in enumerate(processes):
+        by_process.setdefault(process, []).append(i)
+    resolved = [None] * len(processes)
+    for process, idxs in by_process.items():
+        results = MappingIndexes[process].lookup_many([pcs[i] for i in idxs], [instrs[i] for i in idxs])
+        for i, result in zip(idxs, results):
+            resolved[i] = result
+    return resolved
+
+def IterResolvedTaintFlows(PendingTaintFlows, CollectedBetterMappingRanges, NoMappingCount, chunk_size=65536, Unresolved=None, MappingIndexes=None):
+    # Yields a list of CollectedTaintFlows per chunk of PendingTaintFlows. Flows whose source
+    # or sink isn't covered by any mapping are counted in NoMappingCount and dropped, or
+    # added to Unresolved if it's given. MappingIndexes, if given, are BuildMappingIndexes
+    # of CollectedBetterMappingRanges kept up to date by the caller.
+    if MappingIndexes is None:
+        MappingIndexes = BuildMappingIndexes(CollectedBetterMappingRanges)
+    PendingTaintFlows = iter(PendingTaintFlows)
+    while True:
+        chunk = list(itertools.islice(PendingTaintFlows, chunk_size))
+        if not chunk:
+            break
+        sources = ResolveCodePoints(MappingIndexes,
+            [CollectedProcess(ProcessId=pending.SourceThread.ProcessId, ParentProcessId=pending.SourceThread.ParentProcessId) for pending in chunk],
+            [pending.SourcePc for pending in chunk], [pending.SourceInstructionCount for pending in chunk])
+        sinks = ResolveCodePoints(MappingIndexes,
+            [CollectedProcess(ProcessId=pending.SinkThread.ProcessId, ParentProcessId=pending.SinkThread.ParentProcessId) for pending in chunk],
+            [pending.SinkPc for pending in chunk], [pending.SinkInstructionCount for pending in chunk])
+
+        resolved = []
+        for pending, source, sink in zip(chunk, sources, sinks):
+            if sink is None:
+                NoMappingCount['Sink'] += 1
+            if source is None:
+                NoMappingCount['Source'] += 1
+            if (sink is None) or (source is None):
+                if Unresolved is not None:
+                    Unresolved.append(pending)
+                continue
+
+            resolved.append(CollectedTaintFlow(
+                IsStore=pending.IsStore,
+                SourceCodePoint=CollectedCodePoint(Mapping=source[0], Offset=source[1]), SourceThread=pending.SourceThread, SourceInstructionCount=pending.SourceInstructionCount,
+                SinkCodePoint=CollectedCodePoint(Mapping=sink[0], Offset=sink[1]), SinkThread=pending.SinkThread, SinkInstructionCount=pending.SinkInstructionCount
+            ))
+        yield resolved
+
+def ConvertProcessThreadsMappingsToDatabase(datastore, execution, processes, threads, CollectedBetterMappingRanges, thread_names, proc2threads, thread2proc, thread_slices, registry=None):
     # construct db process, and for each,
-    # create associated threads and mappings and connect them up
-    CollectedProcessToDatabaseProcess = {}
-    CollectedThreadToDatabaseThread = {}
-    CollectedMappingToDatabaseMapping = {}
-    for p in processes:
+    # create associated threads and mappings and connect them up.
+    # Processes and threads a ThreadRegistry already wrote are reused.
+    CollectedProcessToDatabaseProcess = dict(registry.processes) if registry is not None else {}
+    CollectedThreadToDatabaseThread = dict(registry.threads) if registry is not None else {}
+
+    OrderedProcesses = list(processes)
+    NewProcesses = [p for p in OrderedProcesses if p not in CollectedProcessToDatabaseProcess]
+    ProcessCreateTimes = []
+    for p in NewProcesses:
         # Setting process create time to earliest thread. I think this is wrong.
         create_time = sys.maxsize
         for t in proc2threads[p]:
             if t.CreateTime < create_time:
                 create_time = t.CreateTime
-        process = datastore.new_process(execution, create_time, p.ProcessId, p.ParentProcessId)
-        CollectedProcessToDatabaseProcess[p] = process
+        ProcessCreateTimes.append((create_time, p.ProcessId, p.ParentProcessId))
+    CollectedProcessToDatabaseProcess.update(zip(NewProcesses, datastore.new_processes(execution, ProcessCreateTimes)))
 
-        for t in proc2threads[p]:
-            CollectedThreadToDatabaseThread[t] = datastore.new_thread(process, t.CreateTime, t.ThreadId, thread_names[t])
-        
-        for mapping, (FirstInstructionCount, LastInstructionCount) in CollectedBetterMappingRanges[p].items():
-            CollectedMappingToDatabaseMapping[mapping] = datastore.new_mapping(process, mapping.Name, mapping.File, mapping.AddressSpaceId, mapping.BaseAddress, FirstInstructionCount, mapping.Size, FirstInstructionCount, LastInstructionCount)
+    NewThreads = [t for p in OrderedProcesses for t in proc2threads[p] if t not in CollectedThreadToDatabaseThread]
+    CollectedThreadToDatabaseThread.update(zip(NewThreads, datastore.new_threads([
+        (CollectedProcessToDatabaseProcess[thread2proc[t]], t.CreateTime, t.ThreadId, thread_names[t]) for t in NewThreads
+    ])))
+
+    OrderedMappings = [(p, mapping, FirstInstructionCount, LastInstructionCount) for p in OrderedProcesses for mapping, (FirstInstructionCount, LastInstructionCount) in CollectedBetterMappingRanges[p].items()]
+    CollectedMappingToDatabaseMapping = dict(zip((mapping for (_, mapping, _, _) in OrderedMappings), datastore.new_mappings([
+        (CollectedProcessToDatabaseProcess[p], mapping.Name, mapping.File, mapping.AddressSpaceId, mapping.BaseAddress, FirstInstructionCount, mapping.Size, FirstInstructionCount, LastInstructionCount)
+        for (p, mapping, FirstInstructionCount, LastInstructionCount) in OrderedMappings
+    ])))
 
-    for thread_slice in thread_slices:
-        datastore.new_threadslice(CollectedThreadToDatabaseThread[thread_slice.Thread], thread_slice.FirstInstructionCount, end_execution_offset=thread_slice.LastInstructionCount)
+    datastore.new_threadslices([
+        (CollectedThreadToDatabaseThread[thread_slice.Thread], thread_slice.FirstInstructionCount, thread_slice.LastInstructionCount)
+        for thread_slice in thread_slices
+    ])
 
     return CollectedProcessToDatabaseProcess, CollectedThreadToDatabaseThread, CollectedMappingToDatabaseMapping
 
+class ThreadRegistry:
+    '''
+    Writes a process and thread to the database the first time a streamed row references
+    the thread, so syscalls can be written while the plog is still being read. Looking up
+    a CollectedThread returns its database Thread, like CollectedThreadToDatabaseThread.
+
+    A thread's names and its process's create time can change as more of the plog is read,
+    sync writes whatever turned up since the rows were created.
+    '''
+    def __init__(self, datastore, execution, collector):
+        self.datastore = datastore
+        self.execution = execution
+        self.collector = collector
+        self.processes = {}
+        self.threads = {}
+        self.written_names = {}
+        self.written_create_times = {}
+
+    def __getitem__(self, thread):
+        db_thread = self.threads.get(thread)
+        if db_thread is None:
+            process = CollectedProcess(ProcessId=thread.ProcessId, ParentProcessId=thread.ParentProcessId)
+            db_process = self.processes.get(process)
+            if db_process is None:
+                db_process = self.datastore.new_process(self.execution, thread.CreateTime, process.ProcessId, process.ParentProcessId)
+                self.processes[process] = db_process
+                self.written_create_times[process] = thread.CreateTime
+            names = set(self.collector.thread_names.get(thread, ()))
+            db_thread = self.datastore.new_thread(db_process, thread.CreateTime, thread.ThreadId, list(names))
+            self.threads[thread] = db_thread
+            self.written_names[thread] = names
+        return db_thread
+
+    def sync(self):
+        # Setting process create time to earliest thread, same as ConvertProcessThreadsMappingsToDatabase
+        create_times = {}
+        for thread in self.collector.threads:
+            process = CollectedProcess(ProcessId=thread.ProcessId, ParentProcessId=thread.ParentProcessId)
+            if process in self.processes:
+                create_times[process] = min(create_times.get(process, thread.CreateTime), thread.CreateTime)
+        with self.datastore.session_scope():
+            for process, create_time in create_times.items():
+                if create_time != self.written_create_times[process]:
+                    self.datastore.set_process_create_time(self.processes[process], create_time)
+                    self.written_create_times[process] = create_time
+            for thread, db_thread in self.threads.items():
+                names = self.collector.thread_names.get(thread, set()) - self.written_names[thread]
+                if names:
+                    self.datastore.add_thread_names(db_thread, list(names))
+                    self.written_names[thread] |= names
+
+class StageCounter:
+    # Throughput of one pipeline stage: work done, time spent on it and time spent blocked on the queue
+    def __init__(self, name):
+        self.name = name
+        self.batches = 0
+        self.rows = collections.Counter()
+        self.busy = 0.0
+        self.waiting = 0.0
+
+    def report(self):
+        rows = sum(self.rows.values())
+        print('\t{}: {} batches, {} rows ({}) in {:.2f} sec ({:.0f} rows/sec), {:.2f} sec waiting on the queue'.format(
+            self.name, self.batches, rows, ', '.join('{} {}'.format(k, v) for k, v in sorted(self.rows.items())),
+            self.busy, rows / self.busy if self.busy > 0 else 0, self.waiting))
+
+class IngestPipeline:
+    '''
+    Overlaps reading the plog with writing to the database.
+
+    The reading side adds rows with add, they are grouped into batches of batch_size and put on a
+    bounded queue. Writer threads take batches off the queue and write them with the datastore's
+    collection calls, each on its own pooled connection and in its own transactions. When the
+    writers fall behind the queue fills up and add blocks, so no more than queue_size batches
+    are waiting in memory at any time.
+    '''
+    # row kind -> datastore call that writes a batch of them
+    Writers = {
+        'syscalls': 'new_syscall_collection',
+        'taintflows': 'new_taintflow_collection',
+    }
+
+    def __init__(self, datastore, writers, batch_size=5000, queue_size=None):
+        self.datastore = datastore
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size if queue_size is not None else 2 * writers)
+        self.pending = { k: [] for k in self.Writers }
+        self.errors = []
+        self.reader = StageCounter('reader')
+        self.writer_counters = [StageCounter('writer {}'.format(i)) for i in range(writers)]
+        self.writer_threads = [threading.Thread(target=self.write_batches, args=(counter,), daemon=True) for counter in self.writer_counters]
+
+    def __enter__(self):
+        self.start_time = time.time()
+        for t in self.writer_threads:
+            t.start()
+        return self
+
+    def add(self, kind, row):
+        batch = self.pending[kind]
+        batch.append(row)
+        if len(batch) >= self.batch_size:
+            self.put(kind, batch)
+            self.pending[kind] = []
+
+    def put(self, kind, batch):
+        if self.errors:
+            raise self.errors[0]
+        t1 = time.time()
+        self.queue.put((kind, batch))
+        self.reader.waiting += time.time() - t1
+        self.reader.batches += 1
+        self.reader.rows[kind] += len(batch)
+
+    def flush(self):
+        for kind, batch in self.pending.items():
+            if batch:
+                self.put(kind, batch)
+            self.pending[kind] = []
+
+    def write_batches(self, counter):
+        while True:
+            t1 = time.time()
+            item = self.queue.get()
+            counter.waiting += time.time() - t1
+            if item is None:
+                return
+            kind, batch = item
+            if self.errors:
+                # keep draining so the reader doesn't block, it raises on its next put
+                continue
+            t2 = time.time()
+            try:
+                getattr(self.datastore, self.Writers[kind])(batch)
+            except Exception as e:
+                self.errors.append(e)
+                continue
+            counter.busy += time.time() - t2
+            counter.batches += 1
+            counter.rows[kind] += len(batch)
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            for _ in self.writer_threads:
+                self.queue.put(None)
+            for t in self.writer_threads:
+                t.join()
+        elapsed = time.time() - self.start_time
+        self.reader.busy = elapsed - self.reader.waiting
+        self.report(elapsed)
+        if exc_type is None and self.errors:
+            raise self.errors[0]
+
+    def report(self, elapsed):
+        print('Pipeline ran {:.2f} sec with {} writers:'.format(elapsed, len(self.writer_threads)))
+        self.reader.report()
+        for counter in self.writer_counters:
+            counter.report()
+
 def CreateExecutionIfNeeded(datastore, exec_name):
     matching_execution = datastore.get_execution_by_name(exec_name)
     if matching_execution is None:
         matching_execution = datastore.new_execution(exec_name)
     return matching_execution
 
-def plog_to_pe(pandalog,  db_url, exec_name):
+def CheckpointedIngest(datastore, execution, pandalog, batch_chunks, batch_flows=100000):
+    # Ingest in batches that are each committed together with a checkpoint, so running
+    # again after a crash carries on from the last committed batch without reading its
+    # chunks again or writing any row twice. The stages are
+    #   decode: read batch_chunks plog chunks at a time, write their syscalls (and the
+    #           processes and threads they reference) and keep their buffered taint flows
+    #           as checkpoint data. Identical syscalls have the same instruction count, so
+    #           the ones at the last instruction count of the previous batch are kept in the
+    #           checkpoint to deduplicate across batches the same as a batch ingest
+    #   flows:  everything else is written, resolve the buffered taint flows and write them
+    #           batch_flows at a time
+    #   done:   nothing left to do, running again is a no-op
+    source = os.path.basename(pandalog)
+    checkpoint = datastore.get_ingest_checkpoint(execution, source)
+    if checkpoint is None:
+        checkpoint = pandelephant.IngestCheckpoint(stage='decode', plog_chunk=0, syscalls=0, taint_flows=0, state=None)
+    elif checkpoint.stage == 'done':
+        print('{} is already ingested into {}'.format(source, execution.name()))
+        return
+    else:
+        print('Resuming {} at stage {}, plog chunk {} ({} Syscalls, {} Taint Flows committed)'.format(
+            source, checkpoint.stage, checkpoint.plog_chunk, checkpoint.syscalls, checkpoint.taint_flows))
+
+    if checkpoint.stage == 'decode':
+        collector = PlogCollector()
+        registry = ThreadRegistry(datastore, execution, collector)
+        LastSyscalls = set()
+        if checkpoint.state is not None:
+            collector, registry.processes, registry.threads, registry.written_names, registry.written_create_times, LastSyscalls = pickle.loads(checkpoint.state)
+            registry.collector = collector
+
+        chunks = ReadPlogChunkDirectory(pandalog)
+        print("Reading plog chunks {} - {} in batches of {}...".format(checkpoint.plog_chunk, len(chunks), batch_chunks))
+        while checkpoint.plog_chunk < len(chunks):
+            t1 = time.time()
+            end = min(len(chunks), checkpoint.plog_chunk + batch_chunks)
+            batch = CollectPlogChunks(pandalog, chunks[checkpoint.plog_chunk:end])
+            collector.merge(batch, records=False)
+            NewSyscalls = [syscall for syscall in batch.CollectedSyscalls if syscall not in LastSyscalls]
+            if NewSyscalls:
+                LastInstr = max(syscall.InstructionCount for syscall in NewSyscalls)
+                # a batch can start and end at the same instruction count as the previous one
+                if LastSyscalls and next(iter(LastSyscalls)).InstructionCount != LastInstr:
+                    LastSyscalls = set()
+                LastSyscalls |= set(syscall for syscall in NewSyscalls if syscall.InstructionCount == LastInstr)
+            with datastore.session_scope():
+                # rows are built first so the threads they reference are written before them
+                syscalls = [SyscallRow(syscall, registry) for syscall in NewSyscalls]
+                datastore.new_syscall_collection(syscalls)
+                if len(batch.PendingTaintFlows):
+                    datastore.add_ingest_checkpoint_data(execution, source, pickle.dumps(batch.PendingTaintFlows))
+                checkpoint = checkpoint._replace(plog_chunk=end, syscalls=checkpoint.syscalls + len(syscalls),
+                    state=pickle.dumps((collector, registry.processes, registry.threads, registry.written_names, registry.written_create_times, LastSyscalls)))
+                datastore.save_ingest_checkpoint(execution, source, checkpoint)
+            print('\tcommitted plog chunks up to {} ({} Syscalls, {} Taint Flows buffered) in {:.2f} sec'.format(end, len(syscalls), len(batch.PendingTaintFlows), time.time() - t1))
+        collector.report()
+
+        print('Associating Threads and Processes...')
+        proc2threads, thread2proc = AssociateThreadsAndProcesses(collector.processes, collector.threads, collector.thread_names)
+        print("Constructing db objects for thread, process, and mapping")
+        with datastore.session_scope():
+            registry.sync()
+            _, CollectedThreadToDatabaseThread, CollectedMappingToDatabaseMapping = ConvertProcessThreadsMappingsToDatabase(
+                datastore, execution, collector.processes, collector.threads, collector.CollectedBetterMappingRanges, collector.thread_names,
+                proc2threads, thread2proc, collector.thread_slices, registry=registry)
+            checkpoint = checkpoint._replace(stage='flows',
+                state=pickle.dumps((CollectedThreadToDatabaseThread, CollectedMappingToDatabaseMapping, collector.CollectedBetterMappingRanges)))
+            datastore.save_ingest_checkpoint(execution, source, checkpoint)
+
+    CollectedThreadToDatabaseThread, CollectedMappingToDatabaseMapping, CollectedBetterMappingRanges = pickle.loads(checkpoint.state)
+    PendingTaintFlows = PendingTaintFlowColumns({ 'threads': Interner() })
+    for data in datastore.iter_ingest_checkpoint_data(execution, source):
+        PendingTaintFlows.update(pickle.loads(data))
+
+    # Resolution order only depends on the buffered flows, so the flows committed
+    # before a crash are the first taint_flows ones again
+    print('Resolving {} buffered Taint Flows and writing them in batches of {}...'.format(len(PendingTaintFlows), batch_flows))
+    NoMappingCount = {
+        'Source': 0,
+        'Sink': 0,
+    }
+    flows = (TaintFlowRow(tf, CollectedThreadToDatabaseThread, CollectedMappingToDatabaseMapping)
+        for resolved in IterResolvedTaintFlows(PendingTaintFlows, CollectedBetterMappingRanges, NoMappingCount) for tf in resolved)
+    flows = itertools.islice(flows, checkpoint.taint_flows, None)
+    while True:
+        batch = list(itertools.islice(flows, batch_flows))
+        if not batch:
+            break
+        with datastore.session_scope():
+            datastore.new_taintflow_collection(batch)
+            checkpoint = checkpoint._replace(taint_flows=checkpoint.taint_flows + len(batch))
+            datastore.save_ingest_checkpoint(execution, source, checkpoint)
+        print('\tcommitted {} Taint Flows'.format(checkpoint.taint_flows))
+    print('\tNoMappingCount = {}'.format(NoMappingCount))
+
+    with datastore.session_scope():
+        datastore.delete_ingest_checkpoint_data(execution, source)
+        datastore.save_ingest_checkpoint(execution, source, checkpoint._replace(stage='done', state=None))
+
+def UniqueRecords(records, seen):
+    # The records not in seen, each once and in order. They are added to seen.
+    unique = []
+    for record in records:
+        if record not in seen:
+            seen.add(record)
+            unique.append(record)
+    return unique
+
+def FollowIngest(datastore, execution, pandalog, poll_interval=1.0):
+    # Ingest a plog that is still being written, committing each chunk as soon as it is
+    # complete so the execution can be queried while the log grows. Per chunk:
+    #  - processes and threads are written when first seen, names and create times
+    #    that turn up later are patched in by the ThreadRegistry
+    #  - new mappings are written and mappings seen again have their range extended
+    #  - new thread slices and the chunk's syscalls are written
+    #  - taint flows are resolved against the mappings known so far. Flows that don't
+    #    resolve yet are retried with every later chunk, a mapping seen again may cover
+    #    them then, and dropped when the log is closed.
+    # Syscalls and taint flows are deduplicated on the whole collected record, the same as a
+    # batch ingest. Identical records have the same instruction count and the log is in
+    # instruction count order, so only the ones at the last instruction count of the
+    # previous chunk are kept to check the next chunk against.
+    # Unlike a batch ingest, which resolves flows once every mapping range is final, a
+    # flow is resolved against the mappings as they are when its chunk arrives. Where
+    # mappings overlap, one seen later can make a batch ingest pick a different mapping.
+    collector = PlogCollector()
+    collector.ChangedProcesses = set()
+    registry = ThreadRegistry(datastore, execution, collector)
+    syscalls = []
+    collector.syscall_sink = syscalls.append
+    WrittenMappings = {}
+    MappingRows = {}
+    MappingIndexes = {}
+    WrittenSlices = set()
+    Unresolved = []
+    # the records logged at LastInstr, the last instruction count of the previous chunk
+    LastInstr = None
+    LastSyscalls = set()
+    LastFlows = set()
+    NoMappingCount = {
+        'Source': 0,
+        'Sink': 0,
+    }
+    SyscallCount = 0
+    TaintFlowCount = 0
+
+    print('Following {} (chunks are written as they complete, until the log is closed)...'.format(pandalog))
+    for data in FollowPlogChunks(pandalog, poll_interval):
+        t1 = time.time()
+        flows = collector.PendingTaintFlows = []
+        SeenSyscalls, SeenFlows = set(LastSyscalls), set(LastFlows)
+        # where the records logged at the chunk's last instruction count start, 0 while
+        # it is still the previous chunk's
+        FirstSyscallAtLast = FirstFlowAtLast = 0
+        for msg in DecodePlogChunkData(data):
+            if msg.instr != LastInstr:
+                LastInstr = msg.instr
+                FirstSyscallAtLast, FirstFlowAtLast = len(syscalls), len(flows)
+                LastSyscalls, LastFlows = set(), set()
+            collector.collect(msg)
+        NewSyscalls = UniqueRecords(syscalls, SeenSyscalls)
+        Pending = UniqueRecords(flows, SeenFlows) + Unresolved
+        LastSyscalls.update(syscalls[FirstSyscallAtLast:])
+        LastFlows.update(flows[FirstFlowAtLast:])
+        syscalls.clear()
+
+        with datastore.session_scope():
+            # every thread seen so far, not only the ones syscalls reference
+            for thread in collector.threads:
+                registry[thread]
+            registry.sync()
+
+            # only the processes whose mappings changed in this chunk have to be looked at
+            NewMappings = []
+            ExtendedMappings = []
+            for process in collector.ChangedProcesses:
+                ranges = collector.CollectedBetterMappingRanges[process]
+                for mapping, (FirstInstructionCount, LastInstructionCount) in ranges.items():
+                    written = WrittenMappings.get(mapping)
+                    if written is None:
+                        NewMappings.append((process, mapping, FirstInstructionCount, LastInstructionCount))
+                    elif written != (FirstInstructionCount, LastInstructionCount):
+                        ExtendedMappings.append((mapping, FirstInstructionCount, LastInstructionCount))
+                MappingIndexes.update(BuildMappingIndexes({ process: ranges }))
+            collector.ChangedProcesses.clear()
+            for (process, mapping, FirstInstructionCount, LastInstructionCount), db_mapping in zip(NewMappings, datastore.new_mappings([
+                (registry.processes[process], mapping.Name, mapping.File, mapping.AddressSpaceId, mapping.BaseAddress, FirstInstructionCount, mapping.Size, FirstInstructionCount, LastInstructionCount)
+                for (process, mapping, FirstInstructionCount, LastInstructionCount) in NewMappings
+            ])):
+                MappingRows[mapping] = db_mapping
+                WrittenMappings[mapping] = (FirstInstructionCount, LastInstructionCount)
+            datastore.extend_mappings([(MappingRows[mapping], FirstInstructionCount, LastInstructionCount) for (mapping, FirstInstructionCount, LastInstructionCount) in ExtendedMappings])
+            for (mapping, FirstInstructionCount, LastInstructionCount) in ExtendedMappings:
+                WrittenMappings[mapping] = (FirstInstructionCount, LastInstructionCount)
+
+            NewSlices = collector.thread_slices - WrittenSlices
+            datastore.new_threadslices([
+                (registry[thread_slice.Thread], thread_slice.FirstInstructionCount, thread_slice.LastInstructionCount)
+                for thread_slice in NewSlices
+            ])
+            WrittenSlices |= NewSlices
+
+            datastore.new_syscall_collection([SyscallRow(syscall, registry) for syscall in NewSyscalls])
+            SyscallCount += len(NewSyscalls)
+
+            Unresolved = []
+            rows = [TaintFlowRow(tf, registry, MappingRows)
+                for resolved in IterResolvedTaintFlows(Pending, collector.CollectedBetterMappingRanges, NoMappingCount, Unresolved=Unresolved, MappingIndexes=MappingIndexes) for tf in resolved]
+            datastore.new_taintflow_collection(rows)
+            TaintFlowCount += len(rows)
+        print('\tchunk: {} messages, {} new mappings, {} extended, {} Syscalls and {} Taint Flows written ({} waiting for a mapping) in {:.2f} sec'.format(
+            collector.message_count, len(NewMappings), len(ExtendedMappings), SyscallCount, TaintFlowCount, len(Unresolved), time.time() - t1))
+
+    # Retried flows were counted each time they didn't resolve, only the ones left at the end are really missing
+    print('Log closed, {} Syscalls and {} Taint Flows written, {} Taint Flows never resolved'.format(SyscallCount, TaintFlowCount, len(Unresolved)))
+    collector.report()
+
+def plog_to_pe(pandalog,  db_url, exec_name, defer_indexes=False, jobs=1, writers=0, memory_budget=None, spill_dir=None, checkpoint_chunks=0, follow=False, poll_interval=1.0):
     start_time = time.time()
-    ds = pandelephant.PandaDatastore(db_url)
+    ds = pandelephant.PandaDatastore(db_url, defer_indexes=defer_indexes)
 
     execution = CreateExecutionIfNeeded(datastore=ds, exec_name=exec_name)
 
-    print("First pass over plog (Gathering Processes and Threads)...")
-    t1 = time.time()
-    processes, threads, thread_names, thread_slices = CollectThreadsAndProcesses(pandalog)
-    t2 = time.time()
-    print ("{:.2f} sec for 1st pass".format(t2 - t1))
-
-    print('Associating Threads and Processes...')
-    t3 = time.time()
-    proc2threads, thread2proc = AssociateThreadsAndProcesses(processes, threads, thread_names)
-    t4 = time.time()
-    print ("{:.2f} sec for association".format(t4 - t3))
-
-    print("Second pass over plog (Gathering Process Mappings)...")
-    t5 = time.time()
-    # mappings, CollectedBetterMappingRanges = CollectProcessMemoryMappings(pandalog, processes)
-    CollectedBetterMappingRanges = CollectProcessMemoryMappings(pandalog, processes)
-    t6 = time.time()
-    print ("{:.2f} sec for mapping gathering".format(t6 - t5))
-
-    print('Got {} BetterMappings...'.format(sum(len(procmaps.keys()) for procmaps in CollectedBetterMappingRanges.values())))
-    for proc in processes:
-        print('\tProcess (ProcessId {} ParentProcessId {}) has {} Threads {} Mappings'.format(proc.ProcessId, proc.ParentProcessId, len(proc2threads[proc]), len(CollectedBetterMappingRanges[proc].keys())))
-        for mapping, (FirstInstructionCount, LastInstructionCount) in CollectedBetterMappingRanges[proc].items():
-            print('\t\tFrom Instruction {} - {} in Address Space {:#x} Mapping {} File {} BaseAddress {:#x} Size {:#x}'.format(
-                FirstInstructionCount,
-                LastInstructionCount,
-                mapping.AddressSpaceId,
-                mapping.Name,
-                mapping.File,
-                mapping.BaseAddress,
-                mapping.Size
-            ))
+    if follow or checkpoint_chunks > 0:
+        if follow:
+            FollowIngest(ds, execution, pandalog, poll_interval)
+        else:
+            CheckpointedIngest(ds, execution, pandalog, checkpoint_chunks)
+        if defer_indexes:
+            ds.create_indexes()
+        print("final time: %.2f sec" % (time.time() - start_time))
+        return
+
+    with contextlib.ExitStack() as stack:
+        # With a memory_budget (bytes), syscalls and buffered taint flows spill to sorted
+        # runs in a temporary directory and are streamed back from there
+        spill = None
+        if memory_budget is not None:
+            spill = (stack.enter_context(tempfile.TemporaryDirectory(prefix='plog_to_pe', dir=spill_dir)), memory_budget)
 
-    print('Third pass over plog (Gathering Taint Flows and Syscalls)...')
-    t7 = time.time()
-    CollectedTaintFlows, CollectedSyscalls, CollectedCodePoints = CollectTaintFlowsAndSyscalls(pandalog, CollectedBetterMappingRanges)
-    t8 = time.time()
-    print('{:.2f} sec to collect Taint Flows and Syscalls...'.format(t8 - t7))
-    print('Collected {} Taint Flows {} Syscalls {} Code Points'.format(len(CollectedTaintFlows), len(CollectedSyscalls), len(CollectedCodePoints)))
+        # With writers, syscalls are written by an IngestPipeline while the plog is read
+        # and taint flows as they are resolved, instead of everything at the end
+        pipeline = stack.enter_context(IngestPipeline(ds, writers)) if writers > 0 else None
 
-    print("Constructing db objects for thread, process, and mapping")
-    t9 = time.time()
-    CollectedProcessToDatabaseProcess, CollectedThreadToDatabaseThread, CollectedMappingToDatabaseMapping = ConvertProcessThreadsMappingsToDatabase(ds, execution, processes, threads, CollectedBetterMappingRanges, thread_names, proc2threads, thread_slices)
-    t10 = time.time()
-    print ("{:.2f} sec for db objects creation".format(t10 - t9))
+        print("Single pass over plog (Gathering Processes, Threads, Mappings, Taint Flows and Syscalls)...")
+        t1 = time.time()
+        registry = None
+        if jobs > 1:
+            collected = CollectPlogParallel(pandalog, jobs, spill)
+        elif writers > 0:
+            collected = PlogCollector(spill)
+            registry = ThreadRegistry(ds, execution, collected)
+            collected.syscall_sink = lambda s: pipeline.add('syscalls', SyscallRow(s, registry))
+            CollectPlog(pandalog, collected)
+        else:
+            collected = CollectPlog(pandalog, PlogCollector(spill))
+        processes, threads, thread_names, thread_slices = collected.processes, collected.threads, collected.thread_names, collected.thread_slices
+        CollectedBetterMappingRanges = collected.CollectedBetterMappingRanges
+        CollectedSyscalls = collected.CollectedSyscalls
+        t2 = time.time()
+        print ("{:.2f} sec for single pass ({} messages, {} bytes)".format(t2 - t1, collected.message_count, collected.byte_count))
+
+        print('Associating Threads and Processes...')
+        t3 = time.time()
+        proc2threads, thread2proc = AssociateThreadsAndProcesses(processes, threads, thread_names)
+        if registry is not None:
+            registry.sync()
+        t4 = time.time()
+        print ("{:.2f} sec for association".format(t4 - t3))
+
+        print('Got {} BetterMappings...'.format(sum(len(procmaps.keys()) for procmaps in CollectedBetterMappingRanges.values())))
+        for proc in processes:
+            print('\tProcess (ProcessId {} ParentProcessId {}) has {} Threads {} Mappings'.format(proc.ProcessId, proc.ParentProcessId, len(proc2threads[proc]), len(CollectedBetterMappingRanges[proc].keys())))
+            for mapping, (FirstInstructionCount, LastInstructionCount) in CollectedBetterMappingRanges[proc].items():
+                print('\t\tFrom Instruction {} - {} in Address Space {:#x} Mapping {} File {} BaseAddress {:#x} Size {:#x}'.format(
+                    FirstInstructionCount,
+                    LastInstructionCount,
+                    mapping.AddressSpaceId,
+                    mapping.Name,
+                    mapping.File,
+                    mapping.BaseAddress,
+                    mapping.Size
+                ))
+
+        print("Constructing db objects for thread, process, and mapping")
+        t9 = time.time()
+        with ds.session_scope():
+            CollectedProcessToDatabaseProcess, CollectedThreadToDatabaseThread, CollectedMappingToDatabaseMapping = ConvertProcessThreadsMappingsToDatabase(ds, execution, processes, threads, CollectedBetterMappingRanges, thread_names, proc2threads, thread2proc, thread_slices, registry=registry)
+        t10 = time.time()
+        print ("{:.2f} sec for db objects creation".format(t10 - t9))
+
+        if writers > 0:
+            print('Resolving Taint Flows against Process Mappings and queueing them for the writers...')
+            t7 = time.time()
+            NoMappingCount = {
+                'Source': 0,
+                'Sink': 0,
+            }
+            QueuedTaintFlows = 0
+            # pending flows come back distinct, and distinct pending flows resolve to distinct flows
+            for resolved in IterResolvedTaintFlows(collected.PendingTaintFlows, CollectedBetterMappingRanges, NoMappingCount):
+                QueuedTaintFlows += len(resolved)
+                # the code points are written up front so concurrent writers never both insert one
+                ds.new_code_points(set(
+                    (CollectedMappingToDatabaseMapping[cp.Mapping], cp.Offset)
+                    for tf in resolved for cp in (tf.SourceCodePoint, tf.SinkCodePoint)
+                ))
+                for tf in resolved:
+                    pipeline.add('taintflows', TaintFlowRow(tf, CollectedThreadToDatabaseThread, CollectedMappingToDatabaseMapping))
+            print('\tNoMappingCount = {}'.format(NoMappingCount))
+            print('{:.2f} sec to resolve and queue {} Taint Flows...'.format(time.time() - t7, QueuedTaintFlows))
+        else:
+            # pending flows and syscalls come back distinct and are resolved and written as a stream
+            print("Resolving Taint Flows against Process Mappings and writing them and the Syscalls to the db")
+            t11 = time.time()
+            NoMappingCount = {
+                'Source': 0,
+                'Sink': 0,
+            }
+            CollectedTaintFlows = (tf for resolved in IterResolvedTaintFlows(collected.PendingTaintFlows, CollectedBetterMappingRanges, NoMappingCount) for tf in resolved)
+            ConvertTaintFlowsAndSyscallsToDatabase(ds, CollectedSyscalls, CollectedTaintFlows, processes, CollectedThreadToDatabaseThread, CollectedMappingToDatabaseMapping)
+            print('\tNoMappingCount = {}'.format(NoMappingCount))
+            print ("{:.2f} sec for db objects create/commit".format(time.time() - t11))
 
-    print("Constructing db objects for Taint Flows, Syscalls, and CodePoints")
-    t11 = time.time()
-    ConvertTaintFlowsAndSyscallsToDatabase(ds, CollectedSyscalls, CollectedTaintFlows, CollectedCodePoints, processes, CollectedThreadToDatabaseThread, CollectedMappingToDatabaseMapping)
-    t12 = time.time()
-    print ("{:.2f} sec for db objects create/commit".format(t12 - t11))
+    if defer_indexes:
+        print("Building indexes...")
+        t13 = time.time()
+        ds.create_indexes()
+        print ("{:.2f} sec for index creation".format(time.time() - t13))
 
 
     print("final time: %.2f sec" % (time.time() - start_time))
@@ -426,8 +1291,25 @@ if __name__ == "__main__":
     parser.add_argument("-db_url", help="db url", action="store", required=True)
     parser.add_argument("-pandalog", help="pandalog", action="store", required=True)
     parser.add_argument("-exec_name", "--exec-name", help="A name for the execution", action="store", required=True)
+    parser.add_argument("-j", "--jobs", help="Decode the plog with N worker processes", type=int, default=1)
+    parser.add_argument("-w", "--writers", help="Write syscalls and taint flows with N threads while the plog is read, instead of after", type=int, default=0)
+    parser.add_argument("--memory-budget", help="Spill collected syscalls and taint flows to disk beyond this many MB", type=int)
+    parser.add_argument("--spill-dir", help="Where to put spill files (default: the system temporary directory)", action="store")
+    parser.add_argument("--checkpoint-chunks", help="Commit every N plog chunks along with a checkpoint, so running again after a failure resumes instead of starting over", type=int, default=0)
+    parser.add_argument("-f", "--follow", help="Ingest a plog that is still being written, chunk by chunk as they are written, until it is closed. "
+                        "Taint flows are resolved against the mappings seen up to their chunk, so where mappings overlap they can resolve to a different mapping than in a batch ingest", action="store_true")
+    parser.add_argument("--poll-interval", help="How often (seconds) --follow checks for new chunks", type=float, default=1.0)
+    parser.add_argument("--defer-indexes", help="Drop secondary indexes during the load and build them once it's done", action="store_true")
 
     args = parser.parse_args()
+    if args.writers > 0 and args.jobs > 1:
+        parser.error("--writers can't be combined with --jobs")
+    if args.checkpoint_chunks > 0 and (args.jobs > 1 or args.writers > 0 or args.memory_budget is not None):
+        parser.error("--checkpoint-chunks can't be combined with --jobs, --writers or --memory-budget")
+    if args.follow and (args.jobs > 1 or args.writers > 0 or args.memory_budget is not None or args.checkpoint_chunks > 0 or args.defer_indexes):
+        parser.error("--follow can't be combined with --jobs, --writers, --memory-budget, --checkpoint-chunks or --defer-indexes")
 
     print("%s %s" % (args.db_url, args.exec_name))
-    plog_to_pe(args.pandalog, args.db_url, args.exec_name)
+    plog_to_pe(args.pandalog, args.db_url, args.exec_name, defer_indexes=args.defer_indexes, jobs=args.jobs, writers=args.writers,
+        memory_budget=args.memory_budget * 1024 * 1024 if args.memory_budget is not None else None, spill_dir=args.spill_dir,
+        checkpoint_chunks=args.checkpoint_chunks, follow=args.follow, poll_interval=args.poll_interval)
@@ -18,7 +18,9 @@ setuptools.setup(
     python_requires='>=3.6',
     install_requires=['sqlalchemy'],
     extras_require={
-        'postgres': ["psycopg2-binary"]
+        'postgres': ["psycopg2-binary"],
+        'numpy': ["numpy"],
+        'arrow': ["pyarrow"]
     },
     options={
         'generate_py_protobufs': {
@@ -0,0 +1,122 @@
+from sqlalchemy import Table
+from typing import Any, Dict, List, Optional
+from . import _db_models
+from ._execution_stats import ExecutionStatsDelta
+import enum
+import io
+import uuid
+
+def _declared_class(table: Table):
+    '''
+    Find the declarative class that owns table (not a subclass sharing it through inheritance)
+    '''
+    pending = list(_db_models.Base.__subclasses__())
+    while pending:
+        cls = pending.pop()
+        if cls.__dict__.get('__table__') is table:
+            return cls
+        pending.extend(cls.__subclasses__())
+    return None
+
+class BulkWriter:
+    '''
+    Buffers rows for the high-volume tables and writes them in chunks with Core executemany.
+
+    Rows are plain dicts keyed by column name. The polymorphic `type` column and uuid primary keys
+    are filled in when they are missing, and add returns the primary key so that rows in other
+    tables can reference it. Every row added to a table must have the same set of columns.
+
+    Buffers are always flushed together in foreign key dependency order, so a row can reference
+    anything that was added before it.
+
+    stats collects the execution_stats changes the rows make, PandaDatastore.bulk_writer writes
+    them after the last flush.
+    '''
+    def __init__(self, conn, chunk_size: int = 10000):
+        self.connection = conn
+        self._chunk_size = chunk_size
+        self._buffers: Dict[Table, List[Dict[str, Any]]] = {}
+        self._defaults: Dict[Table, Dict[str, Any]] = {}
+        self._uuid_keys: Dict[Table, Optional[str]] = {}
+        self._buffered = 0
+        self.rows_written = 0
+        self.stats = ExecutionStatsDelta()
+
+    def _table_defaults(self, table: Table):
+        if table not in self._defaults:
+            defaults = {}
+            uuid_key = None
+            cls = _declared_class(table)
+            if cls is not None and 'type' in table.c and cls.__mapper__.polymorphic_identity is not None:
+                defaults['type'] = cls.__mapper__.polymorphic_identity
+            for col in table.primary_key.columns:
+                if isinstance(col.type, _db_models.GUID):
+                    uuid_key = col.name
+            self._defaults[table] = defaults
+            self._uuid_keys[table] = uuid_key
+        return self._defaults[table], self._uuid_keys[table]
+
+    def add(self, table_name: str, **values) -> Any:
+        '''
+        Buffer a row for table_name, returns the row's uuid primary key (or None for integer keys)
+        '''
+        table = _db_models.Base.metadata.tables[table_name]
+        defaults, uuid_key = self._table_defaults(table)
+        for k, v in defaults.items():
+            values.setdefault(k, v)
+        if uuid_key is not None and values.get(uuid_key) is None:
+            values[uuid_key] = uuid.uuid4()
+
+        self._buffers.setdefault(table, []).append(values)
+        self._buffered += 1
+        if self._buffered >= self._chunk_size:
+            self.flush()
+        return values.get(uuid_key) if uuid_key is not None else None
+
+    def flush(self) -> None:
+        for table in _db_models.Base.metadata.sorted_tables:
+            rows = self._buffers.get(table)
+            if rows:
+                self._write(table, rows)
+                self.rows_written += len(rows)
+                self._buffers[table] = []
+        self._buffered = 0
+
+    def _write(self, table: Table, rows: List[Dict[str, Any]]) -> None:
+        self.connection.execute(table.insert(), rows)
+
+def _copy_text(value: Any) -> str:
+    '''
+    Render a value as a field of COPY's text format
+    '''
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        text = 't' if value else 'f'
+    elif isinstance(value, enum.Enum):
+        text = value.name
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        text = '\\x' + bytes(value).hex()
+    else:
+        text = str(value)
+    return text.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+class CopyBulkWriter(BulkWriter):
+    '''
+    PostgreSQL version of BulkWriter, each chunk is streamed with COPY ... FROM STDIN in text format
+    '''
+    def _write(self, table: Table, rows: List[Dict[str, Any]]) -> None:
+        columns = list(rows[0].keys())
+        buf = io.StringIO()
+        for row in rows:
+            buf.write('\t'.join(_copy_text(row[c]) for c in columns))
+            buf.write('\n')
+        buf.seek(0)
+        sql = 'COPY {} ({}) FROM STDIN'.format(table.name, ', '.join('"{}"'.format(c) for c in columns))
+        with self.connection.connection.cursor() as cursor:
+            cursor.copy_expert(sql, buf)
+
+def make_bulk_writer(conn, chunk_size: int = 10000) -> BulkWriter:
+    if conn.dialect.name == 'postgresql':
+        return CopyBulkWriter(conn, chunk_size)
+    return BulkWriter(conn, chunk_size)
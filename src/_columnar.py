@@ -0,0 +1,184 @@
+import os
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from . import _db_models
+from . import _models
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# file name extension of each format
+FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+# in the order they have to be imported in
+TABLES = ('processes', 'threads', 'mappings', 'threadslices', 'syscalls', 'taint_flows')
+
+# schema metadata keys, every file carries the execution it came from
+EXECUTION_NAME = b'pandelephant.execution.name'
+EXECUTION_DESCRIPTION = b'pandelephant.execution.description'
+
+_UNSIGNED_ARGUMENT_TYPES = {'pointer', 'unsigned64', 'unsigned32', 'unsigned16'}
+
+def require_pyarrow() -> None:
+    if pa is None:
+        raise Exception("Columnar export and import need pyarrow, install pandelephant[arrow]")
+
+def table_path(path: str, table: str, format: str) -> str:
+    if format not in FORMATS:
+        raise Exception("Unrecognized columnar format: {} (expected one of {})".format(format, ', '.join(FORMATS)))
+    return os.path.join(path, table + FORMATS[format])
+
+def _dictionary():
+    return pa.dictionary(pa.int32(), pa.string())
+
+def schema(table: str, num_arguments: int = 0) -> 'pa.Schema':
+    '''
+    The schema of one exported table. Processes, threads and mappings are numbered by their row in their own file and
+    referenced by that number everywhere else, code points are (mapping, offset into mapping). Syscall arguments are
+    flattened into arg<position>_* columns, one set per position up to num_arguments, that are null past the end of a
+    syscall's arguments. Only one of arg<position>_int, _str and _bytes is set, depending on arg<position>_type.
+    '''
+    if table == 'processes':
+        fields = [('process', pa.int32()), ('uuid', pa.string()), ('pid', pa.int64()), ('ppid', pa.int64()), ('create_time', pa.int64())]
+    elif table == 'threads':
+        fields = [('thread', pa.int32()), ('uuid', pa.string()), ('process', pa.int32()), ('tid', pa.int64()), ('create_time', pa.int64()), ('names', pa.list_(pa.string()))]
+    elif table == 'mappings':
+        fields = [('mapping', pa.int32()), ('uuid', pa.string()), ('process', pa.int32()), ('name', _dictionary()), ('path', _dictionary()),
+                  ('asid', pa.int64()), ('base', pa.int64()), ('base_execution_offset', pa.int64()), ('size', pa.int64()),
+                  ('first_seen_execution_offset', pa.int64()), ('last_seen_execution_offset', pa.int64())]
+    elif table == 'threadslices':
+        fields = [('thread', pa.int32()), ('start_execution_offset', pa.int64()), ('end_execution_offset', pa.int64())]
+    elif table == 'syscalls':
+        fields = [('thread', pa.int32()), ('name', _dictionary()), ('retval', pa.int64()), ('pc', pa.int64()), ('execution_offset', pa.int64())]
+        for i in range(num_arguments):
+            fields += [('arg{}_name'.format(i), _dictionary()), ('arg{}_type'.format(i), _dictionary()),
+                       ('arg{}_int'.format(i), pa.int64()), ('arg{}_str'.format(i), pa.string()), ('arg{}_bytes'.format(i), pa.binary())]
+    elif table == 'taint_flows':
+        fields = [('is_store', pa.bool_()),
+                  ('source_thread', pa.int32()), ('source_mapping', pa.int32()), ('source_offset', pa.int64()), ('source_execution_offset', pa.int64()),
+                  ('sink_thread', pa.int32()), ('sink_mapping', pa.int32()), ('sink_offset', pa.int64()), ('sink_execution_offset', pa.int64())]
+    else:
+        raise Exception("Unrecognized table: {}".format(table))
+    return pa.schema(fields)
+
+class _DictionaryEncoder:
+    '''
+    One column's dictionary, shared by every batch of a file and only ever appended to, so an Arrow IPC file
+    can carry it as deltas
+    '''
+    def __init__(self):
+        self.ids: Dict[Optional[str], int] = {}
+        self.values: List[str] = []
+
+    def encode(self, values: List[Optional[str]]) -> 'pa.DictionaryArray':
+        ids = self.ids
+        indices = []
+        for v in values:
+            if v is None:
+                indices.append(None)
+                continue
+            i = ids.get(v)
+            if i is None:
+                i = ids[v] = len(self.values)
+                self.values.append(v)
+            indices.append(i)
+        return pa.DictionaryArray.from_arrays(pa.array(indices, pa.int32()), pa.array(self.values, pa.string()))
+
+class TableWriter:
+    '''
+    Writes record batches of one table to a Parquet or Arrow IPC file, built from lists of column values
+    '''
+    def __init__(self, path: str, table: str, format: str, execution: _models.Execution, num_arguments: int = 0):
+        metadata = {EXECUTION_NAME: execution.name().encode(), EXECUTION_DESCRIPTION: (execution.description() or '').encode()}
+        self.schema = schema(table, num_arguments).with_metadata(metadata)
+        self.dictionaries = {f.name: _DictionaryEncoder() for f in self.schema if pa.types.is_dictionary(f.type)}
+        filename = table_path(path, table, format)
+        os.makedirs(path, exist_ok=True)
+        if format == 'parquet':
+            self.writer = pq.ParquetWriter(filename, self.schema)
+        else:
+            self.writer = pa.ipc.new_file(filename, self.schema, options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+
+    def write(self, columns: List[List[Any]]) -> None:
+        '''
+        columns are the values of each schema field in order
+        '''
+        if not columns or not columns[0]:
+            return
+        arrays = []
+        for field, values in zip(self.schema, columns):
+            dictionary = self.dictionaries.get(field.name)
+            arrays.append(dictionary.encode(values) if dictionary is not None else pa.array(values, field.type))
+        self.writer.write_batch(pa.record_batch(arrays, schema=self.schema))
+
+    def close(self) -> None:
+        self.writer.close()
+
+def argument_columns(names: List, db_types: List, values: List, int_values: List, bytes_values: List, type_names: Dict[str, str]) -> List[List]:
+    '''
+    The arg<position>_* columns of one position from the syscall_arguments columns of a batch of syscalls (None where a
+    syscall has no argument at the position). db_types are the stored _db_models.ArgType names, type_names maps them to the
+    names new_syscall takes. Unsigned 64 bit values of 2**63 and up wrap around to negative, the same as SQLite stores them.
+    '''
+    types = [None if t is None else type_names[t] for t in db_types]
+    ints = [v - (1 << 64) if v is not None and v >= (1 << 63) else v for v in int_values]
+    strings = list(values)
+    blobs = list(bytes_values)
+    for i, (t, v) in enumerate(zip(types, values)):
+        # written before the typed columns existed and not migrated, the value is only in the text column
+        if v is not None and t != 'string':
+            v = _models._argument_from_db(None, _db_models.ArgType[db_types[i]], v)['value']
+            strings[i] = None
+            if isinstance(v, bytes):
+                blobs[i] = v
+            else:
+                ints[i] = v - (1 << 64) if v >= (1 << 63) else v
+    return [list(names), types, ints, strings, blobs]
+
+def read_execution(path: str, format: str) -> Tuple[str, Optional[str]]:
+    '''
+    The name and description of the execution an export came from
+    '''
+    metadata = _read_schema(table_path(path, 'processes', format), format).metadata or {}
+    description = metadata.get(EXECUTION_DESCRIPTION, b'').decode()
+    return metadata.get(EXECUTION_NAME, b'').decode(), description if description else None
+
+def _read_schema(filename: str, format: str) -> 'pa.Schema':
+    if format == 'parquet':
+        return pq.read_schema(filename)
+    with pa.memory_map(filename) as source:
+        return pa.ipc.open_file(source).schema
+
+def iter_rows(path: str, table: str, format: str, batch_size: int = 10000) -> Iterator[Tuple]:
+    '''
+    The rows of an exported table as tuples in schema order, read a record batch at a time
+    '''
+    filename = table_path(path, table, format)
+    if format == 'parquet':
+        for batch in pq.ParquetFile(filename).iter_batches(batch_size=batch_size):
+            yield from zip(*(column.to_pylist() for column in batch.columns))
+        return
+    with pa.memory_map(filename) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            yield from zip(*(column.to_pylist() for column in batch.columns))
+
+def unflatten_arguments(row: Tuple, first: int) -> List[Dict[str, Any]]:
+    '''
+    The arguments of a syscalls row in the form new_syscall takes them, the reverse of argument_columns
+    '''
+    arguments = []
+    for c in range(first, len(row), 5):
+        (name, arg_type, int_value, str_value, bytes_value) = row[c:c + 5]
+        if arg_type is None:
+            break
+        if int_value is not None:
+            value = int_value + (1 << 64) if int_value < 0 and arg_type in _UNSIGNED_ARGUMENT_TYPES else int_value
+        else:
+            value = str_value if arg_type == 'string' else bytes_value
+        arguments.append({'name': name, 'type': arg_type, 'value': value})
+    return arguments
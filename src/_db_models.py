@@ -1,12 +1,15 @@
-from sqlalchemy.types import TypeDecorator, CHAR
+from sqlalchemy.types import TypeDecorator, CHAR, BINARY, NUMERIC
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Boolean, Integer, String, LargeBinary, BigInteger, DateTime, ForeignKey, Enum
+from sqlalchemy import Column, Boolean, Integer, String, LargeBinary, BigInteger, DateTime, ForeignKey, Enum, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 import enum
 import uuid
 Base = declarative_base()
 
+# Attribute set on a dialect to make GUID columns BINARY(16)
+BINARY_GUIDS = 'pandelephant_binary_guids'
+
 # GUID class taken from https://docs.sqlalchemy.org/en/13/core/custom_types.html#backend-agnostic-guid-type
 class GUID(TypeDecorator):
     """Platform-independent GUID type.
@@ -14,12 +17,18 @@ class GUID(TypeDecorator):
     Uses PostgreSQL's UUID type, otherwise uses
     CHAR(32), storing as stringified hex values.
 
+    Dialects with the BINARY_GUIDS attribute set (see PandaDatastore's
+    compact_guids) store the 16 raw bytes in a BINARY(16) column instead,
+    which halves the key and index size and skips hex formatting/parsing.
+
     """
     impl = CHAR
 
     def load_dialect_impl(self, dialect):
         if dialect.name == 'postgresql':
             return dialect.type_descriptor(UUID())
+        elif getattr(dialect, BINARY_GUIDS, False):
+            return dialect.type_descriptor(BINARY(16))
         else:
             return dialect.type_descriptor(CHAR(32))
 
@@ -30,18 +39,47 @@ class GUID(TypeDecorator):
             return str(value)
         else:
             if not isinstance(value, uuid.UUID):
-                return "%.32x" % uuid.UUID(value).int
-            else:
-                # hexstring
-                return "%.32x" % value.int
+                value = uuid.UUID(value)
+            if getattr(dialect, BINARY_GUIDS, False):
+                return value.bytes
+            # hexstring
+            return value.hex
 
     def process_result_value(self, value, dialect):
         if value is None:
             return value
+        elif isinstance(value, uuid.UUID):
+            return value
+        elif isinstance(value, bytes):
+            return uuid.UUID(bytes=value)
         else:
-            if not isinstance(value, uuid.UUID):
-                value = uuid.UUID(value)
+            return uuid.UUID(value)
+
+class ArgumentInteger(TypeDecorator):
+    """Integer syscall argument values, anything from signed to unsigned 64 bit.
+
+    Uses PostgreSQL's NUMERIC(20, 0) so the whole range is stored and sorts as is,
+    otherwise BIGINT. SQLite's integers are signed 64 bit, so there values of 2**63
+    and up are stored wrapped around to negative and sort below 0. Reading them
+    back unwrapped is up to the caller, which knows whether the argument is unsigned.
+
+    """
+    impl = BigInteger
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(NUMERIC(20, 0))
+        return dialect.type_descriptor(BigInteger())
+
+    def process_bind_param(self, value, dialect):
+        if value is None or dialect.name == 'postgresql':
+            return value
+        return value - (1 << 64) if value >= (1 << 63) else value
+
+    def process_result_value(self, value, dialect):
+        if value is None:
             return value
+        return int(value)
 
 class Execution(Base):
     __tablename__ = 'executions'
@@ -80,6 +118,8 @@ class Process(Base):
     threads = relationship("Thread", back_populates="process")
     mappings = relationship("Mapping", back_populates="process")
 
+    __table_args__ = (Index('ix_processes_execution_id', 'execution_id'),)
+
     __mapper_args__ = {
             'polymorphic_identity': 'Process',
             'polymorphic_on':type
@@ -102,6 +142,8 @@ class Thread(Base):
     process = relationship("Process", back_populates="threads")
     names = relationship("ThreadName", back_populates="thread")
 
+    __table_args__ = (Index('ix_threads_process_id', 'process_id'),)
+
     __mapper_args__ = {
             'polymorphic_identity': 'Thread',
             'polymorphic_on':type
@@ -124,6 +166,8 @@ class Mapping(Base):
     process = relationship("Process", back_populates="mappings")
     codepoints = relationship("CodePoint", back_populates="mapping")
 
+    __table_args__ = (Index('ix_mappings_process_id', 'process_id'),)
+
     __mapper_args__ = {
             'polymorphic_identity': 'Mapping',
             'polymorphic_on':type
@@ -139,6 +183,8 @@ class VirtualAddress(Base):
     address = Column(BigInteger, nullable=False)
     execution = relationship("Execution", uselist=False)
 
+    __table_args__ = (Index('ix_virtual_addresses_execution_asid_address', 'execution_id', 'asid', 'address'),)
+
     __mapper_args__ = {
             'polymorphic_identity': 'VirtualAddress',
             'polymorphic_on':type
@@ -153,6 +199,9 @@ class CodePoint(Base):
     offset = Column(BigInteger, nullable=False)
     mapping = relationship("Mapping", back_populates="codepoints", uselist=False)
 
+    # a code point is shared by every flow that touches it
+    __table_args__ = (UniqueConstraint('mapping_id', 'offset'),)
+
     __mapper_args__ = {
             'polymorphic_identity': 'CodePoint',
             'polymorphic_on':type
@@ -183,6 +232,14 @@ class TaintFlow(Base):
     source_execution_offset = Column(BigInteger, nullable=False) 
     sink_execution_offset = Column(BigInteger, nullable=False)
 
+    __table_args__ = (
+        # by code point and then time, for following flows out of (or into) a code point after (or before) an offset
+        Index('ix_taint_flows_source_offset', 'source_id', 'source_execution_offset'),
+        Index('ix_taint_flows_sink_offset', 'sink_id', 'sink_execution_offset'),
+        Index('ix_taint_flows_source_thread_offset', 'source_thread_id', 'source_execution_offset'),
+        Index('ix_taint_flows_sink_thread_offset', 'sink_thread_id', 'sink_execution_offset'),
+    )
+
     __mapper_args__ = {
             'polymorphic_identity': 'TaintFlow',
             'polymorphic_on':type
@@ -204,6 +261,8 @@ class ThreadSlice(Base):
     start_execution_offset = Column(BigInteger, nullable=False) 
     end_execution_offset = Column(BigInteger, nullable=False) 
 
+    __table_args__ = (Index('ix_threadslice_thread_start', 'thread_id', 'start_execution_offset'),)
+
     __mapper_args__ = {
             'polymorphic_identity': 'ThreadSlice',
             'polymorphic_on':type
@@ -229,6 +288,8 @@ class Syscall(Base):
     # and this is when it happened
     execution_offset = Column(BigInteger, nullable=False)
 
+    __table_args__ = (Index('ix_syscalls_thread_execution_offset', 'thread_id', 'execution_offset'),)
+
     __mapper_args__ = {
             'polymorphic_identity': 'Syscall',
             'polymorphic_on':type
@@ -253,4 +314,65 @@ class SyscallArgument(Base):
     name = Column(String)
     position = Column(Integer, nullable=False)
     argument_type = Column(Enum(ArgType))
+
+    # exactly one of these holds the argument: value for strings, int_value for pointers and
+    # numbers and bytes_value for bytes. Databases from before int_value and bytes_value existed
+    # have every argument as text in value until PandaDatastore.migrate_syscall_arguments is run
     value = Column(String)
+    int_value = Column(ArgumentInteger)
+    bytes_value = Column(LargeBinary)
+
+    __table_args__ = (Index('ix_syscall_arguments_syscall_position', 'syscall_id', 'position'),
+                      Index('ix_syscall_arguments_name_position_int_value', 'name', 'position', 'int_value'))
+
+# Progress of a resumable ingest of one plog (source) into an execution. Rows written by the
+# ingest and the checkpoint that covers them are committed together, so after a crash the
+# ingest picks up from the checkpoint without duplicating anything.
+class IngestCheckpoint(Base):
+    __tablename__ = "ingest_checkpoints"
+    ingest_checkpoint_id = Column(Integer, primary_key=True)
+    execution_id = Column(GUID, ForeignKey('executions.execution_id'), nullable=False)
+    source = Column(String, nullable=False)
+
+    # what the ingest is doing and the next plog chunk it will read
+    stage = Column(String(20), nullable=False)
+    plog_chunk = Column(BigInteger, nullable=False)
+
+    # committed row watermarks
+    syscalls = Column(BigInteger, nullable=False)
+    taint_flows = Column(BigInteger, nullable=False)
+
+    # whatever the ingest needs to carry on, opaque to the database
+    state = Column(LargeBinary)
+
+    __table_args__ = (UniqueConstraint('execution_id', 'source'),)
+
+# Records a checkpointed ingest buffered for a later stage, in the order they were added
+class IngestCheckpointData(Base):
+    __tablename__ = "ingest_checkpoint_data"
+    ingest_checkpoint_data_id = Column(Integer, primary_key=True)
+    execution_id = Column(GUID, ForeignKey('executions.execution_id'), nullable=False)
+    source = Column(String, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+
+    __table_args__ = (Index('ix_ingest_checkpoint_data_execution_source', 'execution_id', 'source'),)
+
+# Summary of what each process of an execution contains, kept up to date by the datastore in the same
+# transaction as the rows it counts so totals and offset ranges don't need a scan of the big tables.
+# One row per (process, thread, kind, name): thread is null for rows about the process as a whole and
+# name is '' except for syscalls, where it's the syscall name. Writers running at the same time can
+# each insert a row for a new key, readers add up all the rows of a key.
+class ExecutionStat(Base):
+    __tablename__ = "execution_stats"
+    execution_stat_id = Column(Integer, primary_key=True)
+    process_id = Column(GUID, ForeignKey('processes.process_id'), nullable=False)
+    thread_id = Column(GUID, ForeignKey('threads.thread_id'))
+    kind = Column(String(20), nullable=False) # process, thread, mapping, syscall, taint_flow or threadslice
+    name = Column(String, nullable=False)
+
+    count = Column(BigInteger, nullable=False)
+    coverage = Column(BigInteger, nullable=False) # instructions covered, thread slices only
+    min_offset = Column(BigInteger)
+    max_offset = Column(BigInteger)
+
+    __table_args__ = (Index('ix_execution_stats_process', 'process_id'),)
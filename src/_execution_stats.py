@@ -0,0 +1,78 @@
+from sqlalchemy import bindparam, case, or_, select
+from typing import Dict, List, Optional, Tuple
+from . import _db_models
+import uuid
+
+# (process_id, thread_id or None, kind, name)
+StatKey = Tuple[uuid.UUID, Optional[uuid.UUID], str, str]
+
+class ExecutionStatsDelta:
+    '''
+    Changes to the execution_stats summary rows made by a batch of inserts.
+
+    Each added row is folded into its key right away, so a batch of a million syscalls is a few
+    hundred entries. write applies them with a lookup of the existing rows per batch_size processes, one executemany
+    UPDATE for the keys that have a row and one executemany INSERT for the ones that don't.
+    '''
+    def __init__(self):
+        # key -> [count, coverage, min_offset, max_offset]
+        self.entries: Dict[StatKey, List] = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, process_id: uuid.UUID, thread_id: Optional[uuid.UUID], kind: str, name: str = '', count: int = 1, coverage: int = 0, min_offset: int = None, max_offset: int = None) -> None:
+        key = (process_id, thread_id, kind, name if name is not None else '')
+        entry = self.entries.get(key)
+        if entry is None:
+            self.entries[key] = [count, coverage, min_offset, max_offset]
+            return
+        entry[0] += count
+        entry[1] += coverage
+        if min_offset is not None and (entry[2] is None or min_offset < entry[2]):
+            entry[2] = min_offset
+        if max_offset is not None and (entry[3] is None or max_offset > entry[3]):
+            entry[3] = max_offset
+
+    def update(self, other: 'ExecutionStatsDelta') -> None:
+        for (process_id, thread_id, kind, name), (count, coverage, min_offset, max_offset) in other.entries.items():
+            self.add(process_id, thread_id, kind, name, count, coverage, min_offset, max_offset)
+
+    def write(self, conn, batch_size: int = 500) -> None:
+        '''
+        Apply the entries to the execution_stats rows, looking the existing rows up at most batch_size processes
+        per query to stay under the bound parameter limits of SQLite
+        '''
+        if not self.entries:
+            return
+        table = _db_models.ExecutionStat.__table__
+        process_ids = list(set(key[0] for key in self.entries))
+        kinds = list(set(key[2] for key in self.entries))
+        existing = {}
+        for start in range(0, len(process_ids), batch_size):
+            for (stat_id, process_id, thread_id, kind, name) in conn.execute(
+                    select([table.c.execution_stat_id, table.c.process_id, table.c.thread_id, table.c.kind, table.c.name])
+                    .where(table.c.process_id.in_(process_ids[start:start + batch_size])).where(table.c.kind.in_(kinds))):
+                existing.setdefault((process_id, thread_id, kind, name), stat_id)
+
+        updates = []
+        inserts = []
+        for key, (count, coverage, min_offset, max_offset) in self.entries.items():
+            stat_id = existing.get(key)
+            if stat_id is not None:
+                updates.append({'b_id': stat_id, 'b_count': count, 'b_coverage': coverage, 'b_min': min_offset, 'b_max': max_offset})
+            else:
+                inserts.append({'process_id': key[0], 'thread_id': key[1], 'kind': key[2], 'name': key[3],
+                                'count': count, 'coverage': coverage, 'min_offset': min_offset, 'max_offset': max_offset})
+        if updates:
+            # in key order so concurrent writers lock the rows they share in the same order
+            updates.sort(key=lambda u: u['b_id'])
+            min_col, max_col = table.c.min_offset, table.c.max_offset
+            conn.execute(table.update().where(table.c.execution_stat_id == bindparam('b_id')).values(
+                count=table.c.count + bindparam('b_count'),
+                coverage=table.c.coverage + bindparam('b_coverage'),
+                min_offset=case([(or_(min_col == None, min_col > bindparam('b_min')), bindparam('b_min'))], else_=min_col),
+                max_offset=case([(or_(max_col == None, max_col < bindparam('b_max')), bindparam('b_max'))], else_=max_col)), updates)
+        if inserts:
+            conn.execute(table.insert(), inserts)
+        self.entries = {}
@@ -0,0 +1,190 @@
+from bisect import bisect_left, bisect_right
+from typing import Any, Iterable, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class MappingIndex:
+    '''
+    Answers "which mapping covers address A at execution offset I" in logarithmic time.
+
+    The address space is cut into elementary segments at every mapping boundary. Each
+    segment keeps the mappings that cover it sorted by first seen execution offset, so a
+    lookup is a bisect over the segment boundaries followed by a bisect over the first
+    seen offsets of that segment.
+
+    When more than one mapping covers an address at some offset, the one that was first
+    seen most recently wins (ties go to the mapping added last).
+    '''
+    def __init__(self, mappings: Iterable[Tuple[Any, int, int, int, int]]):
+        '''
+        mappings is an iterable of (key, base_address, size, first_seen_execution_offset, last_seen_execution_offset).
+        The key is what gets returned by lookups.
+        '''
+        entries = []
+        for seq, (key, base, size, first, last) in enumerate(mappings):
+            if size <= 0:
+                continue
+            entries.append((first, seq, last, base, size, key))
+
+        bounds = set()
+        for (_, _, _, base, size, _) in entries:
+            bounds.add(base)
+            bounds.add(base + size)
+        self._bounds = sorted(bounds)
+
+        covering: List[list] = [[] for _ in range(max(len(self._bounds) - 1, 0))]
+        for entry in entries:
+            base, size = entry[3], entry[4]
+            for i in range(bisect_left(self._bounds, base), bisect_left(self._bounds, base + size)):
+                covering[i].append(entry)
+
+        # per segment: first seen offsets, running max of last seen offsets, entries
+        self._segments = []
+        for seg in covering:
+            seg.sort()
+            firsts = [e[0] for e in seg]
+            max_lasts = []
+            running = None
+            for e in seg:
+                running = e[2] if running is None or e[2] > running else running
+                max_lasts.append(running)
+            self._segments.append((firsts, max_lasts, seg))
+
+        if np is not None:
+            self._np_bounds = np.array(self._bounds, dtype=np.uint64)
+            self._build_np_segments()
+
+    def _build_np_segments(self) -> None:
+        # All the segments' entries in one sorted array keyed by segment and then rank of first seen offset, so
+        # lookup_many can find the candidate entry of every lookup with one searchsorted
+        seg_idxs, firsts, lasts, max_lasts, bases, keys = [], [], [], [], [], []
+        for seg_idx, (seg_firsts, seg_max_lasts, seg) in enumerate(self._segments):
+            seg_idxs.extend([seg_idx] * len(seg))
+            firsts.extend(seg_firsts)
+            max_lasts.extend(seg_max_lasts)
+            for (_, _, last, base, _, key) in seg:
+                lasts.append(last)
+                bases.append(base)
+                keys.append(key)
+        self._np_first_values = np.unique(np.array(firsts, dtype=np.int64))
+        self._np_rank_span = len(self._np_first_values) + 1
+        self._np_keys = np.array(seg_idxs, dtype=np.int64) * self._np_rank_span + np.searchsorted(self._np_first_values, np.array(firsts, dtype=np.int64), side='right')
+        self._np_lasts = np.array(lasts, dtype=np.int64)
+        self._np_max_lasts = np.array(max_lasts, dtype=np.int64)
+        self._np_bases = np.array(bases, dtype=np.uint64)
+        self._flat_keys = keys
+
+    def __len__(self) -> int:
+        return len(self._segments)
+
+    def _lookup_segment(self, seg_idx: int, address: int, execution_offset: int) -> Optional[Tuple[Any, int]]:
+        if seg_idx < 0 or seg_idx >= len(self._segments):
+            return None
+        firsts, max_lasts, seg = self._segments[seg_idx]
+        j = bisect_right(firsts, execution_offset) - 1
+        while j >= 0 and max_lasts[j] >= execution_offset:
+            (_, _, last, base, _, key) = seg[j]
+            if last >= execution_offset:
+                return key, address - base
+            j -= 1
+        return None
+
+    def lookup(self, address: int, execution_offset: int) -> Optional[Tuple[Any, int]]:
+        '''
+        Returns (key, offset into mapping) for the mapping covering address at execution_offset, or None
+        '''
+        return self._lookup_segment(bisect_right(self._bounds, address) - 1, address, execution_offset)
+
+    def lookup_many(self, addresses: Sequence[int], execution_offsets: Sequence[int], results: List = None, positions: Sequence[int] = None) -> List[Optional[Tuple[Any, int]]]:
+        '''
+        Batch version of lookup. With numpy available the segment search and the search for the most
+        recently first seen entry of the segment are each a single vectorized searchsorted for the whole
+        batch. Only lookups whose candidate had already gone when an older entry of its segment was
+        still live fall back to walking the segment.
+
+        If results is given the i-th lookup is stored at results[positions[i]] instead of returning a new
+        list, and misses leave it untouched, which saves scattering the results of a subset of a batch.
+        '''
+        if results is None:
+            results = [None] * len(addresses)
+            positions = None
+        if np is None or len(addresses) == 0 or len(self._flat_keys) == 0:
+            lookup_segment = self._lookup_segment
+            for i, (a, o) in enumerate(zip(addresses, execution_offsets)):
+                r = lookup_segment(bisect_right(self._bounds, a) - 1, a, o)
+                if r is not None:
+                    results[i if positions is None else positions[i]] = r
+            return results
+
+        np_addresses = np.asarray(addresses, dtype=np.uint64)
+        np_offsets = np.asarray(execution_offsets, dtype=np.int64)
+        seg_idxs = np.searchsorted(self._np_bounds, np_addresses, side='right') - 1
+        valid = (seg_idxs >= 0) & (seg_idxs < len(self._segments))
+        seg_starts = np.where(valid, seg_idxs, 0) * self._np_rank_span
+        pos = np.searchsorted(self._np_keys, seg_starts + np.searchsorted(self._np_first_values, np_offsets, side='right'), side='right') - 1
+        clipped = np.maximum(pos, 0)
+        candidate = valid & (pos >= 0) & (self._np_keys[clipped] > seg_starts)
+        hit = candidate & (self._np_lasts[clipped] >= np_offsets)
+        walk = candidate & ~hit & (self._np_max_lasts[clipped] >= np_offsets)
+
+        hits = np.nonzero(hit)[0]
+        hit_pos = pos[hits]
+        keys = self._flat_keys
+        targets = (hits if positions is None else np.asarray(positions)[hits]).tolist()
+        for t, p, offset in zip(targets, hit_pos.tolist(), (np_addresses[hits] - self._np_bases[hit_pos]).tolist()):
+            results[t] = (keys[p], offset)
+        if walk.any():
+            for i in np.nonzero(walk)[0].tolist():
+                r = self._lookup_segment(int(seg_idxs[i]), int(np_addresses[i]), int(np_offsets[i]))
+                if r is not None:
+                    results[i if positions is None else positions[i]] = r
+        return results
+
+class IntervalIndex:
+    '''
+    Answers "which intervals contain point P" for a fixed set of closed [start, end] intervals,
+    e.g. which mappings were seen at an execution offset.
+
+    Intervals are kept sorted by start, so the ones starting at or before P are a prefix found
+    by bisect. The prefix is cut into blocks that remember their largest end, blocks ending
+    before P are skipped whole and the rest are scanned. With numpy the prefix is instead
+    checked with a single vectorized comparison.
+    '''
+    BlockSize = 64
+
+    def __init__(self, intervals: Iterable[Tuple[Any, int, int]]):
+        '''
+        intervals is an iterable of (key, start, end), the key is what gets returned by lookups
+        '''
+        entries = sorted(((start, end, seq, key) for seq, (key, start, end) in enumerate(intervals)), key=lambda e: (e[0], e[2]))
+        self._starts = [e[0] for e in entries]
+        self._ends = [e[1] for e in entries]
+        self._keys = [e[3] for e in entries]
+        self._block_max_ends = [max(self._ends[i:i + self.BlockSize]) for i in range(0, len(entries), self.BlockSize)]
+        if np is not None:
+            self._np_ends = np.array(self._ends, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def lookup(self, point: int) -> List[Any]:
+        '''
+        Keys of the intervals containing point, in order of start
+        '''
+        prefix = bisect_right(self._starts, point)
+        if np is not None:
+            return [self._keys[i] for i in np.nonzero(self._np_ends[:prefix] >= point)[0].tolist()]
+        found = []
+        for block, max_end in enumerate(self._block_max_ends):
+            first = block * self.BlockSize
+            if first >= prefix:
+                break
+            if max_end < point:
+                continue
+            for i in range(first, min(first + self.BlockSize, prefix)):
+                if self._ends[i] >= point:
+                    found.append(self._keys[i])
+        return found
@@ -1,4 +1,5 @@
 from typing import Union, Dict, List, Optional, Set
+import codecs
 import uuid
 from datetime import datetime
 from . import models_pb2 as pb
@@ -139,7 +140,7 @@ class Thread(BaseModel):
         names = set([])
         for n in db_object.names:
             names.add(n.name)
-        return Thread(db_object.thread_id, db_object.process_id, db_object.tid, db_object.create_time, names)
+        return Thread(db_object.thread_id, db_object.process_id, db_object.create_time, db_object.tid, names)
 
     def process_uuid(self) -> uuid.UUID:
         return self._process_uuid
@@ -154,7 +155,7 @@ class Thread(BaseModel):
         return self._names
 
     def to_pb(self):
-        return pb.Thread(uuid=str(self.uuid()), process_uuid=str(self.process_uuid()), create_time=self.create_time(), names=list(self.names()))
+        return pb.Thread(uuid=str(self.uuid()), process_uuid=str(self.process_uuid()), create_time=self.create_time(), tid=self.tid(), names=list(self.names()))
         
 class Mapping(BaseModel):
     def __init__(self, uuid: uuid.UUID, process_uuid: uuid.UUID, name: str, path: str, base_uuid: uuid.UUID, size: int, first_seen_execution_offset: int, last_seen_execution_offset: int):
@@ -300,50 +301,73 @@ class ThreadSlice(BaseModel):
     def to_pb(self):
         return pb.ThreadSlice(uuid=str(self.uuid()), thread_uuid=str(self.thread_uuid()), start_execution_offset=self.start_execution_offset(), end_execution_offset=self.end_execution_offset())
 
+_UNSIGNED_ARGUMENT_TYPES = {_db_models.ArgType.POINTER, _db_models.ArgType.UNSIGNED_64, _db_models.ArgType.UNSIGNED_32, _db_models.ArgType.UNSIGNED_16}
+
+def _argument_from_db(name: str, argument_type: _db_models.ArgType, value: Optional[str], int_value: Optional[int] = None, bytes_value: Optional[bytes] = None) -> Dict[str, Union[str, int, bytes, bool]]:
+    # Arguments written before the typed columns existed (and not migrated yet) only have the text value
+    arg = {'name': name, 'pointer': False}
+    if int_value is not None and int_value < 0 and argument_type in _UNSIGNED_ARGUMENT_TYPES:
+        int_value += 1 << 64 # wrapped around to fit a signed 64 bit column, see _db_models.ArgumentInteger
+
+    if argument_type == _db_models.ArgType.STRING:
+        arg['value'] = value
+        arg['type'] = 'string'
+
+    elif argument_type == _db_models.ArgType.POINTER:
+        arg['pointer'] = True
+        arg['type'] = 'pointer'
+        arg['value'] = int_value if int_value is not None else int(value, 16) # XXX: text is a hex string
+
+    elif argument_type == _db_models.ArgType.BYTES:
+        # text is the repr of the bytes without the leading 'b"' and the trailing '"'
+        arg['value'] = bytes_value if bytes_value is not None else codecs.escape_decode(value)[0]
+        arg['type'] = 'bytes'
+    else:
+        arg['value'] = int_value if int_value is not None else int(value) # text is a dec string
+
+    if argument_type == _db_models.ArgType.UNSIGNED_64:
+        arg['type'] = 'unsigned64'
+    elif argument_type == _db_models.ArgType.SIGNED_64:
+        arg['type'] = 'signed64'
+    elif argument_type == _db_models.ArgType.UNSIGNED_32:
+        arg['type'] = 'unsigned32'
+    elif argument_type == _db_models.ArgType.SIGNED_32:
+        arg['type'] = 'signed32'
+    elif argument_type == _db_models.ArgType.UNSIGNED_16:
+        arg['type'] = 'unsigned16'
+    elif argument_type == _db_models.ArgType.SIGNED_16:
+        arg['type'] = 'signed16'
+
+    return arg
+
+_PB_ARGUMENT_TYPES = {
+    'string': pb.ArgumentType.STRING,
+    'pointer': pb.ArgumentType.POINTER,
+    'unsigned64': pb.ArgumentType.UNSIGNED_64,
+    'signed64': pb.ArgumentType.SIGNED_64,
+    'unsigned32': pb.ArgumentType.UNSIGNED_32,
+    'signed32': pb.ArgumentType.SIGNED_32,
+    'unsigned16': pb.ArgumentType.UNSIGNED_16,
+    'signed16': pb.ArgumentType.SIGNED_16,
+    'bytes': pb.ArgumentType.BYTES,
+}
+
 class Syscall(BaseModel):
-    def __init__(self, uuid: uuid.UUID, thread_uuid: uuid.UUID, name: str, arguments: List[Dict[str, Union[str, int, bool]]], execution_offset: int, pc: int):
+    def __init__(self, uuid: uuid.UUID, thread_uuid: uuid.UUID, name: str, arguments: List[Dict[str, Union[str, int, bool]]], execution_offset: int, pc: int, retval: Optional[int] = None):
         super().__init__(uuid)
         self._thread_uuid = thread_uuid
         self._name = name
         self._arguments = arguments
         self._execution_offset = execution_offset
         self._pc = pc
+        self._retval = retval
 
     def _from_db(db_object: _db_models.Syscall) -> 'Syscall':
         arguments = []
         for a in db_object.arguments:
-            arg = {'name': a.name, 'pointer': False}
-            if a.argument_type == _db_models.ArgType.STRING:
-                arg['value'] = a.value
-                arg['type'] = 'string'
-
-            elif a.argument_type == _db_models.ArgType.POINTER:
-                arg['pointer'] = True
-                arg['type'] = 'pointer'
-                arg['value'] = int(a.value, 16) # XXX: stored as a hex string
-
-            elif a.argument_type == _db_models.ArgType.BYTES:
-                arg['value'] = a.value # DB-safe value
-                arg['type'] = 'bytes'
-            else:
-                arg['value'] = int(a.value) # Stored as a dec string
-
-            if a.argument_type == _db_models.ArgType.UNSIGNED_64:
-                arg['type'] = 'unsigned64'
-            elif a.argument_type == _db_models.ArgType.SIGNED_64:
-                arg['type'] = 'signed64'
-            elif a.argument_type == _db_models.ArgType.UNSIGNED_32:
-                arg['type'] = 'unsigned32'
-            elif a.argument_type == _db_models.ArgType.SIGNED_32:
-                arg['type'] = 'signed32'
-            elif a.argument_type == _db_models.ArgType.UNSIGNED_16:
-                arg['type'] = 'unsigned16'
-            elif a.argument_type == _db_models.ArgType.SIGNED_16:
-                arg['type'] = 'signed16'                                                                
-
-            arguments.append(arg)
-        
-        return Syscall(db_object.syscall_id, db_object.thread_id, db_object.name, arguments, db_object.execution_offset, db_object.pc)
+            arguments.append(_argument_from_db(a.name, a.argument_type, a.value, a.int_value, a.bytes_value))
+
+        return Syscall(db_object.syscall_id, db_object.thread_id, db_object.name, arguments, db_object.execution_offset, db_object.pc, db_object.retval)
     
     def thread_uuid(self) -> uuid.UUID:
         return self._thread_uuid
@@ -360,26 +384,21 @@ class Syscall(BaseModel):
     def pc(self) -> int:
         return self._pc
 
+    def retval(self) -> Optional[int]:
+        return self._retval
+
     def to_pb(self):
         pb_args = []
         for a in self.arguments():
+            pb_type = _PB_ARGUMENT_TYPES[a['type']]
             if a['type'] == 'string':
-                pb_args.append(pb.SyscallArgument(name=a['name'], type=pb.ArgumentType.STRING, string_value=a['value']))
+                pb_args.append(pb.SyscallArgument(name=a['name'], type=pb_type, string_value=a['value']))
+            elif a['type'] == 'bytes':
+                pb_args.append(pb.SyscallArgument(name=a['name'], type=pb_type, bytes_value=a['value']))
             else:
-                pb_type = None
-                if a['type'] == 'pointer':
-                    pb_type = pb.ArgumentType.POINTER
-                elif a['type'] == 'unsigned64':
-                    pb_type = pb.ArgumentType.UNSIGNED_64
-                elif a['type'] == 'signed64':
-                    pb_type = pb.ArgumentType.SIGNED_64
-                elif a['type'] == 'unsigned32':
-                    pb_type = pb.ArgumentType.UNSIGNED_32
-                elif a['type'] == 'signed32':
-                    pb_type = pb.ArgumentType.SIGNED_32
-                elif a['type'] == 'unsigned16':
-                    pb_type = pb.ArgumentType.UNSIGNED_16
-                elif a['type'] == 'signed16':
-                    pb_type = pb.ArgumentType.SIGNED_16
-                pb_args.append(pb.SyscallArgument(name=a['name'], type=pb_type, number_value=a['value']))                                                                                      
-        return pb.Syscall(uuid=str(self.uuid()), name=self.name(), arguments=pb_args, thread_uuid=str(self.thread_uuid()), execution_offset=self.execution_offset())
+                # signed values as their 64 bit two's complement
+                pb_args.append(pb.SyscallArgument(name=a['name'], type=pb_type, pointer=a['type'] == 'pointer', number_value=a['value'] & ((1 << 64) - 1)))
+        syscall = pb.Syscall(uuid=str(self.uuid()), name=self.name(), arguments=pb_args, thread_uuid=str(self.thread_uuid()), execution_offset=self.execution_offset(), pc=self.pc())
+        if self.retval() is not None:
+            syscall.retval = self.retval()
+        return syscall
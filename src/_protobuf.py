@@ -0,0 +1,171 @@
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+from . import _db_models
+from . import _models
+from . import models_pb2 as pb
+import uuid
+
+# stored _db_models.ArgType name -> pb.ArgumentType, the names are the same
+ARGUMENT_TYPES = {t.name: pb.ArgumentType.Value(t.name) for t in _db_models.ArgType}
+
+_UINT64_MASK = (1 << 64) - 1
+
+def guid_string(raw: Any) -> str:
+    '''
+    A GUID column as the database driver returns it (see api._raw) in the form str(uuid.UUID) gives, without
+    building the uuid.UUID: 32 hex digits on SQLite, 16 bytes with compact_guids and already a string on PostgreSQL
+    '''
+    if isinstance(raw, bytes):
+        raw = raw.hex()
+    elif isinstance(raw, uuid.UUID):
+        return str(raw)
+    if len(raw) == 32:
+        return '{}-{}-{}-{}-{}'.format(raw[:8], raw[8:12], raw[12:16], raw[16:20], raw[20:])
+    return raw
+
+class GuidStrings(dict):
+    '''
+    guid_string of raw keys that repeat (threads, code points), converted once each
+    '''
+    def __missing__(self, raw: Any) -> str:
+        s = self[raw] = guid_string(raw)
+        return s
+
+def add_argument(arguments, name: Optional[str], db_type: str, value: Optional[str], int_value: Optional[int], bytes_value: Optional[bytes]) -> None:
+    '''
+    Append one syscall_arguments row to the repeated SyscallArgument field arguments. db_type is the stored
+    _db_models.ArgType name.
+    '''
+    pb_type = ARGUMENT_TYPES[db_type]
+    a = arguments.add(type=pb_type, pointer=pb_type == pb.POINTER)
+    if name is not None:
+        a.name = name
+    if pb_type == pb.STRING:
+        a.string_value = value
+        return
+    if value is not None:
+        # written before the typed columns existed and not migrated, the value is only in the text column
+        v = _models._argument_from_db(name, _db_models.ArgType[db_type], value)['value']
+        if pb_type == pb.BYTES:
+            bytes_value = v
+        else:
+            int_value = v
+    if pb_type == pb.BYTES:
+        a.bytes_value = bytes_value
+    else:
+        a.number_value = int_value & _UINT64_MASK
+
+def syscall_batches(batches: Iterable[List[Tuple]], message_type: Any = pb.SyscallBatch, field: str = 'syscalls') -> Iterator[Any]:
+    '''
+    One message_type per batch of api._syscalls_with_arguments rows of (syscall_id, thread_id, name, retval, pc,
+    execution_offset, arguments...), with ids as the driver returns them, filled into its repeated Syscall field
+    '''
+    threads = GuidStrings()
+    for rows in batches:
+        batch = message_type()
+        add = getattr(batch, field).add
+        for row in rows:
+            s = add(uuid=guid_string(row[0]), thread_uuid=threads[row[1]], name=row[2], execution_offset=row[5])
+            if row[3] is not None:
+                s.retval = row[3]
+            if row[4] is not None:
+                s.pc = row[4]
+            arguments = s.arguments
+            for first in range(6, len(row), 5):
+                if row[first + 1] is None:
+                    break
+                add_argument(arguments, *row[first:first + 5])
+        yield batch
+
+def taintflow_batches(batches: Iterable[List[Tuple]], message_type: Any = pb.TaintFlowBatch, field: str = 'taint_flows') -> Iterator[Any]:
+    '''
+    One message_type per batch of (taint_flow_id, is_store, source_id, source_thread_id, source_execution_offset, sink_id,
+    sink_thread_id, sink_execution_offset) rows, filled into its repeated TaintFlow field
+    '''
+    ids = GuidStrings()
+    for rows in batches:
+        batch = message_type()
+        add = getattr(batch, field).add
+        for (flow_id, is_store, source, source_thread, source_offset, sink, sink_thread, sink_offset) in rows:
+            add(uuid=guid_string(flow_id), is_store=is_store, source_code_point_uuid=ids[source], source_thread_uuid=ids[source_thread],
+                source_execution_offset=source_offset, sink_code_point_uuid=ids[sink], sink_thread_uuid=ids[sink_thread], sink_execution_offset=sink_offset)
+        yield batch
+
+def threadslice_batches(batches: Iterable[List[Tuple]], message_type: Any = pb.ThreadSliceBatch, field: str = 'thread_slices') -> Iterator[Any]:
+    '''
+    One message_type per batch of (threadslice_id, thread_id, start_execution_offset, end_execution_offset) rows,
+    filled into its repeated ThreadSlice field
+    '''
+    threads = GuidStrings()
+    for rows in batches:
+        batch = message_type()
+        add = getattr(batch, field).add
+        for (slice_id, thread, start, end) in rows:
+            add(uuid=guid_string(slice_id), thread_uuid=threads[thread], start_execution_offset=start, end_execution_offset=end)
+        yield batch
+
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+def write_delimited(stream, messages: Iterable[Any]) -> int:
+    '''
+    Write protobuf messages to stream, each prefixed with its length as a varint (the framing of Java's
+    writeDelimitedTo and C++'s SerializeDelimitedToOstream). stream is a binary file object or a socket.
+    Returns the number of bytes written.
+    '''
+    write = getattr(stream, 'write', None) or stream.sendall
+    written = 0
+    for message in messages:
+        data = message.SerializeToString()
+        frame = _varint(len(data)) + data
+        write(frame)
+        written += len(frame)
+    return written
+
+def _read_exactly(read, size: int) -> bytes:
+    chunks = []
+    while size > 0:
+        chunk = read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+def read_delimited(stream, message_type) -> Iterator[Any]:
+    '''
+    Read the messages write_delimited wrote to stream (a binary file object or a socket) as message_type,
+    e.g. models_pb2.SyscallBatch, until the end of the stream
+    '''
+    read = getattr(stream, 'read', None) or stream.recv
+    while True:
+        size = shift = 0
+        while True:
+            b = read(1)
+            if not b:
+                if shift == 0:
+                    return
+                raise Exception("Truncated length-delimited message stream")
+            size |= (b[0] & 0x7f) << shift
+            shift += 7
+            if b[0] < 0x80:
+                break
+        data = _read_exactly(read, size)
+        if len(data) < size:
+            raise Exception("Truncated length-delimited message stream")
+        message = message_type()
+        message.ParseFromString(data)
+        yield message
+
+def read_execution_dump(stream) -> pb.ExecutionDump:
+    '''
+    Read the parts PandaDatastore.write_execution_dump wrote to stream back into one ExecutionDump
+    '''
+    dump = pb.ExecutionDump()
+    for part in read_delimited(stream, pb.ExecutionDump):
+        dump.MergeFrom(part)
+    return dump
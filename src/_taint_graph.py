@@ -0,0 +1,131 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class TaintGraph:
+    '''
+    The taint flows of an execution as a directed graph of code points over time, for reachability
+    queries that respect the order in which the flows happened.
+
+    Code points are numbered 0..n-1 in the order they are first seen and the flows are kept twice in
+    CSR form: grouped by source code point and sorted by source execution offset within a group
+    (out_*), and grouped by sink code point and sorted by sink execution offset (in_*). The edges of
+    code point v are out_*[out_start[v]:out_start[v + 1]]. Every array is an array('q'), 8 bytes per
+    entry, so a flow costs 48 bytes however many there are.
+    '''
+    def __init__(self, flows: Iterable[Tuple[Any, int, Any, int]], convert_key: Callable[[Any], Any] = None):
+        '''
+        flows is an iterable of (source code point, source execution offset, sink code point, sink execution offset).
+        Code points can be any hashable key (the datastore uses code point uuids) and are what queries return.
+        convert_key is applied once per distinct code point after loading, e.g. to turn raw database keys into uuids
+        without paying for the conversion on every flow.
+        '''
+        self.code_points: List[Any] = []
+        self._ids: Dict[Any, int] = {}
+        sources, source_offsets, sinks, sink_offsets = array('q'), array('q'), array('q'), array('q')
+        ids, code_points = self._ids, self.code_points
+        for (source, source_offset, sink, sink_offset) in flows:
+            for key, column in ((source, sources), (sink, sinks)):
+                i = ids.get(key)
+                if i is None:
+                    i = ids[key] = len(code_points)
+                    code_points.append(key)
+                column.append(i)
+            source_offsets.append(source_offset)
+            sink_offsets.append(sink_offset)
+        if convert_key is not None:
+            self.code_points = [convert_key(key) for key in code_points]
+            self._ids = {key: i for i, key in enumerate(self.code_points)}
+
+        self.out_start, (self.out_offset, self.out_sink, self.out_sink_offset) = \
+            _csr(len(code_points), sources, source_offsets, sinks, sink_offsets)
+        self.in_start, (self.in_offset, self.in_source, self.in_source_offset) = \
+            _csr(len(code_points), sinks, sink_offsets, sources, source_offsets)
+
+    def __len__(self) -> int:
+        return len(self.out_sink)
+
+    def downstream(self, code_point: Any, after_offset: int) -> Dict[Any, int]:
+        '''
+        Everything tainted downstream of code_point by flows out of it at or after after_offset: a flow out of a
+        reached code point only counts if it happened at or after the code point was reached. Returns the earliest
+        execution offset each reached code point was tainted at. code_point itself is only included if a chain of
+        flows leads back to it.
+        '''
+        start = self._ids.get(code_point)
+        if start is None:
+            return {}
+        return self._reach(start, after_offset, True)
+
+    def upstream(self, code_point: Any, before_offset: int) -> Dict[Any, int]:
+        '''
+        The reverse of downstream: every code point whose data could have reached code_point by flows into it at or
+        before before_offset, with the latest execution offset each one's data left it on such a chain.
+        '''
+        start = self._ids.get(code_point)
+        if start is None:
+            return {}
+        return self._reach(start, before_offset, False)
+
+    def _reach(self, start: int, offset: int, forward: bool) -> Dict[Any, int]:
+        # Label correcting BFS over (code point, best time reached). Going forward the usable flows out of a code point
+        # reached at t are the suffix of its group with offset >= t, going backward the prefix with offset <= t. scanned
+        # remembers how much of each group has been relaxed, so reaching a code point again at a better time only scans
+        # the flows that became usable and every flow is looked at once per query.
+        if forward:
+            starts, offsets, targets, times = self.out_start, self.out_offset, self.out_sink, self.out_sink_offset
+        else:
+            starts, offsets, targets, times = self.in_start, self.in_offset, self.in_source, self.in_source_offset
+        best: Dict[int, int] = {}
+        scanned: Dict[int, int] = {}
+        queue = deque([(start, offset)])
+        while queue:
+            v, t = queue.popleft()
+            if forward:
+                hi = scanned.get(v, starts[v + 1])
+                lo = bisect_left(offsets, t, starts[v], hi)
+            else:
+                lo = scanned.get(v, starts[v])
+                hi = bisect_right(offsets, t, lo, starts[v + 1])
+            if lo >= hi:
+                continue
+            scanned[v] = lo if forward else hi
+            for e in range(lo, hi):
+                w, arrival = targets[e], times[e]
+                previous = best.get(w)
+                if previous is None or (arrival < previous if forward else arrival > previous):
+                    best[w] = arrival
+                    queue.append((w, arrival))
+        code_points = self.code_points
+        return {code_points[w]: arrival for w, arrival in best.items()}
+
+def _csr(num_nodes: int, groups: array, offsets: array, *columns: array) -> Tuple[array, Tuple[array, ...]]:
+    '''
+    Sort the edges by (group, offset) and return the start of each group's edges (num_nodes + 1 entries)
+    along with offsets and columns in that order
+    '''
+    if np is not None and len(groups) > 0:
+        np_groups = np.frombuffer(groups, dtype=np.int64)
+        order = np.lexsort((np.frombuffer(offsets, dtype=np.int64), np_groups))
+        starts = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(np_groups, minlength=num_nodes), out=starts[1:])
+        return _array(starts), tuple(_array(np.frombuffer(c, dtype=np.int64)[order]) for c in (offsets,) + columns)
+
+    order = sorted(range(len(groups)), key=lambda e: (groups[e], offsets[e]))
+    starts = array('q', bytes(8 * (num_nodes + 1)))
+    for g in groups:
+        starts[g + 1] += 1
+    for v in range(num_nodes):
+        starts[v + 1] += starts[v]
+    return starts, tuple(array('q', (c[e] for e in order)) for c in (offsets,) + columns)
+
+def _array(values) -> array:
+    a = array('q')
+    a.frombytes(values.astype(np.int64).tobytes())
+    return a
@@ -1,10 +1,29 @@
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, selectinload, sessionmaker
+from sqlalchemy import BigInteger, and_, bindparam, case, cast, create_engine, event, func, inspect, or_, select, type_coerce
 from sqlalchemy.pool import Pool
-from typing import List, Union, Dict, Tuple
+from sqlalchemy.sql import sqltypes
+from typing import Any, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Union, Dict, Tuple
+from contextlib import contextmanager
+from . import _columnar
 from . import _db_models
 from . import _models
+from . import _protobuf
+from . import models_pb2 as pb
+from ._mapping_index import IntervalIndex, MappingIndex
+from ._taint_graph import TaintGraph
+from ._bulk_writer import BulkWriter, make_bulk_writer
+from ._execution_stats import ExecutionStatsDelta
+from ._protobuf import read_delimited, read_execution_dump, write_delimited
+import codecs
+import collections
+import threading
 import uuid
+import warnings
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 class SessionTransactionWrapper:
         def __init__(self, session):
@@ -21,58 +40,682 @@ class SessionTransactionWrapper:
                         self.session.commit()
                 self.session.close()
 
-def determine_db_type_val(arg: Dict[str, Union[str, int, bool]]) -> Tuple[_db_models.ArgType, str]:
+class _SessionScope:
+        def __init__(self, session, flush_threshold: int):
+                self.session = session
+                self.flush_threshold = flush_threshold
+                self.pending_rows = 0
+                self.stats = ExecutionStatsDelta()
+                # mappings were written in the scope, see PandaDatastore._mappings_changed
+                self.mappings_changed = False
+
+class IngestCheckpoint(NamedTuple):
+    '''
+    Progress of a resumable ingest: the stage it is in, the next plog chunk it will read,
+    how many syscalls and taint flows it has committed and its own opaque state
+    '''
+    stage: str
+    plog_chunk: int
+    syscalls: int
+    taint_flows: int
+    state: Optional[bytes]
+
+class SummaryStats(NamedTuple):
+    '''
+    How many rows of one kind there are, how many instructions they cover (thread slices only) and
+    the execution offsets they span
+    '''
+    count: int
+    coverage: int
+    min_offset: Optional[int]
+    max_offset: Optional[int]
+
+class ExecutionStats(NamedTuple):
+    '''
+    Summary of an execution, from get_execution_stats. syscalls_by_name and threadslices_by_thread (keyed by
+    thread uuid) break the syscall and thread slice totals down, min_offset and max_offset span everything.
+    by_process has the same summary for each process (with an empty by_process), keyed by process uuid.
+    '''
+    processes: int
+    threads: int
+    mappings: SummaryStats
+    syscalls: SummaryStats
+    syscalls_by_name: Dict[str, SummaryStats]
+    taint_flows: SummaryStats
+    threadslices: SummaryStats
+    threadslices_by_thread: Dict[uuid.UUID, SummaryStats]
+    min_offset: Optional[int]
+    max_offset: Optional[int]
+    by_process: Dict[uuid.UUID, 'ExecutionStats']
+
+_EMPTY_SUMMARY = SummaryStats(0, 0, None, None)
+
+def _lower(a: Optional[int], b: Optional[int]) -> Optional[int]:
+    return b if a is None or (b is not None and b < a) else a
+
+def _upper(a: Optional[int], b: Optional[int]) -> Optional[int]:
+    return b if a is None or (b is not None and b > a) else a
+
+def _merge_summary(summary: SummaryStats, count: int, coverage: int, min_offset: Optional[int], max_offset: Optional[int]) -> SummaryStats:
+    return SummaryStats(summary.count + count, summary.coverage + coverage, _lower(summary.min_offset, min_offset), _upper(summary.max_offset, max_offset))
+
+def _summarize_stats(rows: List[Tuple]) -> ExecutionStats:
+    """
+    Add up execution_stats rows of (process_id, thread_id, kind, name, count, coverage, min_offset, max_offset)
+    """
+    counts = {'process': 0, 'thread': 0}
+    summaries = {'mapping': _EMPTY_SUMMARY, 'syscall': _EMPTY_SUMMARY, 'taint_flow': _EMPTY_SUMMARY, 'threadslice': _EMPTY_SUMMARY}
+    by_name: Dict[str, SummaryStats] = {}
+    by_thread: Dict[uuid.UUID, SummaryStats] = {}
+    for (_, thread_id, kind, name, count, coverage, min_offset, max_offset) in rows:
+        if kind in counts:
+            counts[kind] += count
+        elif kind in summaries:
+            summaries[kind] = _merge_summary(summaries[kind], count, coverage, min_offset, max_offset)
+            if kind == 'syscall':
+                by_name[name] = _merge_summary(by_name.get(name, _EMPTY_SUMMARY), count, coverage, min_offset, max_offset)
+            elif kind == 'threadslice':
+                by_thread[thread_id] = _merge_summary(by_thread.get(thread_id, _EMPTY_SUMMARY), count, coverage, min_offset, max_offset)
+    min_offset = max_offset = None
+    for summary in summaries.values():
+        min_offset = _lower(min_offset, summary.min_offset)
+        max_offset = _upper(max_offset, summary.max_offset)
+    return ExecutionStats(processes=counts['process'], threads=counts['thread'], mappings=summaries['mapping'],
+        syscalls=summaries['syscall'], syscalls_by_name=by_name, taint_flows=summaries['taint_flow'],
+        threadslices=summaries['threadslice'], threadslices_by_thread=by_thread,
+        min_offset=min_offset, max_offset=max_offset, by_process={})
+
+class Snapshot(NamedTuple):
+    '''
+    What existed at one execution offset, from snapshot_at. The thread_uuids and mapping_uuids of each process are the
+    threads and mappings live at the offset, base_addresses has the (asid, address) each mapping is loaded at.
+    '''
+    execution_offset: int
+    processes: List[_models.Process]
+    threads: List[_models.Thread]
+    mappings: List[_models.Mapping]
+    base_addresses: Dict[uuid.UUID, Tuple[int, int]]
+
+class _ExecutionCache:
+    """
+    Least recently used cache of something built from the rows of an execution, at most size executions are kept.
+    With cache=False get neither uses nor keeps an entry, for callers that can see rows other connections can't.
+    """
+    def __init__(self, size: int):
+        self.size = size
+        self._entries: collections.OrderedDict = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    def get(self, execution_uuid: uuid.UUID, build, cache: bool = True):
+        if not cache:
+            return build()
+        with self._lock:
+            if execution_uuid in self._entries:
+                self._entries.move_to_end(execution_uuid)
+                return self._entries[execution_uuid]
+            generation = self._generation
+        value = build()
+        with self._lock:
+            # a clear while it was being built can be for rows the build didn't see
+            if generation == self._generation:
+                self._entries[execution_uuid] = value
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+# Indexes only PostgreSQL can build, (table, index name, what follows ON table). snapshot_at finds the mappings seen at
+# an offset through the GiST index of their seen ranges, other databases get an in memory IntervalIndex instead
+_POSTGRESQL_INDEXES = [
+    ('mappings', 'ix_mappings_seen_range', "USING gist (int8range(first_seen_execution_offset, last_seen_execution_offset, '[]'))"),
+]
+
+def _snapshot_queries(postgresql: bool, materialized: bool):
+    """
+    The statements of PandaDatastore.snapshot_at: first and last offsets of each process (thread_id null) and
+    thread of an execution, its mappings with their base address (on PostgreSQL just the ones seen at b_offset)
+    and the names of a list of threads
+    """
+    stats = _db_models.ExecutionStat.__table__
+    processes = _db_models.Process.__table__
+    threads = _db_models.Thread.__table__
+    thread_names = _db_models.ThreadName.__table__
+    mappings = _db_models.Mapping.__table__
+    addresses = _db_models.VirtualAddress.__table__
+    in_execution = processes.c.execution_id == bindparam('b_execution_id')
+
+    ranges = select([processes.c.process_id, processes.c.create_time, processes.c.pid, processes.c.ppid, threads.c.thread_id, threads.c.create_time, threads.c.tid,
+                     func.min(stats.c.min_offset), func.max(stats.c.max_offset)]) \
+        .select_from(stats.join(processes, stats.c.process_id == processes.c.process_id).outerjoin(threads, stats.c.thread_id == threads.c.thread_id)) \
+        .where(in_execution) \
+        .group_by(processes.c.process_id, processes.c.create_time, processes.c.pid, processes.c.ppid, threads.c.thread_id, threads.c.create_time, threads.c.tid)
+
+    source = mappings
+    if postgresql:
+        # the range lookup goes in a CTE of its own, otherwise the planner tends to repeat it for every process
+        seen = func.int8range(mappings.c.first_seen_execution_offset, mappings.c.last_seen_execution_offset, '[]')
+        source = select([mappings]).where(seen.op('@>')(cast(bindparam('b_offset'), BigInteger))).cte('live_mappings')
+        if materialized:
+            source = source.prefix_with('MATERIALIZED') # before PostgreSQL 12 CTEs always are
+    mapping_query = select([source.c.mapping_id, source.c.process_id, source.c.name, source.c.path, source.c.base_id, source.c.size,
+                            source.c.first_seen_execution_offset, source.c.last_seen_execution_offset, addresses.c.asid, addresses.c.address]) \
+        .select_from(source.join(processes, source.c.process_id == processes.c.process_id).join(addresses, source.c.base_id == addresses.c.address_id)) \
+        .where(in_execution)
+
+    names = select([thread_names.c.thread_id, thread_names.c.name]).where(thread_names.c.thread_id.in_(bindparam('b_thread_ids', expanding=True)))
+    return ranges, mapping_query, names
+
+def _encode_pointer(value: Union[str, int]) -> int:
+    # a string is taken to be hex
+    return int(value, 16) if isinstance(value, str) else value
+
+def _encode_integer(value: Union[str, int]) -> int:
+    return int(value)
+
+def _encode_bytes(value: Union[bytes, str]) -> bytes:
+    # a string is taken to be the repr of the bytes without the leading 'b"' and the trailing '"'
+    return codecs.escape_decode(value)[0] if isinstance(value, str) else bytes(value)
+
+# argument type name -> (db type, syscall_arguments column it's stored in, function that turns a value into what gets stored)
+_ARGUMENT_ENCODERS = {
+    'string':     (_db_models.ArgType.STRING, 'value', str),
+    'pointer':    (_db_models.ArgType.POINTER, 'int_value', _encode_pointer),
+    'unsigned64': (_db_models.ArgType.UNSIGNED_64, 'int_value', _encode_integer),
+    'signed64':   (_db_models.ArgType.SIGNED_64, 'int_value', _encode_integer),
+    'unsigned32': (_db_models.ArgType.UNSIGNED_32, 'int_value', _encode_integer),
+    'signed32':   (_db_models.ArgType.SIGNED_32, 'int_value', _encode_integer),
+    'unsigned16': (_db_models.ArgType.UNSIGNED_16, 'int_value', _encode_integer),
+    'signed16':   (_db_models.ArgType.SIGNED_16, 'int_value', _encode_integer),
+    'bytes':      (_db_models.ArgType.BYTES, 'bytes_value', _encode_bytes),
+}
+
+def _argument_encoder(arg_type: str):
+    try:
+        return _ARGUMENT_ENCODERS[arg_type]
+    except KeyError:
+        raise Exception("Unrecognized Argument Type: " + str(arg_type))
+
+def determine_db_type_val(arg: Dict[str, Union[str, int, bool]]) -> Tuple[_db_models.ArgType, Union[str, int, bytes]]:
     """
     Given an argument dict with fields name, type, and value - identify the correct _db_models
-    type and translate it into that type to be stored.
+    type and translate it into that type to be stored. Strings are stored as text, pointers and
+    numbers as ints and bytes as bytes. Numbers may be given as ints or strings, pointers given
+    as strings must be hex.
 
     Returns a tuple of the db_type and value that can be stored stored
     """
-    db_type = None
-    db_val = str(arg['value']) # actual data that gets stored in DB - overloaded just for bytes
-
-    if arg['type'] == 'string':
-        db_type = _db_models.ArgType.STRING
-    elif arg['type'] == 'pointer':
-        db_type = _db_models.ArgType.POINTER
-    elif arg['type'] == 'unsigned64':
-        db_type = _db_models.ArgType.UNSIGNED_64
-    elif arg['type'] == 'signed64':
-        db_type = _db_models.ArgType.SIGNED_64
-    elif arg['type'] == 'unsigned32':
-        db_type = _db_models.ArgType.UNSIGNED_32
-    elif arg['type'] == 'signed32':
-        db_type = _db_models.ArgType.SIGNED_32
-    elif arg['type'] == 'unsigned16':
-        db_type = _db_models.ArgType.UNSIGNED_16
-    elif arg['type'] == 'signed16':
-        db_type = _db_models.ArgType.SIGNED_16
-    elif arg['type'] == 'bytes':
-        # Bytes is a bit of a pain - we can't store non-null terminated strings in
-        # the database, so we repr it and drop the leading 'b"' and the trailing '"'
-        db_type = _db_models.ArgType.BYTES
-        db_val = repr(arg['value'])[2:-1] # turn b"\x00foo\x00" into \x00foo\x00
-    else:
-        raise Exception("Unrecognized Argument Type: " + str(arg['type']))
-
-    return db_type, db_val
+    db_type, _, encode = _argument_encoder(arg['type'])
+    return db_type, encode(arg['value'])
+
+def encode_arguments(args: Iterable[Dict[str, Union[str, int, bool]]]) -> List[Dict[str, Any]]:
+    """
+    Batch version of determine_db_type_val for all the arguments of a syscall, returns the
+    syscall_arguments columns (everything but syscall_id) of each
+    """
+    encoded = []
+    for position, arg in enumerate(args):
+        db_type, column, encode = _argument_encoder(arg['type'])
+        row = {'name': arg.get('name'), 'position': position, 'argument_type': db_type, 'value': None, 'int_value': None, 'bytes_value': None}
+        row[column] = encode(arg['value'])
+        encoded.append(row)
+    return encoded
+
+def _keyset_pages(conn, query, offset_col, id_col, page_size: int):
+    """
+    Run query a page at a time ordered by (offset_col, id_col), each page starting after the last row of the
+    previous one. Unlike LIMIT/OFFSET every page costs the same no matter how deep into the table it is, and as
+    LIMIT bounds each page it is fetched whole.
+    """
+    last = None
+    while True:
+        q = query
+        if last is not None:
+            q = q.where(or_(offset_col > last[0], and_(offset_col == last[0], id_col > last[1])))
+        rows = conn.execute(q.order_by(offset_col, id_col).limit(page_size)).fetchall()
+        if len(rows) == 0:
+            return
+        yield rows
+        if len(rows) < page_size:
+            return
+        last = (rows[-1][offset_col], rows[-1][id_col])
+
+def _fetch_batches(conn, query, batch_size: int) -> Iterator[List]:
+    """
+    Run query on a streaming cursor and yield its rows batch_size at a time
+    """
+    result = conn.execution_options(stream_results=True).execute(query)
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            return
+        yield rows
+
+def _raw(column):
+    # the column as the database driver returns it, e.g. a GUID without the per row conversion to uuid.UUID
+    return type_coerce(column, sqltypes.NullType).label('raw_' + column.name)
+
+def _syscalls_with_arguments(conn, execution_uuid: uuid.UUID, columns: List) -> Tuple[Any, int]:
+    """
+    A select of columns for the syscalls of an execution ordered by execution offset, one row per syscall followed by
+    the name, type (the stored ArgType name), value, int_value and bytes_value of its argument at each position, null
+    past the end of its arguments. Returns it along with the number of positions, which costs one query.
+    """
+    syscalls = _db_models.Syscall.__table__
+    arguments = _db_models.SyscallArgument.__table__
+    threads = _db_models.Thread.__table__
+    processes = _db_models.Process.__table__
+    source = syscalls.join(threads, syscalls.c.thread_id == threads.c.thread_id).join(processes, threads.c.process_id == processes.c.process_id)
+    in_execution = processes.c.execution_id == execution_uuid
+    num_arguments = conn.execute(select([func.max(arguments.c.position)])
+                                 .select_from(source.join(arguments, arguments.c.syscall_id == syscalls.c.syscall_id)).where(in_execution)).scalar()
+    num_arguments = 0 if num_arguments is None else num_arguments + 1
+    # an outer join of the argument at each position
+    for position in range(num_arguments):
+        a = arguments.alias('arg{}'.format(position))
+        source = source.outerjoin(a, and_(a.c.syscall_id == syscalls.c.syscall_id, a.c.position == position))
+        columns = columns + [a.c.name, type_coerce(a.c.argument_type, sqltypes.NullType), a.c.value, a.c.int_value, a.c.bytes_value]
+    query = select(columns).select_from(source).where(in_execution).order_by(syscalls.c.execution_offset, syscalls.c.syscall_id)
+    return query, num_arguments
+
+def _pb_syscalls_query(conn, execution_uuid: uuid.UUID):
+    # the rows _protobuf.syscall_batches takes
+    syscalls = _db_models.Syscall.__table__
+    columns = [_raw(syscalls.c.syscall_id), _raw(syscalls.c.thread_id), syscalls.c.name, syscalls.c.retval, syscalls.c.pc, syscalls.c.execution_offset]
+    return _syscalls_with_arguments(conn, execution_uuid, columns)[0]
+
+def _pb_taintflows_query(execution_uuid: uuid.UUID):
+    # the rows _protobuf.taintflow_batches takes
+    flows = _db_models.TaintFlow.__table__
+    threads = _db_models.Thread.__table__
+    processes = _db_models.Process.__table__
+    return select([_raw(flows.c.taint_flow_id), flows.c.source_is_store, _raw(flows.c.source_id), _raw(flows.c.source_thread_id), flows.c.source_execution_offset,
+                   _raw(flows.c.sink_id), _raw(flows.c.sink_thread_id), flows.c.sink_execution_offset]) \
+        .select_from(flows.join(threads, flows.c.source_thread_id == threads.c.thread_id).join(processes, threads.c.process_id == processes.c.process_id)) \
+        .where(processes.c.execution_id == execution_uuid).order_by(flows.c.source_execution_offset, flows.c.taint_flow_id)
+
+def _pb_threadslices_query(execution_uuid: uuid.UUID):
+    # the rows _protobuf.threadslice_batches takes
+    slices = _db_models.ThreadSlice.__table__
+    threads = _db_models.Thread.__table__
+    processes = _db_models.Process.__table__
+    return select([_raw(slices.c.threadslice_id), _raw(slices.c.thread_id), slices.c.start_execution_offset, slices.c.end_execution_offset]) \
+        .select_from(slices.join(threads, slices.c.thread_id == threads.c.thread_id).join(processes, threads.c.process_id == processes.c.process_id)) \
+        .where(processes.c.execution_id == execution_uuid).order_by(slices.c.start_execution_offset, slices.c.threadslice_id)
+
+def _execution_dump_header(conn, execution: _models.Execution) -> pb.ExecutionDump:
+    """
+    The first part of an execution dump, with one query each for the processes, threads, thread names, mappings
+    (along with their base addresses) and code points
+    """
+    processes = _db_models.Process.__table__
+    threads = _db_models.Thread.__table__
+    thread_names = _db_models.ThreadName.__table__
+    mappings = _db_models.Mapping.__table__
+    addresses = _db_models.VirtualAddress.__table__
+    code_points = _db_models.CodePoint.__table__
+    in_execution = processes.c.execution_id == execution.uuid()
+    of_threads = threads.join(processes, threads.c.process_id == processes.c.process_id)
+    of_mappings = mappings.join(processes, mappings.c.process_id == processes.c.process_id)
+    guid_string = _protobuf.guid_string
+
+    dump = pb.ExecutionDump(execution=pb.Execution(uuid=str(execution.uuid()), name=execution.name()))
+    if execution.description() is not None:
+        dump.execution.description = execution.description()
+    process_messages = {}
+    for (process_id, pid, ppid, create_time) in conn.execute(select([_raw(processes.c.process_id), processes.c.pid, processes.c.ppid, processes.c.create_time])
+                                                             .where(in_execution).order_by(processes.c.create_time, processes.c.pid)):
+        p = process_messages[process_id] = dump.processes.add(uuid=guid_string(process_id), execution_uuid=dump.execution.uuid, create_time=create_time, pid=pid)
+        if ppid is not None:
+            p.ppid = ppid
+        dump.execution.process_uuids.append(p.uuid)
+
+    names: Dict[Any, List[str]] = {}
+    for (thread_id, name) in conn.execute(select([_raw(thread_names.c.thread_id), thread_names.c.name])
+                                          .select_from(thread_names.join(of_threads, thread_names.c.thread_id == threads.c.thread_id))
+                                          .where(in_execution).order_by(thread_names.c.id)):
+        thread_names_seen = names.setdefault(thread_id, [])
+        if name not in thread_names_seen:
+            thread_names_seen.append(name)
+    for (thread_id, process_id, tid, create_time) in conn.execute(select([_raw(threads.c.thread_id), _raw(threads.c.process_id), threads.c.tid, threads.c.create_time])
+                                                                  .select_from(of_threads).where(in_execution).order_by(threads.c.create_time, threads.c.tid)):
+        p = process_messages[process_id]
+        t = dump.threads.add(uuid=guid_string(thread_id), process_uuid=p.uuid, create_time=create_time, tid=tid, names=names.get(thread_id, []))
+        p.thread_uuids.append(t.uuid)
+
+    base_ids = set()
+    for (mapping_id, process_id, name, path, base_id, size, first, last, address_execution_id, asid, address, execution_offset) in conn.execute(
+            select([_raw(mappings.c.mapping_id), _raw(mappings.c.process_id), mappings.c.name, mappings.c.path, _raw(mappings.c.base_id), mappings.c.size,
+                    mappings.c.first_seen_execution_offset, mappings.c.last_seen_execution_offset,
+                    _raw(addresses.c.execution_id), addresses.c.asid, addresses.c.address, addresses.c.execution_offset])
+            .select_from(of_mappings.join(addresses, mappings.c.base_id == addresses.c.address_id))
+            .where(in_execution).order_by(mappings.c.first_seen_execution_offset, mappings.c.mapping_id)):
+        p = process_messages[process_id]
+        m = dump.mappings.add(uuid=guid_string(mapping_id), process_uuid=p.uuid, base_uuid=guid_string(base_id), size=size,
+                              first_seen_execution_offset=first, last_seen_execution_offset=last)
+        if name is not None:
+            m.name = name
+        if path is not None:
+            m.path = path
+        p.mapping_uuids.append(m.uuid)
+        if base_id not in base_ids:
+            base_ids.add(base_id)
+            dump.virtual_addresses.add(uuid=m.base_uuid, execution_uuid=guid_string(address_execution_id), asid=asid, execution_offset=execution_offset, address=address)
+
+    for (code_point_id, mapping_id, offset) in conn.execute(select([_raw(code_points.c.code_point_id), _raw(code_points.c.mapping_id), code_points.c.offset])
+                                                            .select_from(code_points.join(of_mappings, code_points.c.mapping_id == mappings.c.mapping_id))
+                                                            .where(in_execution).order_by(code_points.c.mapping_id, code_points.c.offset)):
+        dump.code_points.add(uuid=guid_string(code_point_id), mapping_uuid=guid_string(mapping_id), offset=offset)
+    return dump
+
+def _filter_offset_range(query, offset_col, offset_range: Optional[Tuple[int, int]]):
+    if offset_range is not None:
+        query = query.where(offset_col >= offset_range[0]).where(offset_col < offset_range[1])
+    return query
+
+def _with_process_ids(execution_class):
+    """
+    _models.Execution._from_db walks the execution's processes, load them all with one extra SELECT
+    instead of one lazy load per execution
+    """
+    return selectinload(execution_class.processes).load_only('process_id')
+
+def _get_or_create_code_point(session, mapping_id: uuid.UUID, offset: int) -> _db_models.CodePoint:
+    cp = session.query(_db_models.CodePoint).filter(_db_models.CodePoint.mapping_id == mapping_id, _db_models.CodePoint.offset == offset).one_or_none()
+    if cp is None:
+        cp = _db_models.CodePoint(code_point_id=uuid.uuid4(), mapping_id=mapping_id, offset=offset)
+        session.add(cp)
+    return cp
+
+def _find_code_points(conn, keys: Iterable[Tuple[uuid.UUID, int]], batch_size: int = 500) -> Dict[Tuple[uuid.UUID, int], uuid.UUID]:
+    """
+    Look up the ids of existing code points by (mapping_id, offset), a mapping at a time and at most batch_size
+    offsets per query to stay under the bound parameter limits of SQLite
+    """
+    code_points = _db_models.CodePoint.__table__
+    by_mapping: Dict[uuid.UUID, List[int]] = {}
+    for (mapping_id, offset) in keys:
+        by_mapping.setdefault(mapping_id, []).append(offset)
+    found = {}
+    for mapping_id, offsets in by_mapping.items():
+        for start in range(0, len(offsets), batch_size):
+            rows = conn.execute(
+                select([code_points.c.code_point_id, code_points.c.offset])
+                .where(code_points.c.mapping_id == mapping_id)
+                .where(code_points.c.offset.in_(offsets[start:start + batch_size])))
+            for (code_point_id, offset) in rows:
+                found[(mapping_id, offset)] = code_point_id
+    return found
+
+def _write_code_points(writer: BulkWriter, keys: Iterable[Tuple[uuid.UUID, int]], code_point_ids: Dict[Tuple[uuid.UUID, int], uuid.UUID]) -> None:
+    """
+    Fill in code_point_ids for keys, looking up the ones not already known and adding the ones that don't exist to writer
+    """
+    missing = set(key for key in keys if key not in code_point_ids)
+    code_point_ids.update(_find_code_points(writer.connection, missing))
+    for key in missing:
+        if key not in code_point_ids:
+            code_point_ids[key] = writer.add('code_points', mapping_id=key[0], offset=key[1])
+
+def _detect_binary_guids(engine) -> Optional[bool]:
+    """
+    None for a database without the pandelephant tables, otherwise whether its uuids are stored as binary
+    """
+    inspector = inspect(engine)
+    if 'executions' not in inspector.get_table_names():
+        return None
+    for col in inspector.get_columns('executions'):
+        if col['name'] == 'execution_id':
+            return isinstance(col['type'], sqltypes._Binary)
+    return None
+
+def _add_typed_argument_columns(engine, defer_indexes: bool) -> None:
+    """
+    Databases created before syscall_arguments had int_value and bytes_value get the (empty) columns added, along
+    with their index unless indexes are deferred. PandaDatastore.migrate_syscall_arguments moves the old text values over
+    """
+    table = _db_models.SyscallArgument.__table__
+    existing = set(col['name'] for col in inspect(engine).get_columns(table.name))
+    missing = [col for col in (table.c.int_value, table.c.bytes_value) if col.name not in existing]
+    if not missing:
+        return
+    with engine.begin() as conn:
+        for col in missing:
+            conn.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table.name, col.name, col.type.compile(dialect=engine.dialect)))
+    if not defer_indexes:
+        for index in table.indexes:
+            if any(col.name in index.columns for col in missing):
+                index.create(bind=engine)
+
+class StatementCounter:
+    """
+    Counts the SQL statements an engine emits while the counter is active. An executemany counts once.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+        self.statements: List[str] = []
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._on_execute)
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        event.remove(self.engine, 'before_cursor_execute', self._on_execute)
 
 class PandaDatastore:
-    def __init__(self, url:str, debug:bool = False, pool:Pool = None):
+    def __init__(self, url:str, debug:bool = False, pool:Pool = None, defer_indexes:bool = False, compact_guids:bool = False):
+        '''
+        With defer_indexes the secondary indexes are dropped after the tables are created, so a bulk load doesn't
+        have to maintain them row by row. Call create_indexes once the load is done.
+
+        compact_guids makes a new database store its uuid keys as 16 byte binary instead of 32 character hex strings
+        (PostgreSQL always uses its native UUID type). An existing database keeps the storage it was created with.
+        '''
         engine = create_engine(url, echo=debug, poolclass=pool)
+        if engine.dialect.name != 'postgresql':
+            existing = _detect_binary_guids(engine)
+            if compact_guids and existing is False:
+                raise Exception("compact_guids requested, but this database already stores uuids as hex strings")
+            setattr(engine.dialect, _db_models.BINARY_GUIDS, compact_guids if existing is None else existing)
+        self.engine = engine
         self.session_maker = sessionmaker(bind=engine)
+        self._local = threading.local()
+        self._seen_ranges = _ExecutionCache(8)
+        self._address_indexes = _ExecutionCache(8)
+        self._snapshot_queries = None
+        self._compiled_cache: Dict[Any, Any] = {}
         _db_models.Base.metadata.create_all(engine)
+        _add_typed_argument_columns(engine, defer_indexes)
+        if defer_indexes:
+            self.drop_indexes()
+        else:
+            self._create_postgresql_indexes()
+
+    @contextmanager
+    def session_scope(self, flush_threshold: int = 10000) -> Iterator[Session]:
+        '''
+        Context manager making every new_*, get_* and iter_* call in its block (on this thread) share one session
+        and transaction, which is committed when the block exits or rolled back if it raises. Objects created in
+        the block are flushed every flush_threshold rows instead of each call paying for its own commit, and before
+        any read, so reads in the block see what was written earlier in it. Nested scopes join the outermost one.
+        '''
+        if getattr(self._local, 'scope', None) is not None:
+            yield self._local.scope.session
+            return
+        scope = None
+        try:
+            with SessionTransactionWrapper(self.session_maker()) as s:
+                scope = self._local.scope = _SessionScope(s, flush_threshold)
+                try:
+                    yield s
+                    self._write_stats(s, scope.stats)
+                finally:
+                    self._local.scope = None
+        finally:
+            # only now that the scope's mappings are committed (or rolled back) can the indexes be rebuilt from them
+            if scope is not None and scope.mappings_changed:
+                self._mappings_changed()
+
+    batch = session_scope
+
+    @contextmanager
+    def _session(self) -> Iterator[Session]:
+        scope = getattr(self._local, 'scope', None)
+        if scope is not None:
+            yield scope.session
+        else:
+            with SessionTransactionWrapper(self.session_maker()) as s:
+                yield s
+
+    @contextmanager
+    def _reading_session(self) -> Iterator[Session]:
+        '''
+        _session for calls that read through Core statements on s.connection(), which unlike ORM queries don't autoflush.
+        In a session_scope the rows and execution_stats changes added so far are flushed first, so the read sees them.
+        '''
+        scope = getattr(self._local, 'scope', None)
+        if scope is not None:
+            self._write_stats(scope.session, scope.stats)
+            scope.pending_rows = 0
+            yield scope.session
+        else:
+            with SessionTransactionWrapper(self.session_maker()) as s:
+                yield s
+
+    def _track(self, session: Session, rows: int, stats: ExecutionStatsDelta = None) -> None:
+        '''
+        Count rows added to session, flushing once an enclosing session_scope reaches its threshold.
+        Outside a scope the commit at the end of the call flushes them.
+
+        stats are the execution_stats changes the rows make. In a scope they're written along with a flush,
+        otherwise right away.
+        '''
+        scope = getattr(self._local, 'scope', None)
+        if scope is not None:
+            if stats is not None:
+                scope.stats.update(stats)
+            scope.pending_rows += rows
+            if scope.pending_rows >= scope.flush_threshold:
+                self._write_stats(session, scope.stats)
+                scope.pending_rows = 0
+        elif stats is not None:
+            self._write_stats(session, stats)
+
+    def _write_stats(self, session: Session, stats: ExecutionStatsDelta) -> None:
+        # the rows the stats are about have to exist before the stats can reference them
+        session.flush()
+        stats.write(session.connection())
+
+    def _mappings_changed(self) -> None:
+        # Called once mappings written through this datastore are committed: the in memory indexes built from an execution's
+        # mappings are rebuilt the next time they're needed. In a session_scope that's when the scope ends, until then
+        # reads in the scope build their own (see _uncommitted_mappings).
+        scope = getattr(self._local, 'scope', None)
+        if scope is not None:
+            scope.mappings_changed = True
+            return
+        self._seen_ranges.clear()
+        self._address_indexes.clear()
+
+    def _uncommitted_mappings(self) -> bool:
+        # this thread's session_scope has written mappings other connections can't see yet, indexes built from them can't be cached
+        scope = getattr(self._local, 'scope', None)
+        return scope is not None and scope.mappings_changed
+
+    def count_statements(self) -> StatementCounter:
+        '''
+        Context manager counting the SQL statements issued inside it, e.g. to catch N+1 query regressions:
+
+            with datastore.count_statements() as counter:
+                datastore.get_executions()
+            assert counter.count <= 2
+        '''
+        return StatementCounter(self.engine)
+
+    def _existing_indexes(self) -> Dict[str, set]:
+        inspector = inspect(self.engine)
+        with warnings.catch_warnings():
+            # the expression indexes of _POSTGRESQL_INDEXES can't be reflected, those are handled on their own
+            warnings.filterwarnings('ignore', 'Skipped unsupported reflection of expression-based index')
+            return {table.name: set(i['name'] for i in inspector.get_indexes(table.name)) for table in _db_models.Base.metadata.sorted_tables}
+
+    def _create_postgresql_indexes(self) -> None:
+        if self.engine.dialect.name == 'postgresql':
+            for (table, name, definition) in _POSTGRESQL_INDEXES:
+                self.engine.execute('CREATE INDEX IF NOT EXISTS {} ON {} {}'.format(name, table, definition))
+
+    def create_indexes(self) -> None:
+        '''
+        Build any declared secondary index that doesn't exist yet (e.g. after a load with defer_indexes)
+        '''
+        existing = self._existing_indexes()
+        for table in _db_models.Base.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name not in existing[table.name]:
+                    index.create(bind=self.engine)
+        self._create_postgresql_indexes()
+
+    def drop_indexes(self) -> None:
+        '''
+        Drop the declared secondary indexes. Primary keys and unique constraints are left alone.
+        '''
+        existing = self._existing_indexes()
+        for table in _db_models.Base.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name in existing[table.name]:
+                    index.drop(bind=self.engine)
+        if self.engine.dialect.name == 'postgresql':
+            for (_, name, _) in _POSTGRESQL_INDEXES:
+                self.engine.execute('DROP INDEX IF EXISTS {}'.format(name))
+
+    def migrate_syscall_arguments(self, batch_size: int = 10000) -> int:
+        '''
+        Move the syscall arguments of a database from before the typed columns existed out of the text value column:
+        pointers and numbers to int_value and bytes to bytes_value. Runs in batches of batch_size arguments, each committed
+        on its own (unless in a session_scope), so it can be interrupted and run again. Returns the number of arguments moved.
+        '''
+        table = _db_models.SyscallArgument.__table__
+        query = select([table.c.syscall_argument_id, table.c.name, table.c.argument_type, table.c.value]) \
+            .where(table.c.argument_type != _db_models.ArgType.STRING).where(table.c.value != None) \
+            .order_by(table.c.syscall_argument_id).limit(batch_size)
+        update = table.update().where(table.c.syscall_argument_id == bindparam('b_id')) \
+            .values(value=None, int_value=bindparam('b_int_value'), bytes_value=bindparam('b_bytes_value'))
+        moved = 0
+        last = None
+        while True:
+            with self._session() as s:
+                conn = s.connection()
+                rows = conn.execute(query if last is None else query.where(table.c.syscall_argument_id > last)).fetchall()
+                if not rows:
+                    return moved
+                params = []
+                for (syscall_argument_id, name, argument_type, value) in rows:
+                    arg = _models._argument_from_db(name, argument_type, value)
+                    row = encode_arguments([arg])[0]
+                    params.append({'b_id': syscall_argument_id, 'b_int_value': row['int_value'], 'b_bytes_value': row['bytes_value']})
+                conn.execute(update, params)
+                moved += len(rows)
+                last = rows[-1][0]
 
     def new_execution(self, name: str, description: str = None) -> _models.Execution:
-        with SessionTransactionWrapper(self.session_maker()) as s:
-            e = _db_models.Execution(name=name, description=description)
+        with self._session() as s:
+            e = _db_models.Execution(execution_id=uuid.uuid4(), name=name, description=description, processes=[])
             s.add(e)
-            s.commit()
+            self._track(s, 1)
             return _models.Execution._from_db(e)
 
     def get_executions(self) -> List[_models.Execution]:
-        with SessionTransactionWrapper(self.session_maker()) as s:
-            executions = s.query(_db_models.Execution).all()
+        with self._session() as s:
+            executions = s.query(_db_models.Execution).options(_with_process_ids(_db_models.Execution)).all()
             ret = []
             for e in executions:
                 ret.append(_models.Execution._from_db(e))
@@ -81,29 +724,30 @@ class PandaDatastore:
             return None
 
     def get_execution_by_uuid(self, execution_uuid: uuid.UUID) -> _models.Execution:
-        with SessionTransactionWrapper(self.session_maker()) as s:
-            e = s.query(_db_models.Execution).filter(_db_models.Execution.execution_id == execution_uuid).one_or_none()
+        with self._session() as s:
+            e = s.query(_db_models.Execution).options(_with_process_ids(_db_models.Execution)).filter(_db_models.Execution.execution_id == execution_uuid).one_or_none()
             if e:
                 return _models.Execution._from_db(e)
             return None
 
     def get_execution_by_name(self, name: str) -> _models.Execution:
-        with SessionTransactionWrapper(self.session_maker()) as s:
-            e = s.query(_db_models.Execution).filter(_db_models.Execution.name == name).one_or_none()
+        with self._session() as s:
+            e = s.query(_db_models.Execution).options(_with_process_ids(_db_models.Execution)).filter(_db_models.Execution.name == name).one_or_none()
             if e:
                 return _models.Execution._from_db(e)
             return None
 
     def new_recording(self, name: str, prefix: str, instruction_count: int, log_hash: List[bytes], snapshot_hash: List[bytes], description: str = None, qcow_hash: List[bytes] = None):
-        with SessionTransactionWrapper(self.session_maker()) as s:
-            r = _db_models.Recording(name=name, description=description, prefix=prefix, instruction_count=instruction_count, log_hash=log_hash, snapshot_hash=snapshot_hash, qcow_hash=qcow_hash)
+        with self._session() as s:
+            recording_id = uuid.uuid4()
+            r = _db_models.Recording(execution_id=recording_id, recording_id=recording_id, name=name, description=description, prefix=prefix, instruction_count=instruction_count, log_hash=log_hash, snapshot_hash=snapshot_hash, qcow_hash=qcow_hash, processes=[])
             s.add(r)
-            s.commit()
+            self._track(s, 2)
             return _models.Recording._from_db(r)
 
     def get_recordings(self) -> List[_models.Execution]:
-        with SessionTransactionWrapper(self.session_maker()) as s:
-            recordings = s.query(_db_models.Recording).all()
+        with self._session() as s:
+            recordings = s.query(_db_models.Recording).options(_with_process_ids(_db_models.Recording)).all()
             ret = []
             for e in recordings:
                 ret.append(_models.Recording._from_db(e))
@@ -113,82 +757,786 @@ class PandaDatastore:
             return None
 
     def get_recording_by_uuid(self, recording_uuid: uuid.UUID) -> _models.Recording:
-        with SessionTransactionWrapper(self.session_maker()) as s:
-            r = s.query(_db_models.Recording).filter(_db_models.Recording.recording_id == recording_uuid).one_or_none()
+        with self._session() as s:
+            r = s.query(_db_models.Recording).options(_with_process_ids(_db_models.Recording)).filter(_db_models.Recording.recording_id == recording_uuid).one_or_none()
             if r:
                 return _models.Recording._from_db(r)
             return None
 
     def new_process(self, execution: _models.Execution, create_time: int, pid: int, ppid: int) -> _models.Process:
-        with SessionTransactionWrapper(self.session_maker()) as s:
-            p = _db_models.Process(execution_id=execution.uuid(), create_time=create_time, pid=pid, ppid=ppid)
+        with self._session() as s:
+            p = _db_models.Process(process_id=uuid.uuid4(), execution_id=execution.uuid(), create_time=create_time, pid=pid, ppid=ppid, threads=[], mappings=[])
             s.add(p)
-            s.commit()
+            stats = ExecutionStatsDelta()
+            stats.add(p.process_id, None, 'process')
+            self._track(s, 1, stats)
             return _models.Process._from_db(p)
 
+    def new_processes(self, execution: _models.Execution, processes: List[Tuple[int, int, int]]) -> List[_models.Process]:
+        '''
+        Batch version of new_process, processes is a list of (create_time, pid, ppid). Everything is written in one
+        transaction and the returned Process objects are in the same order as the input.
+        '''
+        ret = []
+        with self.bulk_writer() as writer:
+            for (create_time, pid, ppid) in processes:
+                process_id = writer.add('processes', execution_id=execution.uuid(), create_time=create_time, pid=pid, ppid=ppid)
+                writer.stats.add(process_id, None, 'process')
+                ret.append(_models.Process(process_id, execution.uuid(), create_time, pid, ppid, set(), set()))
+        return ret
+
     def new_thread(self, process: _models.Process, create_time: int, tid: int, names: List[str]) -> _models.Thread:
-        with SessionTransactionWrapper(self.session_maker()) as s:
+        with self._session() as s:
             db_names = []
             for n in names:
                 db_names.append(_db_models.ThreadName(name=n))
-            t = _db_models.Thread(process_id=process.uuid(), create_time=create_time, tid=tid, names=db_names)
+            t = _db_models.Thread(thread_id=uuid.uuid4(), process_id=process.uuid(), create_time=create_time, tid=tid, names=db_names)
             s.add(t)
-            s.commit()
+            stats = ExecutionStatsDelta()
+            stats.add(process.uuid(), t.thread_id, 'thread')
+            self._track(s, 1 + len(db_names), stats)
             return _models.Thread._from_db(t)
 
+    def new_threads(self, threads: List[Tuple[_models.Process, int, int, List[str]]]) -> List[_models.Thread]:
+        '''
+        Batch version of new_thread, threads is a list of (process, create_time, tid, names). Everything is written in one
+        transaction and the returned Thread objects are in the same order as the input.
+        '''
+        ret = []
+        with self.bulk_writer() as writer:
+            for (process, create_time, tid, names) in threads:
+                thread_id = writer.add('threads', process_id=process.uuid(), create_time=create_time, tid=tid)
+                writer.stats.add(process.uuid(), thread_id, 'thread')
+                for n in names:
+                    writer.add('thread_names', thread_id=thread_id, name=n)
+                ret.append(_models.Thread(thread_id, process.uuid(), create_time, tid, set(names)))
+        return ret
+
+    def set_process_create_time(self, process: _models.Process, create_time: int) -> None:
+        with self._session() as s:
+            s.query(_db_models.Process).filter(_db_models.Process.process_id == process.uuid()).update({'create_time': create_time}, synchronize_session=False)
+            self._track(s, 1)
+
+    def add_thread_names(self, thread: _models.Thread, names: List[str]) -> None:
+        '''
+        Add names to a thread that already exists, e.g. names that turned up after the thread was written
+        '''
+        with self._session() as s:
+            s.add_all([_db_models.ThreadName(thread_id=thread.uuid(), name=n) for n in names])
+            self._track(s, len(names))
+
     def new_mapping(self, process: _models.Process, name: str, path: str, asid: int, address: int, execution_offset: int, size: int, first_seen_execution_offset: int, last_seen_execution_offset: int) -> _models.Mapping:
-        with SessionTransactionWrapper(self.session_maker()) as s:
-            base_addr = _db_models.VirtualAddress(execution_id=process.execution_uuid(), asid=asid, address=address, execution_offset=execution_offset)
+        with self._session() as s:
+            base_addr = _db_models.VirtualAddress(address_id=uuid.uuid4(), execution_id=process.execution_uuid(), asid=asid, address=address, execution_offset=execution_offset)
             s.add(base_addr)
-            mapping = _db_models.Mapping(process_id=process.uuid(), name=name, path=path, base=base_addr, size=size, first_seen_execution_offset=first_seen_execution_offset, last_seen_execution_offset=last_seen_execution_offset)
+            mapping = _db_models.Mapping(mapping_id=uuid.uuid4(), process_id=process.uuid(), name=name, path=path, base_id=base_addr.address_id, size=size, first_seen_execution_offset=first_seen_execution_offset, last_seen_execution_offset=last_seen_execution_offset)
             s.add(mapping)
-            s.commit()
-            return _models.Mapping._from_db(mapping)
+            stats = ExecutionStatsDelta()
+            stats.add(process.uuid(), None, 'mapping', min_offset=first_seen_execution_offset, max_offset=last_seen_execution_offset)
+            self._track(s, 2, stats)
+            ret = _models.Mapping._from_db(mapping)
+        self._mappings_changed()
+        return ret
     
+    def new_mappings(self, mappings: List[Tuple[_models.Process, str, str, int, int, int, int, int, int]]) -> List[_models.Mapping]:
+        '''
+        Batch version of new_mapping, mappings is a list of (process, name, path, asid, address, execution_offset, size,
+        first_seen_execution_offset, last_seen_execution_offset). Everything is written in one transaction and the
+        returned Mapping objects are in the same order as the input.
+        '''
+        ret = []
+        with self.bulk_writer() as writer:
+            for (process, name, path, asid, address, execution_offset, size, first_seen_execution_offset, last_seen_execution_offset) in mappings:
+                base_id = writer.add('virtual_addresses', execution_id=process.execution_uuid(), asid=asid, address=address, execution_offset=execution_offset)
+                mapping_id = writer.add('mappings', process_id=process.uuid(), name=name, path=path, base_id=base_id, size=size, first_seen_execution_offset=first_seen_execution_offset, last_seen_execution_offset=last_seen_execution_offset)
+                writer.stats.add(process.uuid(), None, 'mapping', min_offset=first_seen_execution_offset, max_offset=last_seen_execution_offset)
+                ret.append(_models.Mapping(mapping_id, process.uuid(), name, path, base_id, size, first_seen_execution_offset, last_seen_execution_offset))
+        self._mappings_changed()
+        return ret
+
+    def extend_mappings(self, mappings: List[Tuple[_models.Mapping, int, int]]) -> None:
+        '''
+        Widen the seen range of mappings that already exist, mappings is a list of (mapping, first_seen_execution_offset,
+        last_seen_execution_offset). Each end of a range only moves outwards. Everything is one executemany.
+        '''
+        if not mappings:
+            return
+        table = _db_models.Mapping.__table__
+        first, last = table.c.first_seen_execution_offset, table.c.last_seen_execution_offset
+        update = table.update().where(table.c.mapping_id == bindparam('b_mapping_id')).values(
+            first_seen_execution_offset=case([(first < bindparam('b_first'), first)], else_=bindparam('b_first')),
+            last_seen_execution_offset=case([(last > bindparam('b_last'), last)], else_=bindparam('b_last')))
+        stats = ExecutionStatsDelta()
+        for (m, f, l) in mappings:
+            stats.add(m.process_uuid(), None, 'mapping', count=0, min_offset=f, max_offset=l)
+        with self._session() as s:
+            s.connection().execute(update, [{'b_mapping_id': m.uuid(), 'b_first': f, 'b_last': l} for (m, f, l) in mappings])
+            self._track(s, 0, stats)
+        self._mappings_changed()
+
     def new_taintflow(self, is_store: bool, source_thread: _models.Thread, source_mapping: _models.Mapping, source_offset: int, source_execution_offset: int, sink_thread: _models.Thread, sink_mapping: _models.Mapping, sink_offset: int, sink_execution_offset: int) -> _models.TaintFlow:
-        with SessionTransactionWrapper(self.session_maker()) as s:
-            src = _db_models.CodePoint(mapping_id=source_mapping.uuid(), offset=source_offset)
-            s.add(src)
-            sink = _db_models.CodePoint(mapping_id=sink_mapping.uuid(), offset=sink_offset)
-            s.add(sink)
-            taintflow = _db_models.TaintFlow(source_is_store=is_store, source=src, source_thread_id=source_thread.uuid(), sink=sink, sink_thread_id=sink_thread.uuid(), source_execution_offset=source_execution_offset, sink_execution_offset=sink_execution_offset)
+        with self._session() as s:
+            src = _get_or_create_code_point(s, source_mapping.uuid(), source_offset)
+            sink = _get_or_create_code_point(s, sink_mapping.uuid(), sink_offset)
+            taintflow = _db_models.TaintFlow(taint_flow_id=uuid.uuid4(), source_is_store=is_store, source_id=src.code_point_id, source_thread_id=source_thread.uuid(), sink_id=sink.code_point_id, sink_thread_id=sink_thread.uuid(), source_execution_offset=source_execution_offset, sink_execution_offset=sink_execution_offset)
             s.add(taintflow)
-            s.commit()
+            stats = ExecutionStatsDelta()
+            stats.add(source_thread.process_uuid(), source_thread.uuid(), 'taint_flow',
+                      min_offset=min(source_execution_offset, sink_execution_offset), max_offset=max(source_execution_offset, sink_execution_offset))
+            self._track(s, 3, stats)
             return _models.TaintFlow._from_db(taintflow)
 
+    def new_taintflow_collection(self, taintflows: Iterable[Tuple[bool, _models.Thread, _models.Mapping, int, int, _models.Thread, _models.Mapping, int, int]], chunk_size: int = 10000) -> None:
+        '''
+        Bulk insert a bunch of taint flows, each a tuple of the arguments to new_taintflow. Doesn't return the db objects.
+
+        Each distinct (mapping, offset) code point is written once and reused by every flow that references it,
+        including code points that already exist in the database from an earlier ingest. Flows are processed in
+        chunks of chunk_size so taintflows can be a generator.
+        '''
+        code_point_ids: Dict[Tuple[uuid.UUID, int], uuid.UUID] = {}
+        with self.bulk_writer(chunk_size) as writer:
+            def write_chunk(chunk):
+                keys = set()
+                for (_, _, source_mapping, source_offset, _, _, sink_mapping, sink_offset, _) in chunk:
+                    keys.add((source_mapping.uuid(), source_offset))
+                    keys.add((sink_mapping.uuid(), sink_offset))
+                _write_code_points(writer, keys, code_point_ids)
+
+                for (is_store, source_thread, source_mapping, source_offset, source_execution_offset, sink_thread, sink_mapping, sink_offset, sink_execution_offset) in chunk:
+                    writer.add('taint_flows', source_is_store=is_store,
+                        source_id=code_point_ids[(source_mapping.uuid(), source_offset)], source_thread_id=source_thread.uuid(), source_execution_offset=source_execution_offset,
+                        sink_id=code_point_ids[(sink_mapping.uuid(), sink_offset)], sink_thread_id=sink_thread.uuid(), sink_execution_offset=sink_execution_offset)
+                    writer.stats.add(source_thread.process_uuid(), source_thread.uuid(), 'taint_flow',
+                        min_offset=min(source_execution_offset, sink_execution_offset), max_offset=max(source_execution_offset, sink_execution_offset))
+
+            chunk = []
+            for taintflow in taintflows:
+                chunk.append(taintflow)
+                if len(chunk) >= chunk_size:
+                    write_chunk(chunk)
+                    chunk = []
+            write_chunk(chunk)
+
+    def new_code_points(self, code_points: Iterable[Tuple[_models.Mapping, int]]) -> None:
+        '''
+        Make sure the (mapping, offset) code points exist, writing the ones that don't. new_taintflow_collection
+        does this itself, but when several threads write flows at once creating the code points first keeps
+        them from racing to insert the same one.
+        '''
+        with self.bulk_writer() as writer:
+            _write_code_points(writer, set((mapping.uuid(), offset) for (mapping, offset) in code_points), {})
+
     def new_threadslice(self, thread: _models.Thread, start_execution_offset: int, end_execution_offset: int) -> _models.ThreadSlice:
-        with SessionTransactionWrapper(self.session_maker()) as s:
-            ts = _db_models.ThreadSlice(thread_id=thread.uuid(), start_execution_offset=start_execution_offset, end_execution_offset=end_execution_offset)
+        with self._session() as s:
+            ts = _db_models.ThreadSlice(threadslice_id=uuid.uuid4(), thread_id=thread.uuid(), start_execution_offset=start_execution_offset, end_execution_offset=end_execution_offset)
             s.add(ts)
-            s.commit()
+            stats = ExecutionStatsDelta()
+            stats.add(thread.process_uuid(), thread.uuid(), 'threadslice', coverage=end_execution_offset - start_execution_offset, min_offset=start_execution_offset, max_offset=end_execution_offset)
+            self._track(s, 1, stats)
             return _models.ThreadSlice._from_db(ts)
 
-    def new_syscall_collection(self, syscalls: List[Tuple[_models.Thread, str, int, List[Dict[str, Union[str, int, bool]]], int, int]]) -> None:
+    def new_threadslices(self, threadslices: List[Tuple[_models.Thread, int, int]]) -> List[_models.ThreadSlice]:
+        '''
+        Batch version of new_threadslice, threadslices is a list of (thread, start_execution_offset, end_execution_offset).
+        Everything is written in one transaction and the returned ThreadSlice objects are in the same order as the input.
+        '''
+        ret = []
+        with self.bulk_writer() as writer:
+            for (thread, start_execution_offset, end_execution_offset) in threadslices:
+                threadslice_id = writer.add('threadslice', thread_id=thread.uuid(), start_execution_offset=start_execution_offset, end_execution_offset=end_execution_offset)
+                writer.stats.add(thread.process_uuid(), thread.uuid(), 'threadslice', coverage=end_execution_offset - start_execution_offset, min_offset=start_execution_offset, max_offset=end_execution_offset)
+                ret.append(_models.ThreadSlice(threadslice_id, thread.uuid(), start_execution_offset, end_execution_offset))
+        return ret
+
+    @contextmanager
+    def bulk_writer(self, chunk_size: int = 10000) -> Iterator[BulkWriter]:
+        '''
+        Context manager yielding a BulkWriter that rows for the high-volume tables (syscalls, syscall_arguments,
+        taint_flows, code_points, threadslice and virtual_addresses) can be fed into as they are produced.
+        On PostgreSQL chunks are streamed with COPY FROM STDIN, other databases get Core executemany.
+        Everything written, along with the execution_stats changes added to writer.stats, shares one transaction which
+        is committed when the block exits.
+        '''
+        with self._session() as s:
+            # pending ORM objects of an enclosing session_scope have to exist before rows can reference them
+            s.flush()
+            writer = make_bulk_writer(s.connection(), chunk_size)
+            yield writer
+            writer.flush()
+            writer.stats.write(writer.connection)
+
+    def new_syscall_collection(self, syscalls: Iterable[Tuple[_models.Thread, str, int, List[Dict[str, Union[str, int, bool]]], int, int]], chunk_size: int = 10000) -> None:
         '''
         Bulk insert a bunch of syscalls. Significantly faster than inserting one at a time in a loop, but doesn't return the db object
+
+        Syscall uuids are generated client side so the arguments can reference them without a round trip, and rows go through
+        a bulk_writer in chunks of chunk_size rows. No ORM objects are built and only one chunk is held in memory at a time,
+        so syscalls can be a generator.
+        '''
+        with self.bulk_writer(chunk_size) as writer:
+            for (thread, name, retval, args, execution_offset, pc) in syscalls:
+                syscall_id = writer.add('syscalls', thread_id=thread.uuid(), name=name, retval=retval, execution_offset=execution_offset, pc=pc)
+                writer.stats.add(thread.process_uuid(), thread.uuid(), 'syscall', name, min_offset=execution_offset, max_offset=execution_offset)
+                for row in encode_arguments(args):
+                    writer.add('syscall_arguments', syscall_id=syscall_id, **row)
+
+    def iter_syscalls(self, execution: _models.Execution, thread: _models.Thread = None, name: str = None, offset_range: Tuple[int, int] = None, page_size: int = 500, argument: Tuple[Optional[str], int, Tuple[int, int]] = None) -> Iterator[_models.Syscall]:
+        '''
+        Generator over the syscalls of an execution ordered by execution offset, optionally limited to one thread,
+        one syscall name and start <= execution_offset < end for offset_range=(start, end).
+
+        argument=(argument name, position, (start, end)) limits them to syscalls with a pointer or numeric argument at
+        position with start <= value < end, e.g. argument=(None, 1, (1 << 20, 1 << 64)) with name='sys_mmap' for mmaps of
+        more than 1MB. Arguments written by the plog ingest have no name, None matches those. The lookup is indexed by
+        (name, position, value). On SQLite a range must not span 2**63, see _db_models.ArgumentInteger.
+
+        Rows are read in keyset paginated pages of page_size syscalls (plus one query for their arguments), so a
+        whole recording can be scanned in constant memory.
+        '''
+        syscalls = _db_models.Syscall.__table__
+        arguments = _db_models.SyscallArgument.__table__
+        threads = _db_models.Thread.__table__
+        processes = _db_models.Process.__table__
+        source = syscalls.join(threads, syscalls.c.thread_id == threads.c.thread_id).join(processes, threads.c.process_id == processes.c.process_id)
+        if argument is not None:
+            matches = arguments.alias('matches')
+            source = source.join(matches, matches.c.syscall_id == syscalls.c.syscall_id)
+        query = select([syscalls.c.syscall_id, syscalls.c.thread_id, syscalls.c.name, syscalls.c.execution_offset, syscalls.c.pc, syscalls.c.retval]) \
+            .select_from(source) \
+            .where(processes.c.execution_id == execution.uuid())
+        if thread is not None:
+            query = query.where(syscalls.c.thread_id == thread.uuid())
+        if name is not None:
+            query = query.where(syscalls.c.name == name)
+        query = _filter_offset_range(query, syscalls.c.execution_offset, offset_range)
+        if argument is not None:
+            (arg_name, position, value_range) = argument
+            query = _filter_offset_range(query.where(matches.c.name == arg_name).where(matches.c.position == position), matches.c.int_value, value_range)
+
+        with self._reading_session() as s:
+            conn = s.connection()
+            for page in _keyset_pages(conn, query, syscalls.c.execution_offset, syscalls.c.syscall_id, page_size):
+                page_arguments: Dict[uuid.UUID, List] = {row[syscalls.c.syscall_id]: [] for row in page}
+                argument_rows = conn.execute(
+                    select([arguments.c.syscall_id, arguments.c.name, arguments.c.argument_type, arguments.c.value, arguments.c.int_value, arguments.c.bytes_value])
+                    .where(arguments.c.syscall_id.in_(list(page_arguments.keys())))
+                    .order_by(arguments.c.syscall_id, arguments.c.position))
+                for (syscall_id, arg_name, argument_type, value, int_value, bytes_value) in argument_rows:
+                    page_arguments[syscall_id].append(_models._argument_from_db(arg_name, argument_type, value, int_value, bytes_value))
+                for (syscall_id, thread_id, syscall_name, execution_offset, pc, retval) in page:
+                    yield _models.Syscall(syscall_id, thread_id, syscall_name, page_arguments[syscall_id], execution_offset, pc, retval)
+
+    def iter_taintflows(self, execution: _models.Execution, source_thread: _models.Thread = None, sink_thread: _models.Thread = None, offset_range: Tuple[int, int] = None, page_size: int = 1000) -> Iterator[_models.TaintFlow]:
+        '''
+        Generator over the taint flows of an execution ordered by source execution offset, optionally limited to
+        a source and/or sink thread and start <= source_execution_offset < end for offset_range=(start, end).
+        Reads keyset paginated pages of page_size flows.
         '''
-        syscalls_to_insert = []
-        for (thread, name, retval, args, execution_offset, pc) in syscalls:
-            db_args = []
-            for idx, arg in enumerate(args):
-                db_type, db_val = determine_db_type_val(arg)
-                db_args.append(_db_models.SyscallArgument(name=arg['name'], position=idx, argument_type=db_type, value=db_val))
+        flows = _db_models.TaintFlow.__table__
+        threads = _db_models.Thread.__table__
+        processes = _db_models.Process.__table__
+        query = select([flows.c.taint_flow_id, flows.c.source_is_store, flows.c.source_id, flows.c.source_thread_id, flows.c.source_execution_offset, flows.c.sink_id, flows.c.sink_thread_id, flows.c.sink_execution_offset]) \
+            .select_from(flows.join(threads, flows.c.source_thread_id == threads.c.thread_id).join(processes, threads.c.process_id == processes.c.process_id)) \
+            .where(processes.c.execution_id == execution.uuid())
+        if source_thread is not None:
+            query = query.where(flows.c.source_thread_id == source_thread.uuid())
+        if sink_thread is not None:
+            query = query.where(flows.c.sink_thread_id == sink_thread.uuid())
+        query = _filter_offset_range(query, flows.c.source_execution_offset, offset_range)
 
-            syscall = _db_models.Syscall(thread_id=thread.uuid(), name=name, retval=retval, arguments=db_args, execution_offset=execution_offset, pc=pc)
-            syscalls_to_insert.append(syscall)
+        with self._reading_session() as s:
+            conn = s.connection()
+            for page in _keyset_pages(conn, query, flows.c.source_execution_offset, flows.c.taint_flow_id, page_size):
+                for row in page:
+                    yield _models.TaintFlow(*row)
 
-        with SessionTransactionWrapper(self.session_maker()) as s:
-            #s.bulk_save_objects(syscalls_to_insert) # XXX: Wish we could use this, but then the inserts will (silently!) drop the arguments
-            s.add_all(syscalls_to_insert) # This is about 2-4x slower than bulk_save_bojects, but it actually does insert the args
+    def iter_threadslices(self, execution: _models.Execution, thread: _models.Thread = None, offset_range: Tuple[int, int] = None, page_size: int = 1000) -> Iterator[_models.ThreadSlice]:
+        '''
+        Generator over the thread slices of an execution ordered by start execution offset, optionally limited to one
+        thread and start <= start_execution_offset < end for offset_range=(start, end).
+        Reads keyset paginated pages of page_size slices.
+        '''
+        slices = _db_models.ThreadSlice.__table__
+        threads = _db_models.Thread.__table__
+        processes = _db_models.Process.__table__
+        query = select([slices.c.threadslice_id, slices.c.thread_id, slices.c.start_execution_offset, slices.c.end_execution_offset]) \
+            .select_from(slices.join(threads, slices.c.thread_id == threads.c.thread_id).join(processes, threads.c.process_id == processes.c.process_id)) \
+            .where(processes.c.execution_id == execution.uuid())
+        if thread is not None:
+            query = query.where(slices.c.thread_id == thread.uuid())
+        query = _filter_offset_range(query, slices.c.start_execution_offset, offset_range)
+
+        with self._reading_session() as s:
+            conn = s.connection()
+            for page in _keyset_pages(conn, query, slices.c.start_execution_offset, slices.c.threadslice_id, page_size):
+                for row in page:
+                    yield _models.ThreadSlice(*row)
 
     def new_syscall(self, thread: _models.Thread, name: str, retval: int, args: List[Dict[str, Union[str, int, bool]]], execution_offset: int, pc: int) -> _models.Syscall:
-        with SessionTransactionWrapper(self.session_maker()) as s:
-            db_args = []
-            for idx, arg in enumerate(args):
-                db_type, db_val = determine_db_type_val(arg)
-                
-                db_args.append(_db_models.SyscallArgument(name=arg['name'], position=idx, argument_type=db_type, value=db_val))
-            syscall = _db_models.Syscall(thread_id=thread.uuid(), name=name, retval=retval, arguments=db_args, execution_offset=execution_offset, pc=pc)
+        with self._session() as s:
+            db_args = [_db_models.SyscallArgument(**row) for row in encode_arguments(args)]
+            syscall = _db_models.Syscall(syscall_id=uuid.uuid4(), thread_id=thread.uuid(), name=name, retval=retval, arguments=db_args, execution_offset=execution_offset, pc=pc)
             s.add(syscall)
-            s.commit()
+            stats = ExecutionStatsDelta()
+            stats.add(thread.process_uuid(), thread.uuid(), 'syscall', name, min_offset=execution_offset, max_offset=execution_offset)
+            self._track(s, 1 + len(db_args), stats)
             return _models.Syscall._from_db(syscall)
+
+    def get_execution_stats(self, execution: _models.Execution) -> ExecutionStats:
+        '''
+        Counts and execution offset ranges of everything in an execution, overall and per process, from the
+        execution_stats summary rows (one query over a few rows per thread, no scan of the big tables). The rows are kept
+        up to date by every new_* call, an execution written before they existed needs rebuild_execution_stats once.
+        '''
+        stats = _db_models.ExecutionStat.__table__
+        processes = _db_models.Process.__table__
+        with self._reading_session() as s:
+            rows = s.connection().execute(
+                select([stats.c.process_id, stats.c.thread_id, stats.c.kind, stats.c.name, stats.c.count, stats.c.coverage, stats.c.min_offset, stats.c.max_offset])
+                .select_from(stats.join(processes, stats.c.process_id == processes.c.process_id))
+                .where(processes.c.execution_id == execution.uuid())).fetchall()
+        process_rows: Dict[uuid.UUID, List[Tuple]] = {}
+        for row in rows:
+            process_rows.setdefault(row[0], []).append(row)
+        return _summarize_stats(rows)._replace(by_process={process_id: _summarize_stats(r) for process_id, r in process_rows.items()})
+
+    def rebuild_execution_stats(self, execution: _models.Execution) -> None:
+        '''
+        Recompute an execution's execution_stats rows from its processes, threads, mappings, syscalls, taint flows and
+        thread slices, e.g. for an execution written before the summary rows were maintained
+        '''
+        stats_table = _db_models.ExecutionStat.__table__
+        processes = _db_models.Process.__table__
+        threads = _db_models.Thread.__table__
+        mappings = _db_models.Mapping.__table__
+        syscalls = _db_models.Syscall.__table__
+        flows = _db_models.TaintFlow.__table__
+        slices = _db_models.ThreadSlice.__table__
+        in_execution = processes.c.execution_id == execution.uuid()
+        process_ids = select([processes.c.process_id]).where(in_execution)
+
+        def by_thread(table, thread_col):
+            return table.join(threads, thread_col == threads.c.thread_id).join(processes, threads.c.process_id == processes.c.process_id)
+
+        stats = ExecutionStatsDelta()
+        with self._reading_session() as s:
+            conn = s.connection()
+            conn.execute(stats_table.delete().where(stats_table.c.process_id.in_(process_ids)))
+            for (process_id,) in conn.execute(process_ids):
+                stats.add(process_id, None, 'process')
+            for (process_id, thread_id) in conn.execute(select([threads.c.process_id, threads.c.thread_id]).select_from(threads.join(processes, threads.c.process_id == processes.c.process_id)).where(in_execution)):
+                stats.add(process_id, thread_id, 'thread')
+            for (process_id, count, first, last) in conn.execute(
+                    select([mappings.c.process_id, func.count(), func.min(mappings.c.first_seen_execution_offset), func.max(mappings.c.last_seen_execution_offset)])
+                    .select_from(mappings.join(processes, mappings.c.process_id == processes.c.process_id)).where(in_execution).group_by(mappings.c.process_id)):
+                stats.add(process_id, None, 'mapping', count=count, min_offset=first, max_offset=last)
+            for (process_id, thread_id, name, count, first, last) in conn.execute(
+                    select([threads.c.process_id, syscalls.c.thread_id, syscalls.c.name, func.count(), func.min(syscalls.c.execution_offset), func.max(syscalls.c.execution_offset)])
+                    .select_from(by_thread(syscalls, syscalls.c.thread_id)).where(in_execution).group_by(threads.c.process_id, syscalls.c.thread_id, syscalls.c.name)):
+                stats.add(process_id, thread_id, 'syscall', name, count=count, min_offset=first, max_offset=last)
+            for (process_id, thread_id, count, first_source, first_sink, last_source, last_sink) in conn.execute(
+                    select([threads.c.process_id, flows.c.source_thread_id, func.count(),
+                            func.min(flows.c.source_execution_offset), func.min(flows.c.sink_execution_offset),
+                            func.max(flows.c.source_execution_offset), func.max(flows.c.sink_execution_offset)])
+                    .select_from(by_thread(flows, flows.c.source_thread_id)).where(in_execution).group_by(threads.c.process_id, flows.c.source_thread_id)):
+                stats.add(process_id, thread_id, 'taint_flow', count=count, min_offset=min(first_source, first_sink), max_offset=max(last_source, last_sink))
+            for (process_id, thread_id, count, coverage, first, last) in conn.execute(
+                    select([threads.c.process_id, slices.c.thread_id, func.count(), func.sum(slices.c.end_execution_offset - slices.c.start_execution_offset),
+                            func.min(slices.c.start_execution_offset), func.max(slices.c.end_execution_offset)])
+                    .select_from(by_thread(slices, slices.c.thread_id)).where(in_execution).group_by(threads.c.process_id, slices.c.thread_id)):
+                stats.add(process_id, thread_id, 'threadslice', count=count, coverage=int(coverage), min_offset=first, max_offset=last)
+            stats.write(conn)
+
+    def snapshot_at(self, execution: _models.Execution, execution_offset: int) -> Snapshot:
+        '''
+        The processes, threads and mappings (with where they're loaded) live at execution_offset. A mapping is live between its
+        first and last seen offsets, a thread or process between the first and last offsets in its execution_stats rows.
+
+        On PostgreSQL the mappings are found through a GiST index of their seen ranges. Other databases keep the seen ranges
+        of the last few executions asked about in an IntervalIndex, rebuilt once mappings written through this datastore are
+        committed (and built on every call in a session_scope that wrote mappings, until the scope ends).
+        '''
+        if self._snapshot_queries is None:
+            materialized = self.engine.dialect.name == 'postgresql' and self.engine.dialect.server_version_info >= (12,)
+            self._snapshot_queries = _snapshot_queries(self.engine.dialect.name == 'postgresql', materialized)
+        ranges_query, mapping_query, names_query = self._snapshot_queries
+
+        with self._reading_session() as s:
+            # the statements are built once, so they only have to be compiled once too
+            conn = s.connection().execution_options(compiled_cache=self._compiled_cache)
+            ranges = conn.execute(ranges_query, b_execution_id=execution.uuid()).fetchall()
+            if self.engine.dialect.name == 'postgresql':
+                mapping_rows = conn.execute(mapping_query, b_execution_id=execution.uuid(), b_offset=execution_offset).fetchall()
+            else:
+                def build():
+                    return IntervalIndex((tuple(row), row[6], row[7]) for row in conn.execute(mapping_query, b_execution_id=execution.uuid()))
+                mapping_rows = self._seen_ranges.get(execution.uuid(), build, cache=not self._uncommitted_mappings()).lookup(execution_offset)
+
+            process_rows = {}
+            process_ranges: Dict[uuid.UUID, Tuple[Optional[int], Optional[int]]] = {}
+            live_threads = []
+            for (process_id, create_time, pid, ppid, thread_id, thread_create_time, tid, first, last) in ranges:
+                process_rows[process_id] = (create_time, pid, ppid)
+                lower, upper = process_ranges.get(process_id, (None, None))
+                process_ranges[process_id] = (_lower(lower, first), _upper(upper, last))
+                if thread_id is not None and first is not None and first <= execution_offset <= last:
+                    live_threads.append((thread_id, process_id, thread_create_time, tid))
+
+            names: Dict[uuid.UUID, set] = {thread_id: set() for (thread_id, _, _, _) in live_threads}
+            if names:
+                for (thread_id, name) in conn.execute(names_query, b_thread_ids=list(names.keys())):
+                    names[thread_id].add(name)
+
+        live_processes = {process_id: (set(), set()) for process_id, (first, last) in process_ranges.items()
+                          if first is not None and first <= execution_offset <= last}
+        thread_objects = []
+        for (thread_id, process_id, create_time, tid) in live_threads:
+            if process_id in live_processes:
+                live_processes[process_id][0].add(thread_id)
+            thread_objects.append(_models.Thread(thread_id, process_id, create_time, tid, names[thread_id]))
+        mapping_objects = []
+        base_addresses = {}
+        for (mapping_id, process_id, name, path, base_id, size, first, last, asid, address) in mapping_rows:
+            if process_id in live_processes:
+                live_processes[process_id][1].add(mapping_id)
+            mapping_objects.append(_models.Mapping(mapping_id, process_id, name, path, base_id, size, first, last))
+            base_addresses[mapping_id] = (asid, address)
+        process_objects = [_models.Process(process_id, execution.uuid(), *process_rows[process_id], thread_uuids, mapping_uuids)
+                           for process_id, (thread_uuids, mapping_uuids) in live_processes.items()]
+        return Snapshot(execution_offset, process_objects, thread_objects, mapping_objects, base_addresses)
+
+    def _address_index(self, execution: _models.Execution) -> Dict[int, MappingIndex]:
+        '''
+        A MappingIndex per asid over the mappings of an execution, loaded with one query the first time and then kept in
+        an LRU of the last few executions asked about (rebuilt once mappings written through this datastore are committed,
+        in a session_scope that wrote mappings it's loaded on every call until the scope ends)
+        '''
+        def build():
+            mappings = _db_models.Mapping.__table__
+            processes = _db_models.Process.__table__
+            addresses = _db_models.VirtualAddress.__table__
+            by_asid: Dict[int, List] = {}
+            with self._reading_session() as s:
+                for (mapping_id, process_id, name, path, base_id, size, first, last, asid, address) in s.connection().execute(
+                        select([mappings.c.mapping_id, mappings.c.process_id, mappings.c.name, mappings.c.path, mappings.c.base_id, mappings.c.size,
+                                mappings.c.first_seen_execution_offset, mappings.c.last_seen_execution_offset, addresses.c.asid, addresses.c.address])
+                        .select_from(mappings.join(processes, mappings.c.process_id == processes.c.process_id).join(addresses, mappings.c.base_id == addresses.c.address_id))
+                        .where(processes.c.execution_id == execution.uuid())):
+                    mapping = _models.Mapping(mapping_id, process_id, name, path, base_id, size, first, last)
+                    by_asid.setdefault(asid, []).append((mapping, address, size, first, last))
+            return {asid: MappingIndex(entries) for asid, entries in by_asid.items()}
+        return self._address_indexes.get(execution.uuid(), build, cache=not self._uncommitted_mappings())
+
+    def resolve_address(self, execution: _models.Execution, asid: int, address: int, execution_offset: int) -> Optional[Tuple[_models.Mapping, int]]:
+        '''
+        The mapping covering address in address space asid at execution_offset and the offset of address into it, or None.
+        When several mappings cover it the one first seen most recently wins, the same as the plog ingest.
+        '''
+        index = self._address_index(execution).get(asid)
+        if index is None:
+            return None
+        return index.lookup(address, execution_offset)
+
+    def resolve_addresses(self, execution: _models.Execution, asids: Sequence[int], addresses: Sequence[int], execution_offsets: Sequence[int]) -> List[Optional[Tuple[_models.Mapping, int]]]:
+        '''
+        Batch version of resolve_address, the i-th result is for (asids[i], addresses[i], execution_offsets[i]).
+        Each asid's addresses are looked up together with MappingIndex.lookup_many, grouped with numpy when it is available.
+        '''
+        indexes = self._address_index(execution)
+        results: List[Optional[Tuple[_models.Mapping, int]]] = [None] * len(asids)
+        if np is not None and len(asids) > 0:
+            np_asids = np.asarray(asids, dtype=np.uint64)
+            np_addresses = np.asarray(addresses, dtype=np.uint64)
+            np_offsets = np.asarray(execution_offsets, dtype=np.int64)
+            for asid, index in indexes.items():
+                idxs = np.nonzero(np_asids == asid)[0]
+                if len(idxs) > 0:
+                    index.lookup_many(np_addresses[idxs], np_offsets[idxs], results, idxs)
+            return results
+        by_asid: Dict[int, List[int]] = {}
+        for i, asid in enumerate(asids):
+            by_asid.setdefault(asid, []).append(i)
+        for asid, idxs in by_asid.items():
+            index = indexes.get(asid)
+            if index is None:
+                continue
+            index.lookup_many([addresses[i] for i in idxs], [execution_offsets[i] for i in idxs], results, idxs)
+        return results
+
+    def load_taint_graph(self, execution: _models.Execution, chunk_size: int = 10000) -> TaintGraph:
+        '''
+        Load the taint flows of an execution into a TaintGraph keyed by code point uuid, read with one streaming query
+        chunk_size rows at a time. For executions with more flows than fit in memory use taint_downstream and
+        taint_upstream, which answer the same questions in the database.
+        '''
+        flows = _db_models.TaintFlow.__table__
+        threads = _db_models.Thread.__table__
+        processes = _db_models.Process.__table__
+        # code point ids are read as the raw column values and only turned into uuids once per code point
+        guid = _db_models.GUID()
+        query = select([_raw(flows.c.source_id), flows.c.source_execution_offset, _raw(flows.c.sink_id), flows.c.sink_execution_offset]) \
+            .select_from(flows.join(threads, flows.c.source_thread_id == threads.c.thread_id).join(processes, threads.c.process_id == processes.c.process_id)) \
+            .where(processes.c.execution_id == execution.uuid())
+        with self._reading_session() as s:
+            rows = (row for batch in _fetch_batches(s.connection(), query, chunk_size) for row in batch)
+            return TaintGraph(rows, lambda key: guid.process_result_value(key, self.engine.dialect))
+
+    def taint_downstream(self, code_point_uuid: uuid.UUID, after_offset: int) -> Dict[uuid.UUID, int]:
+        '''
+        TaintGraph.downstream as one recursive query, for graphs that don't fit in memory: the code points tainted by
+        flows out of code_point_uuid at or after after_offset, each with the earliest execution offset it was tainted at
+        '''
+        return self._taint_reach(code_point_uuid, after_offset, True)
+
+    def taint_upstream(self, code_point_uuid: uuid.UUID, before_offset: int) -> Dict[uuid.UUID, int]:
+        '''
+        TaintGraph.upstream as one recursive query: the code points whose data reached code_point_uuid by flows into it
+        at or before before_offset, each with the latest execution offset its data left it at
+        '''
+        return self._taint_reach(code_point_uuid, before_offset, False)
+
+    def _taint_reach(self, code_point_uuid: uuid.UUID, offset: int, forward: bool) -> Dict[uuid.UUID, int]:
+        # The recursive term can't aggregate, so the CTE holds every distinct (code point, time) a chain of flows
+        # reaches (at most one per flow) and the best time per code point is picked at the end. Each step is a lookup
+        # in the (code point, offset) index of taint_flows.
+        flows = _db_models.TaintFlow.__table__
+        if forward:
+            start, start_offset, end, end_offset = flows.c.source_id, flows.c.source_execution_offset, flows.c.sink_id, flows.c.sink_execution_offset
+            usable, best = (lambda t: start_offset >= t), func.min
+        else:
+            start, start_offset, end, end_offset = flows.c.sink_id, flows.c.sink_execution_offset, flows.c.source_id, flows.c.source_execution_offset
+            usable, best = (lambda t: start_offset <= t), func.max
+        reached = select([end.label('code_point_id'), end_offset.label('execution_offset')]) \
+            .where(start == code_point_uuid).where(usable(offset)).cte('reached', recursive=True)
+        reached = reached.union(select([end, end_offset]).select_from(
+            flows.join(reached, and_(start == reached.c.code_point_id, usable(reached.c.execution_offset)))))
+        with self._reading_session() as s:
+            return dict(s.connection().execute(
+                select([reached.c.code_point_id, best(reached.c.execution_offset)]).group_by(reached.c.code_point_id)).fetchall())
+
+    def export_execution(self, execution: _models.Execution, path: str, format: str = 'parquet', batch_size: int = 65536) -> None:
+        '''
+        Write the processes, threads, mappings, thread slices, syscalls (with their arguments flattened into columns) and
+        taint flows of an execution to the directory path, one Parquet (format='parquet') or Arrow IPC (format='arrow')
+        file per table, e.g. for pandas.read_parquet. Rows go from streaming cursors into record batches of batch_size
+        rows without building model objects. Names are dictionary encoded and offsets are int64, see _columnar.schema for
+        the layout. import_execution loads the files back. Needs pyarrow.
+        '''
+        _columnar.require_pyarrow()
+        # an unknown format fails before anything is read
+        _columnar.table_path(path, 'processes', format)
+        processes = _db_models.Process.__table__
+        threads = _db_models.Thread.__table__
+        thread_names = _db_models.ThreadName.__table__
+        mappings = _db_models.Mapping.__table__
+        addresses = _db_models.VirtualAddress.__table__
+        slices = _db_models.ThreadSlice.__table__
+        syscalls = _db_models.Syscall.__table__
+        flows = _db_models.TaintFlow.__table__
+        sources = _db_models.CodePoint.__table__.alias('sources')
+        sinks = _db_models.CodePoint.__table__.alias('sinks')
+        in_execution = processes.c.execution_id == execution.uuid()
+        of_threads = threads.join(processes, threads.c.process_id == processes.c.process_id)
+
+        def write(table, rows, num_arguments=0):
+            writer = _columnar.TableWriter(path, table, format, execution, num_arguments)
+            try:
+                for batch in rows:
+                    writer.write(batch)
+            finally:
+                writer.close()
+
+        def number(rows):
+            # processes, threads and mappings are referenced by their row number in their own file
+            return {row[0]: i for i, row in enumerate(rows)}
+
+        with self._reading_session() as s:
+            conn = s.connection()
+            rows = conn.execute(select([_raw(processes.c.process_id), processes.c.process_id, processes.c.pid, processes.c.ppid, processes.c.create_time])
+                                .where(in_execution).order_by(processes.c.create_time, processes.c.pid)).fetchall()
+            process_numbers = number(rows)
+            write('processes', [[list(range(len(rows))), [str(r[1]) for r in rows], [r[2] for r in rows], [r[3] for r in rows], [r[4] for r in rows]]])
+
+            names: Dict[Any, List[str]] = {}
+            for (thread_id, name) in conn.execute(select([_raw(thread_names.c.thread_id), thread_names.c.name])
+                                                  .select_from(thread_names.join(of_threads, thread_names.c.thread_id == threads.c.thread_id))
+                                                  .where(in_execution).order_by(thread_names.c.id)):
+                names.setdefault(thread_id, []).append(name)
+            rows = conn.execute(select([_raw(threads.c.thread_id), threads.c.thread_id, _raw(threads.c.process_id), threads.c.tid, threads.c.create_time])
+                                .select_from(of_threads).where(in_execution).order_by(threads.c.create_time, threads.c.tid)).fetchall()
+            thread_numbers = number(rows)
+            write('threads', [[list(range(len(rows))), [str(r[1]) for r in rows], [process_numbers[r[2]] for r in rows],
+                               [r[3] for r in rows], [r[4] for r in rows], [names.get(r[0], []) for r in rows]]])
+
+            rows = conn.execute(select([_raw(mappings.c.mapping_id), mappings.c.mapping_id, _raw(mappings.c.process_id), mappings.c.name, mappings.c.path,
+                                        addresses.c.asid, addresses.c.address, addresses.c.execution_offset, mappings.c.size,
+                                        mappings.c.first_seen_execution_offset, mappings.c.last_seen_execution_offset])
+                                .select_from(mappings.join(processes, mappings.c.process_id == processes.c.process_id).join(addresses, mappings.c.base_id == addresses.c.address_id))
+                                .where(in_execution).order_by(mappings.c.first_seen_execution_offset, mappings.c.mapping_id)).fetchall()
+            mapping_numbers = number(rows)
+            columns = [list(c) for c in zip(*rows)] if rows else [[] for _ in range(11)]
+            write('mappings', [[list(range(len(rows))), [str(m) for m in columns[1]], [process_numbers[p] for p in columns[2]]] + columns[3:]])
+
+            query = select([_raw(slices.c.thread_id), slices.c.start_execution_offset, slices.c.end_execution_offset]) \
+                .select_from(slices.join(of_threads, slices.c.thread_id == threads.c.thread_id)) \
+                .where(in_execution).order_by(slices.c.start_execution_offset, slices.c.threadslice_id)
+            write('threadslices', ([[thread_numbers[t] for t in c[0]], list(c[1]), list(c[2])] for c in (list(zip(*batch)) for batch in _fetch_batches(conn, query, batch_size))))
+
+            (query, num_arguments) = _syscalls_with_arguments(conn, execution.uuid(), [_raw(syscalls.c.thread_id), syscalls.c.name, syscalls.c.retval, syscalls.c.pc, syscalls.c.execution_offset])
+            type_names = {db_type.name: name for name, (db_type, _, _) in _ARGUMENT_ENCODERS.items()}
+
+            def syscall_batches():
+                for batch in _fetch_batches(conn, query, batch_size):
+                    c = list(zip(*batch))
+                    columns = [[thread_numbers[t] for t in c[0]]] + [list(v) for v in c[1:5]]
+                    for first in range(5, len(c), 5):
+                        columns += _columnar.argument_columns(*c[first:first + 5], type_names)
+                    yield columns
+            write('syscalls', syscall_batches(), num_arguments)
+
+            query = select([flows.c.source_is_store, _raw(flows.c.source_thread_id), _raw(sources.c.mapping_id), sources.c.offset, flows.c.source_execution_offset,
+                            _raw(flows.c.sink_thread_id), _raw(sinks.c.mapping_id), sinks.c.offset, flows.c.sink_execution_offset]) \
+                .select_from(flows.join(of_threads, flows.c.source_thread_id == threads.c.thread_id)
+                             .join(sources, flows.c.source_id == sources.c.code_point_id).join(sinks, flows.c.sink_id == sinks.c.code_point_id)) \
+                .where(in_execution).order_by(flows.c.source_execution_offset, flows.c.taint_flow_id)
+            write('taint_flows', ([list(c[0]), [thread_numbers[t] for t in c[1]], [mapping_numbers[m] for m in c[2]], list(c[3]), list(c[4]),
+                                   [thread_numbers[t] for t in c[5]], [mapping_numbers[m] for m in c[6]], list(c[7]), list(c[8])]
+                                  for c in (list(zip(*batch)) for batch in _fetch_batches(conn, query, batch_size))))
+
+    def import_execution(self, path: str, format: str = 'parquet', name: str = None, batch_size: int = 10000) -> _models.Execution:
+        '''
+        Load an execution written by export_execution into this datastore as a new execution, named as it was exported
+        unless name is given. Everything is written in one transaction. Needs pyarrow.
+        '''
+        _columnar.require_pyarrow()
+        (exported_name, description) = _columnar.read_execution(path, format)
+
+        def rows(table):
+            return _columnar.iter_rows(path, table, format, batch_size)
+
+        with self.session_scope():
+            execution = self.new_execution(name if name is not None else exported_name, description)
+            exported = list(rows('processes'))
+            created = self.new_processes(execution, [(create_time, pid, ppid) for (_, _, pid, ppid, create_time) in exported])
+            processes = {row[0]: process for row, process in zip(exported, created)}
+            exported = list(rows('threads'))
+            created = self.new_threads([(processes[process], create_time, tid, names or []) for (_, _, process, tid, create_time, names) in exported])
+            threads = {row[0]: thread for row, thread in zip(exported, created)}
+            exported = list(rows('mappings'))
+            created = self.new_mappings([(processes[process], mapping_name, mapping_path, asid, base, base_execution_offset, size, first, last)
+                                         for (_, _, process, mapping_name, mapping_path, asid, base, base_execution_offset, size, first, last) in exported])
+            mappings = {row[0]: mapping for row, mapping in zip(exported, created)}
+            self.new_threadslices([(threads[thread], start, end) for (thread, start, end) in rows('threadslices')])
+            self.new_syscall_collection(((threads[row[0]], row[1], row[2], _columnar.unflatten_arguments(row, 5), row[4], row[3]) for row in rows('syscalls')), batch_size)
+            self.new_taintflow_collection(((is_store, threads[source_thread], mappings[source_mapping], source_offset, source_execution_offset,
+                                            threads[sink_thread], mappings[sink_mapping], sink_offset, sink_execution_offset)
+                                           for (is_store, source_thread, source_mapping, source_offset, source_execution_offset,
+                                                sink_thread, sink_mapping, sink_offset, sink_execution_offset) in rows('taint_flows')), batch_size)
+        return execution
+
+    def iter_syscall_batches(self, execution: _models.Execution, thread: _models.Thread = None, name: str = None, offset_range: Tuple[int, int] = None, batch_size: int = 10000) -> Iterator[pb.SyscallBatch]:
+        '''
+        The syscalls of an execution as models_pb2.SyscallBatch messages of up to batch_size syscalls, ordered by execution
+        offset and optionally limited as by iter_syscalls. The messages are filled straight from the rows of one streaming
+        query, a row per syscall with its arguments joined in, without building model objects. See write_delimited to send
+        them to a file or socket.
+        '''
+        syscalls = _db_models.Syscall.__table__
+        with self._reading_session() as s:
+            conn = s.connection()
+            query = _pb_syscalls_query(conn, execution.uuid())
+            if thread is not None:
+                query = query.where(syscalls.c.thread_id == thread.uuid())
+            if name is not None:
+                query = query.where(syscalls.c.name == name)
+            query = _filter_offset_range(query, syscalls.c.execution_offset, offset_range)
+            yield from _protobuf.syscall_batches(_fetch_batches(conn, query, batch_size))
+
+    def iter_taintflow_batches(self, execution: _models.Execution, source_thread: _models.Thread = None, sink_thread: _models.Thread = None, offset_range: Tuple[int, int] = None, batch_size: int = 10000) -> Iterator[pb.TaintFlowBatch]:
+        '''
+        The taint flows of an execution as models_pb2.TaintFlowBatch messages of up to batch_size flows, ordered by source
+        execution offset and optionally limited as by iter_taintflows, filled straight from the rows of one streaming query
+        '''
+        flows = _db_models.TaintFlow.__table__
+        query = _pb_taintflows_query(execution.uuid())
+        if source_thread is not None:
+            query = query.where(flows.c.source_thread_id == source_thread.uuid())
+        if sink_thread is not None:
+            query = query.where(flows.c.sink_thread_id == sink_thread.uuid())
+        query = _filter_offset_range(query, flows.c.source_execution_offset, offset_range)
+        with self._reading_session() as s:
+            yield from _protobuf.taintflow_batches(_fetch_batches(s.connection(), query, batch_size))
+
+    def iter_threadslice_batches(self, execution: _models.Execution, thread: _models.Thread = None, offset_range: Tuple[int, int] = None, batch_size: int = 10000) -> Iterator[pb.ThreadSliceBatch]:
+        '''
+        The thread slices of an execution as models_pb2.ThreadSliceBatch messages of up to batch_size slices, ordered by start
+        execution offset and optionally limited as by iter_threadslices, filled straight from the rows of one streaming query
+        '''
+        slices = _db_models.ThreadSlice.__table__
+        query = _pb_threadslices_query(execution.uuid())
+        if thread is not None:
+            query = query.where(slices.c.thread_id == thread.uuid())
+        query = _filter_offset_range(query, slices.c.start_execution_offset, offset_range)
+        with self._reading_session() as s:
+            yield from _protobuf.threadslice_batches(_fetch_batches(s.connection(), query, batch_size))
+
+    def iter_execution_dump(self, execution: _models.Execution, batch_size: int = 10000) -> Iterator[pb.ExecutionDump]:
+        '''
+        Everything recorded for an execution as models_pb2.ExecutionDump parts: a first one with the execution, its processes,
+        threads, mappings, the mappings' base addresses and code points, then one per batch of up to batch_size thread slices,
+        syscalls and taint flows, in that order. Merging the parts gives the whole dump, see write_execution_dump and
+        read_execution_dump. Costs nine queries however big the execution is.
+        '''
+        with self._reading_session() as s:
+            conn = s.connection()
+            yield _execution_dump_header(conn, execution)
+            yield from _protobuf.threadslice_batches(_fetch_batches(conn, _pb_threadslices_query(execution.uuid()), batch_size), pb.ExecutionDump, 'thread_slices')
+            yield from _protobuf.syscall_batches(_fetch_batches(conn, _pb_syscalls_query(conn, execution.uuid()), batch_size), pb.ExecutionDump, 'syscalls')
+            yield from _protobuf.taintflow_batches(_fetch_batches(conn, _pb_taintflows_query(execution.uuid()), batch_size), pb.ExecutionDump, 'taint_flows')
+
+    def write_execution_dump(self, execution: _models.Execution, stream, batch_size: int = 10000) -> int:
+        '''
+        Write the parts of iter_execution_dump as length-delimited messages to stream, a binary file object or a socket.
+        Returns the number of bytes written.
+        '''
+        return write_delimited(stream, self.iter_execution_dump(execution, batch_size))
+
+    def get_ingest_checkpoint(self, execution: _models.Execution, source: str) -> Optional[IngestCheckpoint]:
+        with self._session() as s:
+            c = s.query(_db_models.IngestCheckpoint).filter(_db_models.IngestCheckpoint.execution_id == execution.uuid(), _db_models.IngestCheckpoint.source == source).one_or_none()
+            if c is None:
+                return None
+            return IngestCheckpoint(c.stage, c.plog_chunk, c.syscalls, c.taint_flows, c.state)
+
+    def save_ingest_checkpoint(self, execution: _models.Execution, source: str, checkpoint: IngestCheckpoint) -> None:
+        '''
+        Create or replace the checkpoint of source's ingest into execution. Inside a session_scope the checkpoint is
+        committed together with the rows written in the same scope, which is what makes a checkpointed batch idempotent.
+        '''
+        with self._session() as s:
+            c = s.query(_db_models.IngestCheckpoint).filter(_db_models.IngestCheckpoint.execution_id == execution.uuid(), _db_models.IngestCheckpoint.source == source).one_or_none()
+            if c is None:
+                c = _db_models.IngestCheckpoint(execution_id=execution.uuid(), source=source)
+                s.add(c)
+            c.stage, c.plog_chunk, c.syscalls, c.taint_flows, c.state = checkpoint
+            self._track(s, 1)
+
+    def add_ingest_checkpoint_data(self, execution: _models.Execution, source: str, data: bytes) -> None:
+        with self._session() as s:
+            s.add(_db_models.IngestCheckpointData(execution_id=execution.uuid(), source=source, data=data))
+            self._track(s, 1)
+
+    def iter_ingest_checkpoint_data(self, execution: _models.Execution, source: str) -> Iterator[bytes]:
+        '''
+        The data added with add_ingest_checkpoint_data, in the order it was added
+        '''
+        data = _db_models.IngestCheckpointData.__table__
+        query = select([data.c.data]).where(data.c.execution_id == execution.uuid()).where(data.c.source == source).order_by(data.c.ingest_checkpoint_data_id)
+        with self._reading_session() as s:
+            for (d,) in s.connection().execute(query):
+                yield d
+
+    def delete_ingest_checkpoint_data(self, execution: _models.Execution, source: str) -> None:
+        with self._session() as s:
+            s.query(_db_models.IngestCheckpointData).filter(_db_models.IngestCheckpointData.execution_id == execution.uuid(), _db_models.IngestCheckpointData.source == source).delete(synchronize_session=False)